@@ -1,13 +1,14 @@
 // Merged from gateway/src/lib.rs into backend module.
 
 use axum::{
-    extract::State,
-    http::StatusCode,
-    response::Json,
+    extract::{Query, State},
+    http::{header, StatusCode},
+    response::{IntoResponse, Json},
     routing::{get, post},
     Router,
 };
-use pyo3::prelude::*;
+use pyo3::{prelude::*, types::PyDict};
+use serde::Deserialize;
 use serde_json::Value;
 use std::{net::SocketAddr, sync::Arc};
 use tokio::sync::Mutex;
@@ -52,6 +53,39 @@ impl EngineHandle {
         Ok(())
     }
 
+    /// string returned by an engine method, None if the engine is not running
+    async fn call_text(&self, method: &str, kwargs: &Value) -> anyhow::Result<Option<String>> {
+        let engine = self.engine.lock().await;
+        let Some(engine) = engine.as_ref() else {
+            return Ok(None);
+        };
+        let text = Python::with_gil(|py| -> anyhow::Result<String> {
+            let json = py.import_bound("json")?;
+            let kwargs = json.call_method1("loads", (kwargs.to_string(),))?.downcast_into::<PyDict>()?;
+            Ok(engine.call_method_bound(py, method, (), Some(&kwargs))?.extract(py)?)
+        })?;
+        Ok(Some(text))
+    }
+
+    /// calls an engine method returning a dict, as json; a python exception
+    /// (e.g. a profile session already running) is returned as the error text
+    async fn call_json(&self, method: &str, kwargs: &Value) -> Result<Value, (StatusCode, String)> {
+        let engine = self.engine.lock().await;
+        let Some(engine) = engine.as_ref() else {
+            return Err((StatusCode::SERVICE_UNAVAILABLE, "engine is not running".into()));
+        };
+        Python::with_gil(|py| -> PyResult<String> {
+            let json = py.import_bound("json")?;
+            let kwargs = json.call_method1("loads", (kwargs.to_string(),))?.downcast_into::<PyDict>()?;
+            let ret = engine.call_method_bound(py, method, (), Some(&kwargs))?;
+            json.call_method1("dumps", (ret,))?.extract()
+        })
+        .map_err(|e| (StatusCode::BAD_REQUEST, e.to_string()))
+        .and_then(|text| {
+            serde_json::from_str(&text).map_err(|e| (StatusCode::INTERNAL_SERVER_ERROR, e.to_string()))
+        })
+    }
+
     async fn status(&self) -> &'static str {
         if self.engine.lock().await.is_some() {
             "running"
@@ -87,6 +121,63 @@ async fn engine_status(State(state): State<AppState>) -> Json<Value> {
     Json(serde_json::json!({"status": state.engine.status().await}))
 }
 
+async fn engine_text(state: &AppState, method: &str, kwargs: &Value) -> Result<String, StatusCode> {
+    state
+        .engine
+        .call_text(method, kwargs)
+        .await
+        .map_err(|_| StatusCode::INTERNAL_SERVER_ERROR)?
+        .ok_or(StatusCode::SERVICE_UNAVAILABLE)
+}
+
+async fn engine_metrics(State(state): State<AppState>) -> Result<impl IntoResponse, StatusCode> {
+    let text = engine_text(&state, "get_metrics", &serde_json::json!({})).await?;
+    Ok(([(header::CONTENT_TYPE, "text/plain; version=0.0.4")], text))
+}
+
+#[derive(Deserialize)]
+struct TraceQuery {
+    profile: Option<String>,
+}
+
+/// the recent engine steps as a Chrome trace, see `Engine.get_step_trace`;
+/// query: ?profile=<id of a stopped "cpuinfer" profile session to merge in>, optional
+async fn engine_trace(
+    State(state): State<AppState>,
+    Query(query): Query<TraceQuery>,
+) -> Result<impl IntoResponse, (StatusCode, String)> {
+    let kwargs = serde_json::json!({"profile_id": query.profile});
+    let text = state
+        .engine
+        .call_text("get_step_trace", &kwargs)
+        .await
+        .map_err(|e| (StatusCode::BAD_REQUEST, e.to_string()))?
+        .ok_or((StatusCode::SERVICE_UNAVAILABLE, "engine is not running".to_string()))?;
+    Ok(([(header::CONTENT_TYPE, "application/json")], text))
+}
+
+/// body: {"kinds": ["torch", "cpuinfer", "python"], "duration": seconds, "steps": n}, all optional
+async fn engine_profile_start(
+    State(state): State<AppState>,
+    Json(payload): Json<Value>,
+) -> Result<Json<Value>, (StatusCode, String)> {
+    let mut kwargs = serde_json::Map::new();
+    for key in ["kinds", "duration", "steps"] {
+        if let Some(value) = payload.get(key) {
+            kwargs.insert(key.into(), value.clone());
+        }
+    }
+    Ok(Json(state.engine.call_json("start_profile", &Value::Object(kwargs)).await?))
+}
+
+async fn engine_profile_stop(State(state): State<AppState>) -> Result<Json<Value>, (StatusCode, String)> {
+    Ok(Json(state.engine.call_json("stop_profile", &serde_json::json!({})).await?))
+}
+
+async fn engine_profile_status(State(state): State<AppState>) -> Result<Json<Value>, (StatusCode, String)> {
+    Ok(Json(state.engine.call_json("profile_status", &serde_json::json!({})).await?))
+}
+
 pub async fn serve(addr: SocketAddr) -> anyhow::Result<()> {
     let engine = EngineHandle::new()?;
     let state = AppState { engine };
@@ -95,6 +186,11 @@ pub async fn serve(addr: SocketAddr) -> anyhow::Result<()> {
         .route("/engine/start", post(engine_start))
         .route("/engine/stop", post(engine_stop))
         .route("/engine/status", get(engine_status))
+        .route("/engine/metrics", get(engine_metrics))
+        .route("/engine/trace", get(engine_trace))
+        .route("/engine/profile/start", post(engine_profile_start))
+        .route("/engine/profile/stop", post(engine_profile_stop))
+        .route("/engine/profile/status", get(engine_profile_status))
         .with_state(state);
 
     println!("gateway listening on {addr}");
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Detokenization throughput, old re-decoding path against the
+               incremental detokenizer. Streams token sequences one id at a
+               time through both: random ids drawn from the tokenizer's vocab,
+               and the encoding of long CJK / emoji text whose characters span
+               several byte-fallback tokens.
+Version      : 1.0.0
+'''
+import argparse
+import random
+import time
+from typing import Callable, List
+
+from transformers import AutoTokenizer
+
+from heyi.utils.detokenizer import IncrementalDetokenizer
+
+
+def legacy_stream(tokenizer, ids: List[int]) -> str:
+    """the former `IOInterface.id_to_token`: re-decode the cache until it is valid text"""
+    out = []
+    token_cache = []
+    for new_id in ids:
+        token_cache.append(new_id)
+        text = tokenizer.decode(token_cache, skip_special_tokens=True)
+        if not text.endswith("�"):
+            out.append(text)
+            token_cache.clear()
+    return "".join(out)
+
+
+def incremental_stream(tokenizer, ids: List[int]) -> str:
+    detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
+    return "".join(detokenizer.step(new_id) for new_id in ids)
+
+
+def bench(name: str, fn: Callable, tokenizer, ids: List[int]) -> str:
+    t0 = time.perf_counter()
+    text = fn(tokenizer, ids)
+    t = time.perf_counter() - t0
+    print(f"  {name:<12} {len(ids) / t:12.0f} tokens/s  ({t * 1e6 / len(ids):8.2f} us/token)")
+    return text
+
+
+def random_ids(tokenizer, n: int) -> List[int]:
+    special = set(tokenizer.all_special_ids)
+    vocab = [i for i in range(len(tokenizer)) if i not in special]
+    return random.choices(vocab, k=n)
+
+
+def text_ids(tokenizer, n: int) -> List[int]:
+    unit = "长上下文里的中文和表情😀🚀🎉，还有日本語のテキスト。"
+    ids: List[int] = []
+    while len(ids) < n:
+        ids += tokenizer.encode(unit * 64, add_special_tokens=False)
+    return ids[:n]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", required=True, help="model or tokenizer path")
+    parser.add_argument("--n-tokens", type=int, nargs="+", default=[256, 1024, 4096])
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    random.seed(0)
+    for source, make_ids in [("random vocab", random_ids), ("cjk/emoji text", text_ids)]:
+        for n in args.n_tokens:
+            ids = make_ids(tokenizer, n)
+            print(f"{source}, {n} tokens:")
+            bench("legacy", legacy_stream, tokenizer, ids)
+            text = bench("incremental", incremental_stream, tokenizer, ids)
+            if source != "random vocab":
+                assert text == tokenizer.decode(ids, skip_special_tokens=True)
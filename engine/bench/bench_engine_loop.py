@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Engine loop idle cost and submit-to-first-schedule latency.
+               Boots a real engine, measures the CPU time burnt by the engine
+               thread while no request is in flight, then submits short
+               requests one at a time (engine idle in between) and reports the
+               time each one spent in the pending queue.
+Version      : 1.0.0
+'''
+import argparse
+import os
+import time
+
+from heyi.config import Config
+from heyi.engine import Engine
+from heyi.utils.request import ReqState
+
+
+def engine_thread_cpu_time(engine: Engine) -> float:
+    return time.clock_gettime(
+        time.pthread_getcpuclockid(engine.engine_thread.ident)
+    )
+
+
+def bench_idle(engine: Engine, seconds: float):
+    wall_start = time.perf_counter()
+    cpu_start = engine_thread_cpu_time(engine)
+    time.sleep(seconds)
+    cpu = engine_thread_cpu_time(engine) - cpu_start
+    wall = time.perf_counter() - wall_start
+    print(
+        f"idle: engine thread cpu {cpu:.3f}s / wall {wall:.3f}s "
+        f"({cpu / wall * 100:.1f}% of one core)"
+    )
+
+
+def bench_schedule_latency(engine: Engine, n_requests: int, idle_gap: float):
+    queue_times = []
+    for i in range(n_requests):
+        time.sleep(idle_gap)  # let the engine park again
+        req = engine.submit(
+            f"bench-loop-{i}",
+            [{"role": "user", "content": "hi"}],
+            dict(max_new_tokens=2, temperature=0),
+        )
+        while req.state not in [ReqState.FINISHED, ReqState.CANCELLED]:
+            time.sleep(0.001)
+        queue_times.append(req.stats.summarize()["queue_time"])
+
+    queue_times.sort()
+    print(
+        f"submit -> first schedule over {n_requests} requests: "
+        f"avg {sum(queue_times) / len(queue_times):.3f} ms, "
+        f"p50 {queue_times[len(queue_times) // 2]:.3f} ms, "
+        f"max {queue_times[-1]:.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", required=True)
+    parser.add_argument("--idle-seconds", type=float, default=10.0)
+    parser.add_argument("--n-requests", type=int, default=50)
+    parser.add_argument("--idle-gap", type=float, default=0.2)
+    args = parser.parse_args()
+
+    Config(enable_layerwise_prefill=False)
+    engine = Engine(args.model_path)
+    engine.boot()
+
+    bench_idle(engine, args.idle_seconds)
+    bench_schedule_latency(engine, args.n_requests, args.idle_gap)
+    bench_idle(engine, args.idle_seconds)
+
+    # the engine thread never returns
+    os._exit(0)
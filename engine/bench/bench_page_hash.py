@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Prefix-cache hashing cost against context length.
+               For each length, a sequence is planned into a kvcache, then
+               times: hashing all its pages on the host and on the device
+               (and checks they agree bit for bit), `match` hashing the whole
+               sequence, `match` with a warm per-request `PageHashCache`, and
+               the `plan` of one decode step.
+Version      : 1.0.0
+'''
+import argparse
+import time
+
+import torch
+from transformers.configuration_utils import PretrainedConfig
+
+from heyi.utils.kvcache.kvcache import PagedMLACache
+from heyi.utils.kvcache.pagehash import PageHashCache, do_page_hash
+
+
+PAGE_SIZE = 64
+
+
+def timed(fn, n_iters: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return (time.perf_counter() - t0) / n_iters
+
+
+def bench(context_len: int, n_iters: int):
+    max_num_pages = context_len // PAGE_SIZE + 64
+    cache = PagedMLACache(
+        PretrainedConfig(num_hidden_layers=1, kv_lora_rank=512, qk_rope_head_dim=64),
+        max_batch_size=4,
+        max_num_pages=max_num_pages,
+        page_size=PAGE_SIZE,
+    )
+    # the last page is half full, so a decode step rehashes it without allocating
+    prompt_len = context_len - PAGE_SIZE // 2
+    ids = torch.randint(0, 150000, (prompt_len + 1,), dtype=torch.int32, device="cpu")
+    prompt = ids[:prompt_len]
+
+    host = do_page_hash(prompt, PAGE_SIZE, trim=True)
+    device = do_page_hash(prompt.cuda(), PAGE_SIZE, trim=True)
+    assert host == device, "host and device page hashes differ"
+
+    matches = cache.plan(cache.match(prompt[None]), [prompt])
+    page_hashes = PageHashCache(PAGE_SIZE)
+    page_hashes.get(prompt)
+
+    # before any match, which splits the leaf off the partial last page
+    t_plan = timed(lambda: cache.plan(matches, [ids]), n_iters)
+
+    t_host = timed(lambda: do_page_hash(prompt, PAGE_SIZE, trim=True), n_iters)
+    t_device = timed(lambda: do_page_hash(prompt.cuda(), PAGE_SIZE, trim=True), n_iters)
+    t_match = timed(lambda: cache.match(prompt[None]), n_iters)
+    t_match_cached = timed(lambda: cache.match(prompt[None], [page_hashes]), n_iters)
+    print(
+        f"{context_len:>7} tokens: hash host {t_host * 1e3:7.3f} ms, device {t_device * 1e3:7.3f} ms | "
+        f"match {t_match * 1e3:7.3f} ms, cached {t_match_cached * 1e3:7.3f} ms | "
+        f"decode plan {t_plan * 1e3:7.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--context-lens", type=int, nargs="+", default=[1024, 4096, 16384, 65536, 131072])
+    parser.add_argument("--n-iters", type=int, default=50)
+    args = parser.parse_args()
+
+    torch.set_default_device("cuda")
+    for context_len in args.context_lens:
+        bench(context_len, args.n_iters)
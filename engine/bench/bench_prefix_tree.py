@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : PrefixTree operations with many cached conversations.
+               Inserts 10^5 synthetic conversations (a few shared system
+               prompts, then per-conversation turns) and times inserting,
+               matching the next turn of a random conversation, and reading
+               `prefix_len` / `prefix_page_indices` of its node, then evicting
+               the least recently used pages in batches. Page hashes are
+               chained like the kvcache's, without hashing any tokens.
+Version      : 1.0.0
+'''
+import argparse
+import random
+import time
+from typing import List
+
+from heyi.utils.kvcache.prefixtree import PrefixTree
+
+
+def chain(seed: int, n_pages: int) -> List[int]:
+    """n_pages chained page hashes after `seed`, all different from any other chain"""
+    hashes = []
+    for _ in range(n_pages):
+        seed = hash((seed, random.getrandbits(64)))
+        hashes.append(seed)
+    return hashes
+
+
+def bench(
+    n_convs: int,
+    n_system_prompts: int,
+    system_pages: int,
+    n_turns: int,
+    turn_pages: int,
+    n_queries: int,
+    evict_pages: int,
+):
+    random.seed(0)
+    tree = PrefixTree()
+    next_page = 0
+    system_prompts = [chain(i, system_pages) for i in range(n_system_prompts)]
+
+    convs: List[List[int]] = []
+    t0 = time.perf_counter()
+    for _ in range(n_convs):
+        hashes = list(random.choice(system_prompts))
+        # each turn is a request extending the previous one
+        for _ in range(random.randint(1, n_turns)):
+            hashes += chain(hashes[-1], random.randint(1, turn_pages))
+            match = tree.match(hashes)
+            n_new = len(hashes) - match.len
+            if n_new:
+                tree.add(list(range(next_page, next_page + n_new)), hashes[match.len :], match)
+                next_page += n_new
+        convs.append(hashes)
+    t_insert = time.perf_counter() - t0
+    print(f"{n_convs} conversations, {next_page} pages: insert {t_insert:.2f} s")
+
+    queries = [c + chain(c[-1], turn_pages) for c in random.choices(convs, k=n_queries)]
+    t0 = time.perf_counter()
+    matches = [tree.root.treematch(q) for q in queries]
+    t_match = (time.perf_counter() - t0) / n_queries
+    assert all(m.len == len(q) - turn_pages for m, q in zip(matches, queries))
+
+    t0 = time.perf_counter()
+    for m in matches:
+        m.node.prefix_len
+    t_prefix_len = (time.perf_counter() - t0) / n_queries
+
+    t0 = time.perf_counter()
+    for m in matches:
+        m.node.prefix_page_array()
+    t_indices_first = (time.perf_counter() - t0) / n_queries
+    t0 = time.perf_counter()
+    for m in matches:
+        m.node.prefix_page_array()
+    t_indices = (time.perf_counter() - t0) / n_queries
+
+    print(
+        f"match {t_match * 1e6:8.2f} us | prefix_len {t_prefix_len * 1e6:6.2f} us | "
+        f"prefix page indices {t_indices_first * 1e6:8.2f} us first, {t_indices * 1e6:6.2f} us cached"
+    )
+
+    n_evicts = next_page // 2 // evict_pages
+    t0 = time.perf_counter()
+    for _ in range(n_evicts):
+        assert len(tree.free(evict_pages)) == evict_pages
+    t_evict = (time.perf_counter() - t0) / n_evicts
+    print(f"evict {evict_pages} pages {t_evict * 1e6:8.2f} us ({n_evicts} times)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-convs", type=int, default=100000)
+    parser.add_argument("--n-system-prompts", type=int, default=16)
+    parser.add_argument("--system-pages", type=int, default=32)
+    parser.add_argument("--n-turns", type=int, default=4)
+    parser.add_argument("--turn-pages", type=int, default=8)
+    parser.add_argument("--n-queries", type=int, default=10000)
+    parser.add_argument("--evict-pages", type=int, default=64)
+    args = parser.parse_args()
+
+    bench(
+        args.n_convs,
+        args.n_system_prompts,
+        args.system_pages,
+        args.n_turns,
+        args.turn_pages,
+        args.n_queries,
+        args.evict_pages,
+    )
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Scheduler step time against the number of live requests.
+               Builds an engine without loading a model, fills the request
+               registry with a mix of pending and decoding requests and times
+               the bookkeeping of one loop iteration (finished-request
+               cleanup, preempted-request resume, prefill batch selection and the
+               16 decode batch selections), without any forward pass.
+Version      : 1.0.0
+'''
+import argparse
+import time
+
+import torch
+from transformers import GenerationConfig
+from transformers.configuration_utils import PretrainedConfig
+
+from heyi.config import Config
+from heyi.engine import N_RUNNERS, Engine
+from heyi.utils.kvcache.accounting import KVPageAccounting
+from heyi.utils.kvcache.kvcache import PagedMLACache
+from heyi.utils.request import ReqState, Request, RequestRegistry
+from heyi.utils.stream import AsyncStream
+
+
+PAGE_SIZE = 64
+
+
+def make_engine(n_requests: int, pending_ratio: float) -> Engine:
+    engine = Engine("")
+    engine.enable_layerwise_prefill = False
+    engine.lp_req = None
+    engine.lp_res = None
+    engine.host_kv_pool = None
+    engine.n_preemptions = 0
+    engine.Bs = Config().batch_sizes_per_runner
+    engine.kvcache = PagedMLACache(
+        PretrainedConfig(num_hidden_layers=1, kv_lora_rank=512, qk_rope_head_dim=64),
+        max_batch_size=Config().max_batch_size,
+        max_num_pages=4 * n_requests + 64,
+        page_size=PAGE_SIZE,
+    )
+    engine.kv_accounting = KVPageAccounting(engine.kvcache.page_table, engine.kvcache.prefix_tree)
+    engine.requests = RequestRegistry(engine._on_request_state_change)
+
+    n_pending = int(n_requests * pending_ratio)
+    for i in range(n_requests):
+        input_ids = torch.randint(0, 32000, (1, PAGE_SIZE + i % PAGE_SIZE), dtype=torch.int)
+        req = Request(
+            f"bench-sched-{i}",
+            AsyncStream(f"bench-sched-{i}", cancel=engine.cancel),
+            input_ids,
+            logits_processor=None,
+            generation_config=GenerationConfig(max_length=512, max_new_tokens=256),
+        )
+        req.matches = engine.kvcache.plan(
+            engine.kvcache.match(req.all_ids[:, : req.all_length]),
+            req.all_ids[:, : req.all_length],
+        )
+        engine.requests.add(req)
+        if i >= n_pending:
+            req.state = ReqState.DECODING
+    return engine
+
+
+def scheduler_step(engine: Engine):
+    engine._handle_finished_reqs()
+    engine._resume_preempted_reqs()
+    engine._next_chunked_prefill_batch()
+    for _ in range(16):
+        engine._continuous_batching(N_RUNNERS)
+
+
+def bench(n_requests: int, pending_ratio: float, n_iters: int):
+    engine = make_engine(n_requests, pending_ratio)
+    for _ in range(3):
+        scheduler_step(engine)
+
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        scheduler_step(engine)
+    t = (time.perf_counter() - t0) / n_iters
+    print(f"{n_requests:>6} requests: {t * 1e3:8.3f} ms / scheduler step")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-requests", type=int, nargs="+", default=[10, 100, 1000, 2000])
+    parser.add_argument("--pending-ratio", type=float, default=0.1)
+    parser.add_argument("--n-iters", type=int, default=100)
+    args = parser.parse_args()
+
+    torch.set_default_device("cuda")
+    Config(enable_layerwise_prefill=False)
+    for n in args.n_requests:
+        bench(n, args.pending_ratio, args.n_iters)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Token delivery from the engine thread to http streams.
+               A producer thread plays the engine, putting one token on each
+               of 500 concurrent streams per scheduler step; the consumers
+               iterate the streams on one asyncio loop, as the http server
+               does. Compares one loop hop per token against the coalescing
+               StreamDelivery (flushed once per step, optionally with a flush
+               interval) and reports consumer-side CPU and token latency.
+Version      : 1.0.0
+'''
+import argparse
+import asyncio
+import threading
+import time
+from typing import List, Optional
+
+from heyi.utils.stream import AsyncStream, StreamDelivery
+
+
+def produce(streams: List[AsyncStream], delivery: Optional[StreamDelivery], n_steps: int, step_time: float):
+    for _ in range(n_steps):
+        t0 = time.perf_counter()
+        for stream in streams:
+            # the put time rides along as the token text
+            stream.put((f"{time.perf_counter():.6f};", None))
+        if delivery is not None:
+            delivery.flush()
+        time.sleep(max(step_time - (time.perf_counter() - t0), 0))
+    for stream in streams:
+        stream.put(("", "length"))
+        stream.finish()
+    if delivery is not None:
+        delivery.flush(force=True)
+
+
+async def consume(stream: AsyncStream, latencies: List[float], n_chunks: List[int]):
+    async for txt, _ in stream.generator():
+        now = time.perf_counter()
+        if txt:
+            # latency of the oldest token of the chunk
+            latencies.append(now - float(txt.split(";", 1)[0]))
+            n_chunks[0] += 1
+
+
+async def run(name: str, n_streams: int, n_steps: int, step_time: float, coalesce: bool, flush_interval: float):
+    delivery = StreamDelivery() if coalesce else None
+    streams = [
+        AsyncStream(f"bench-stream-{i}", cancel=lambda _: None, delivery=delivery,
+                    min_flush_interval=flush_interval)
+        for i in range(n_streams)
+    ]
+    latencies: List[float] = []
+    n_chunks = [0]
+    consumers = [asyncio.create_task(consume(s, latencies, n_chunks)) for s in streams]
+    await asyncio.sleep(0.1)  # every consumer is waiting on its stream
+
+    cpu0, wall0 = time.thread_time(), time.perf_counter()
+    producer = threading.Thread(target=produce, args=(streams, delivery, n_steps, step_time))
+    producer.start()
+    await asyncio.gather(*consumers)
+    cpu, wall = time.thread_time() - cpu0, time.perf_counter() - wall0
+    producer.join()
+
+    latencies.sort()
+    print(
+        f"{name:<22} consumer cpu {cpu:6.3f}s / wall {wall:6.3f}s ({cpu / wall * 100:5.1f}%), "
+        f"{n_chunks[0]:>7} chunks, latency p50 {latencies[len(latencies) // 2] * 1e3:7.2f} ms "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:7.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-streams", type=int, default=500)
+    parser.add_argument("--n-steps", type=int, default=200)
+    parser.add_argument("--step-ms", type=float, default=20.0)
+    parser.add_argument("--flush-interval-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    step_time = args.step_ms / 1e3
+    for name, coalesce, flush_interval in [
+        ("hop per token", False, 0.0),
+        ("coalesced", True, 0.0),
+        (f"coalesced, {args.flush_interval_ms:g}ms flush", True, args.flush_interval_ms / 1e3),
+    ]:
+        asyncio.run(run(name, args.n_streams, args.n_steps, step_time, coalesce, flush_interval))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Concurrent submit throughput against prompt length.
+               Many clients render and tokenize chat prompts at once on one
+               asyncio loop, as the http server does, either synchronously
+               in the caller (the former `Engine.submit`) or on the
+               tokenizer pool (`Engine.submit_async`). Reports prompts/s and
+               the worst stall of the event loop.
+Version      : 1.0.0
+'''
+import argparse
+import asyncio
+import time
+
+from transformers import AutoTokenizer
+
+from heyi.utils.tokenizer_pool import TokenizerPool
+
+
+TEXT = "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。"
+
+
+def make_messages(n_chars: int):
+    return [{"role": "user", "content": (TEXT * (n_chars // len(TEXT) + 1))[:n_chars]}]
+
+
+async def loop_lag(stop: asyncio.Event) -> float:
+    """largest delay of a 1ms timer on the loop"""
+    worst = 0.0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - t0 - 0.001)
+    return worst
+
+
+async def run(tokenize, n_requests: int, concurrency: int, messages):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            return await tokenize(messages)
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(loop_lag(stop))
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[one() for _ in range(n_requests)])
+    t = time.perf_counter() - t0
+    stop.set()
+    return results[0].shape[1], n_requests / t, await lag
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", required=True)
+    parser.add_argument("--n-chars", type=int, nargs="+", default=[1_000, 10_000, 100_000, 400_000])
+    parser.add_argument("--n-requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    pool = TokenizerPool(args.model_path, args.workers)
+
+    async def sync_tokenize(messages):
+        return tokenizer.apply_chat_template(
+            messages, tokenize=True, add_generation_prompt=True, return_tensors="pt"
+        )
+
+    async def pool_tokenize(messages):
+        return await pool.format_and_tokenize(messages)
+
+    # spawn the workers and load their tokenizers
+    asyncio.run(run(pool_tokenize, args.workers * 2, args.workers, make_messages(100)))
+
+    for n_chars in args.n_chars:
+        messages = make_messages(n_chars)
+        for name, tokenize in [("caller", sync_tokenize), (f"pool x{args.workers}", pool_tokenize)]:
+            n_tokens, throughput, lag = asyncio.run(
+                run(tokenize, args.n_requests, args.concurrency, messages)
+            )
+            print(
+                f"{n_tokens:>8} tokens  {name:<10} {throughput:8.2f} prompts/s  "
+                f"max loop stall {lag * 1e3:8.2f} ms"
+            )
+    pool.shutdown()
@@ -16,6 +16,8 @@ class Config(Singleton):
     max_length: int = 130000
     max_new_tokens: int = 130000
     prefill_chunk_size: int = 128
+    prefill_batch_num_tokens: int = 2048
+    mixed_prefill_decode: bool = False
 
     enable_layerwise_prefill: bool = True
     layerwise_prefill_device: int = 0
@@ -23,6 +25,9 @@ class Config(Singleton):
 
     kvcache_page_size: int = 64
     kvcache_num_tokens: int = 150000
+    kvcache_free_watermark: float = 0.02
+    preemption_mode: str = "swap"  # swap / recompute
+    swap_space_num_tokens: int = 32768
     
     top_k: int = 40
     top_p: float = 0.9
@@ -34,6 +39,10 @@ class Config(Singleton):
     model_name: str = ""
     api_key: str = ""
     trust_remote_code: bool = True
+    tokenizer_workers: int = 4
+    chat_template_cache_size: int = 64
+    chat_template_cache_verify: bool = False
+    step_recorder_size: int = 65536
 
     auto_license: bool = False
 
@@ -2,6 +2,7 @@ import time
 import asyncio
 import copy
 import gc
+import json
 import threading
 from typing import Awaitable, Dict, List, Optional, Tuple
 from enum import Enum
@@ -18,7 +19,6 @@ from flashinfer.logits_processor import (
 )
 
 # from line_profiler import profile
-from torch.profiler import ProfilerActivity, profile
 from transformers import AutoConfig, GenerationConfig
 
 from heyi.operators.experts import KExpertsCPU
@@ -31,11 +31,21 @@ from heyi.optimized_models.opt_modeling_qwen3_moe import OptQwen3MoeForCausalLM
 from heyi.runner import MLADecodeRunner, GQADecodeRunner, MLA_LPrefillRunner, GQA_LPrefillRunner
 from heyi.config import Config
 from heyi.io_interface import IOInterface
+from heyi.utils.decode_partition import DecodeCostModel, partition_decode_reqs
 from heyi.utils.fork_model import fork_model
+from heyi.utils.kvcache.accounting import KVPageAccounting
 from heyi.utils.kvcache.kvcache import PagedMLACache, PagedGQACache, n_pages
+from heyi.utils.kvcache.swap import HostKVPool
 from heyi.utils.log import logger
-from heyi.utils.request import AsyncStream, ReqState, Request, DecodeBatch
+from heyi.utils.metrics import EngineMetrics
+from heyi.utils.profiler import Profiler
+from heyi.utils.request import ReqState, Request, RequestRegistry, DecodeBatch
+from heyi.utils.sampling import SamplingParams
+from heyi.utils.stats import LatencyStats
+from heyi.utils.stop_matcher import StopMatcher
+from heyi.utils.stream import AsyncStream, StreamDelivery
 from heyi.utils.singleton import Singleton
+from heyi.utils.step_recorder import StepRecorder
 from heyi.utils.utils import make_async
 from heyi.utils.weight_loader import WeightLoader
 
@@ -128,9 +138,21 @@ class Engine(Singleton):
                 self.enable_layerwise_prefill = False
                 Config().enable_layerwise_prefill = False
 
-        self.requests: List[Request] = []
+        self.requests = RequestRegistry(self._on_request_state_change)
+        # stream updates of a step reach each consumer loop in one hop
+        self.stream_delivery = StreamDelivery()
+        self.latency_stats = LatencyStats()
+        self.recorder = StepRecorder()
 
         self.batch_sizes_per_runner = self.Bs = Config().batch_sizes_per_runner
+        self.decode_cost_model = DecodeCostModel(self.Bs)
+        # last decode step of each runner, predicted vs measured
+        self.decode_step_stats = [
+            dict(batch_size=0, kv_tokens=0, predicted_ms=0.0, actual_ms=0.0)
+            for _ in range(N_RUNNERS)
+        ]
+        # decode batches planned one substep ahead, see `_prepare_next_decode`
+        self.prepared: Optional[Tuple[List[DecodeBatch | None], Dict[str, int]]] = None
 
         kvcache_max_num_pages = n_pages(Config().kvcache_num_tokens, Config().kvcache_page_size)
         logger.info(
@@ -153,6 +175,27 @@ class Engine(Singleton):
             )
         else:
             logger.fatal(f"kvcache unsupported for {config.model_type}")
+        self.kv_accounting = KVPageAccounting(self.kvcache.page_table, self.kvcache.prefix_tree)
+        # pages kept free by evicting the prefix cache off the planning path, 0 evicts on demand only
+        self.kv_free_watermark = int(kvcache_max_num_pages * Config().kvcache_free_watermark)
+
+        self.metrics = EngineMetrics(self.Bs[-1])
+        self.metrics.kv_pages.set_function(lambda: {
+            "free": self.kv_accounting.free_pages,
+            "used": self.kv_accounting.in_use_pages,
+            "busy": self.kv_accounting.busy_pages,
+            "cached": self.kv_accounting.cached_pages,
+        })
+        self.metrics.queue_depth.set_function(
+            lambda: {state.value: self.requests.count(state) for state in ReqState}
+        )
+
+        self.n_preemptions = 0
+        self.host_kv_pool: Optional[HostKVPool] = None
+        if Config().preemption_mode == "swap":
+            swap_space_num_pages = n_pages(Config().swap_space_num_tokens, Config().kvcache_page_size)
+            logger.info(f"init host kv swap space: num_pages={swap_space_num_pages}")
+            self.host_kv_pool = HostKVPool(self.kvcache.page_table.pages, swap_space_num_pages)
 
         logger.info("init model")
         with torch.device("meta"), torch.no_grad():
@@ -199,9 +242,9 @@ class Engine(Singleton):
                 for i in range(N_RUNNERS)
             ]
 
+        self.lp_req: Optional[Request] = None
+        self.lp_res = None
         if self.enable_layerwise_prefill:
-            self.lp_req = None
-
             if config.model_type in ["deepseek_v3", "kimi_k2"]:
                 self.lp_runner = MLA_LPrefillRunner(
                     N_RUNNERS,
@@ -217,10 +260,17 @@ class Engine(Singleton):
                     Config().layerwise_prefill_device,
                 )
 
+        # submit/cancel/lprefill completion wake the engine loop up when it is parked
+        self.wakeup = threading.Condition()
+        self.wakeup_pending = False
+
+        self.profiler = Profiler(KExpertsCPU.CPU_INFER.cpuinfer if KExpertsCPU.CPU_INFER else None)
+
         self.state = EngineState.RUNNING
         self.engine_thread = threading.Thread(target=self._start_engine_loop)
         self.engine_thread.start()
-        self.trace_started = False
+        # the python sampler of profile sessions samples the engine loop
+        self.profiler.thread_id = self.engine_thread.ident
         self.decode_throughput = 0
 
     def _start_engine_loop(self):
@@ -228,35 +278,115 @@ class Engine(Singleton):
         asyncio.set_event_loop(loop)
         loop.run_until_complete(self.run_engine_loop())
 
+    def _wakeup_engine(self):
+        """thread-safe, called by submit/cancel or any event that may create runnable work"""
+        with self.wakeup:
+            self.wakeup_pending = True
+            self.wakeup.notify_all()
+
+    def _wait_for_wakeup(self):
+        """block until `_wakeup_engine` is called, runs on an executor thread"""
+        with self.wakeup:
+            while not self.wakeup_pending:
+                self.wakeup.wait()
+            self.wakeup_pending = False
+
     def _handle_finished_reqs(self):
-        for req in self.requests:
-            if req.state in [ReqState.FINISHED, ReqState.CANCELLED]:
-                stat = req.stats.pretty_print_str()
-                logger.info(f"<{req.request_id}> finished/cancelled\n" + stat)
-                self.requests.remove(req)
-
-    def _summarize_kvcache_usage(self):
-        self.busy_kvcache_pages = 0
-        for req in self.requests:
-            if req.state is ReqState.LPREFILLING:
-                self.busy_kvcache_pages += n_pages(req.all_length, self.kvcache.page_size)
-            elif req.state is ReqState.PREFILLING:
-                self.busy_kvcache_pages += n_pages(req.prefilled_length, self.kvcache.page_size)
-            elif req.state is ReqState.DECODING:
-                self.busy_kvcache_pages += n_pages(req.all_length, self.kvcache.page_size)
-        # logger.info(f"kvcache usage: [{self.busy_kvcache_pages} busy / {len(self.kvcache.page_table.used_pages)} used / {self.kvcache.max_num_pages} all]")
+        finished = self.requests.in_state(ReqState.FINISHED, ReqState.CANCELLED)
+        if self.lp_req in finished and self.lp_res is not None and not self.lp_res.done():
+            # the lprefill runner still reads its tokens and writes its pages,
+            # `_handle_layerwise_prefill` lets go of it once the run is over
+            finished.remove(self.lp_req)
+        for req in finished:
+            if req.swap_handle is not None:
+                self.host_kv_pool.free(req.swap_handle.slots)
+                req.swap_handle = None
+            # unpin the prefix, its pages stay cached
+            req.matches = []
+            req.tokens.release()
+            self.latency_stats.add_request(req.stats)
+            self.metrics.requests_finished.labels(req.state.value.lower()).inc()
+            stat = req.stats.pretty_print_str()
+            logger.info(f"<{req.request_id}> finished/cancelled\n" + stat)
+            self.requests.remove(req)
+        return len(finished)
+
+    def _account_kv_pages(self, req: Request, reserved: int = 0):
+        """refresh the kvcache pages held by `req` after its state or length changed"""
+        page_size = self.kvcache.page_size
+        if req.state is ReqState.LPREFILLING:
+            in_use = n_pages(req.prefilled_length, page_size)
+            # the whole prompt is written in one go
+            self.kv_accounting.set(
+                req.request_id, in_use, n_pages(req.prefill_length, page_size) - in_use
+            )
+        elif req.state is ReqState.PREFILLING:
+            self.kv_accounting.set(
+                req.request_id, n_pages(req.prefilled_length, page_size), reserved
+            )
+        elif req.state is ReqState.DECODING:
+            self.kv_accounting.set(req.request_id, n_pages(req.all_length, page_size))
+        else:
+            self.kv_accounting.release(req.request_id)
+
+    def _reclaim_kv_pages(self):
+        """
+        evict prefix-cache pages toward the free watermark while the gpu is
+        busy or the loop idles, so planning seldom has to; pinned pages cannot
+        be evicted, so only the cached ones count toward the watermark
+        """
+        n_free = self.kvcache.page_table.n_free_pages
+        target = min(self.kv_free_watermark, n_free + self.kv_accounting.cached_pages)
+        if n_free >= target:
+            return
+        with self.recorder.span("kv_reclaim", "scheduler") as args:
+            args["pages"] = self.kvcache.reclaim(target)
+
+    def _on_request_state_change(self, req: Request, old_state: ReqState):
+        self._account_kv_pages(req)
+
+    def _preempt(self, req: Request):
+        """pause a decoding request, its kvcache pages become evictable"""
+        self.n_preemptions += 1
+        swap_handle = None
+        if self.host_kv_pool is not None:
+            # the kv of the last sampled token is not written yet
+            swap_handle = self.kvcache.swap_out(
+                req.matches[0], req.all_length - 1, self.host_kv_pool
+            )
+            if swap_handle is None:
+                logger.warning(f"host swap space full, <{req.request_id}> will be recomputed")
+        self.metrics.preemptions.labels("swap" if swap_handle else "recompute").inc()
+        logger.info(
+            f"<{req.request_id}> preempted ({'swap' if swap_handle else 'recompute'}), "
+            f"{req.all_length} tokens"
+        )
+        req.preempt(swap_handle)
+
+    def _resume_preempted_reqs(self):
+        """swap preempted requests back in, oldest first, once their pages fit again"""
+        n_decoding = self.requests.count(ReqState.DECODING)
+        for req in self.requests.in_state(ReqState.PREEMPTED):
+            pages_needed = n_pages(req.all_length, self.kvcache.page_size)
+            # keep one page of headroom per decoding request to avoid thrashing
+            if pages_needed + n_decoding > self.kv_accounting.free_pages:
+                break
+            match = self.kvcache.swap_in(
+                req.swap_handle, req.all_ids[0, : req.all_length - 1], self.host_kv_pool, req.page_hashes
+            )
+            req.resume(match)
+            logger.info(f"<{req.request_id}> resumed, {req.all_length} tokens")
+            n_decoding += 1
 
     def _next_layerwise_prefill_req(self):
         lp_req = None
-        for req in self.requests:
-            if req.state not in [ReqState.PENDING, ReqState.PREFILLING]:
-                continue
+        for req in self.requests.in_state(ReqState.PREFILLING, ReqState.PENDING):
             if not req.matches:
-                req.matches = self.kvcache.match(req.all_ids[:, : req.prompt_length])
+                req.matches = self.kvcache.match(req.all_ids[:, : req.prefill_length], [req.page_hashes])
             if (
                 req.matches[0].len * self.kvcache.page_size
                 + Config().layerwise_prefill_thresh_len
-                <= req.prompt_length
+                <= req.prefill_length
             ):
                 lp_req = req
                 break
@@ -270,12 +400,13 @@ class Engine(Singleton):
         if next_lp_req is None:
             return
         
-        if n_pages(next_lp_req.all_length - next_lp_req.prefilled_length, self.kvcache.page_size) + self.busy_kvcache_pages > self.kvcache.max_num_pages:
+        if n_pages(next_lp_req.all_length - next_lp_req.prefilled_length, self.kvcache.page_size) > self.kv_accounting.free_pages:
             logger.warning(f"no free kvcache, skipping lprefill <{next_lp_req}>")
             return
 
         self.lp_req = next_lp_req
         self.lp_req.state = ReqState.LPREFILLING
+        self.lp_req.stats.on_scheduled()
         logger.debug(f"<{self.lp_req.request_id}> layerwise prefilling")
 
     def _layerwise_prefill_blocking(self):
@@ -291,13 +422,24 @@ class Engine(Singleton):
         print("UNLOAD MAIN MODELS")
         print(torch.cuda.memory_allocated() / 1024**2, "MB")
 
-        logits = self.lp_runner.prefill(self.lp_req)
+        t0 = time.perf_counter()
+        logits, step_time = self._timed(self.lp_runner.prefill, self.lp_req)
+        self.recorder.record(
+            "lprefill", "lprefill", t0, t0 + step_time,
+            req=self.lp_req.request_id, prefill_length=self.lp_req.prefill_length,
+        )
+        self.metrics.step_time.labels("lprefill").observe(step_time)
+        # the runner set prefilled_length to the matched prefix
+        self.metrics.prefill_tokens.inc(self.lp_req.prefill_length - self.lp_req.prefilled_length)
+        self.metrics.generation_tokens.inc()
 
         # prefill & decode on same device
-        next_token, txt, stop = self.io.logits_to_token(
-            logits, self.lp_req.logits_processor, self.lp_req.token_cache
-        )
-        self.lp_req.on_prefill_done(next_token, txt, stop)
+        if self.lp_req.state is ReqState.LPREFILLING:
+            next_token, txt, stop = self.io.logits_to_token(
+                logits, self.lp_req.logits_processor, self.lp_req.detokenizer, self.lp_req.stop_matcher
+            )
+            self.lp_req.on_prefill_done(next_token, txt, stop)
+            self._account_kv_pages(self.lp_req)
         self.lp_req = None
         print(torch.cuda.memory_allocated() / 1024**2, "MB")
         print("LOAD MAIN MODELS")
@@ -311,73 +453,159 @@ class Engine(Singleton):
         for runner in self.runners:
             runner.warmup_and_capture_graph()
         self.state = EngineState.RUNNING
-        return
+        return True
 
-    async def _handle_layerwise_prefill(self):
+    async def _handle_layerwise_prefill(self) -> bool:
+        """returns whether any progress was made"""
         if self.lp_req is None:
-            return
+            return False
         
         if Config().layerwise_prefill_device == 0:
             return self._layerwise_prefill_blocking()
 
         if self.state is not EngineState.LPREFILLING:
             self.state = EngineState.LPREFILLING
-            self.lp_res = make_async(self.lp_runner.prefill)(self.lp_req)
+            self.lp_start_time = time.perf_counter()
+            self.lp_res = make_async(self._timed)(self.lp_runner.prefill, self.lp_req)
+            # wake the loop up if it parks while the lprefill is running
+            self.lp_res.add_done_callback(lambda _: self._wakeup_engine())
+            return True
 
         # prefill-decode-disagg
-        try:
-            logits = await asyncio.wait_for(asyncio.shield(self.lp_res), timeout=0.01)
-            print(f"{logits=}")
-            logits = logits.to(0)
-            next_token, txt, stop = self.io.logits_to_token(
-                logits, self.lp_req.logits_processor, self.lp_req.token_cache
-            )
-            self.lp_req.on_prefill_done(next_token, txt, stop)
+        if not self.lp_res.done():
+            return False
+
+        logits, step_time = self.lp_res.result()
+        self.lp_res = None
+        self.recorder.record(
+            "lprefill", "lprefill", self.lp_start_time, self.lp_start_time + step_time,
+            req=self.lp_req.request_id, prefill_length=self.lp_req.prefill_length,
+        )
+        self.metrics.step_time.labels("lprefill").observe(step_time)
+        self.metrics.prefill_tokens.inc(self.lp_req.prefill_length - self.lp_req.prefilled_length)
+        if self.lp_req.state is not ReqState.LPREFILLING:
+            # cancelled while running, `_handle_finished_reqs` removes it
+            logger.info(f"<{self.lp_req.request_id}> lprefill result dropped, {self.lp_req.state.name}")
             self.lp_req = None
             self.state = EngineState.RUNNING
-        except asyncio.TimeoutError:
-            pass
-
-    def _next_chunked_prefill_req(self):
-        cp_req = None
-        for req in self.requests:
-            if req.state not in [ReqState.PENDING, ReqState.PREFILLING]:
-                continue
-
-            if n_pages(Config().prefill_chunk_size, self.kvcache.page_size) + self.busy_kvcache_pages > self.kvcache.max_num_pages:
-                logger.warning(f"no free kvcache, skipping chunked prefill <{req}>")
-                continue
+            return True
+        self.metrics.generation_tokens.inc()
+        print(f"{logits=}")
+        logits = logits.to(0)
+        next_token, txt, stop = self.io.logits_to_token(
+            logits, self.lp_req.logits_processor, self.lp_req.detokenizer, self.lp_req.stop_matcher
+        )
+        self.lp_req.on_prefill_done(next_token, txt, stop)
+        self._account_kv_pages(self.lp_req)
+        self.lp_req = None
+        self.state = EngineState.RUNNING
+        return True
+
+    def _next_chunked_prefill_batch(self, n_decode_reqs: int = 0) -> List[Tuple[Request, int]]:
+        """
+        packs chunks of several requests into one pass, up to the token budget;
+        `n_decode_reqs` decode tokens ride along in the same pass
+        """
+        batch: List[Tuple[Request, int]] = []
+        budget = Config().prefill_batch_num_tokens - n_decode_reqs
+        # each decode row may take a new page
+        free_pages = self.kv_accounting.free_pages - n_decode_reqs
+        page_size = self.kvcache.page_size
+        # pages planned by the running lprefill, their kv is not written yet
+        lp_pages = set(self.lp_req.matches[0].node.prefix_page_indices()) if self.lp_req else set()
+        # requests already halfway through their prompt go first
+        for req in self.requests.in_state(ReqState.PREFILLING, ReqState.PENDING):
+            if len(batch) + n_decode_reqs >= self.kvcache.max_batch_size or budget <= 0:
+                break
 
             if not req.matches:
-                req.matches = self.kvcache.match(req.all_ids[:, : req.prompt_length])
+                req.matches = self.kvcache.match(req.all_ids[:, : req.prefill_length], [req.page_hashes])
             if (
-                not self.enable_layerwise_prefill or
-                req.matches[0].len * self.kvcache.page_size
+                self.enable_layerwise_prefill and
+                req.matches[0].len * page_size
                 + Config().layerwise_prefill_thresh_len
-                > req.prompt_length
+                <= req.prefill_length
             ):
-                cp_req = req
-                break
-        return cp_req
+                continue
 
-    async def _handle_chunked_prefill(self):
-        req = self._next_chunked_prefill_req()
-        if req is None:
-            return
-        req.state = ReqState.PREFILLING
-        
-        if self.lp_req and set(req.matches[0].node.prefix_page_indices()) & set(self.lp_req.matches[0].node.prefix_page_indices()):
-            # logger.warning(f"<{req.request_id}> chunked prefill KV cache conflict with lprefill, skip")
-            return
-        
-        logger.debug(f"<{req.request_id}> prefilling on Rnr#0")
-        logits = await make_async(self.runners[0].prefill_chunk)(req)
-        prefill_done = req.on_prefill_1chunk_done()
-        if prefill_done:
-            next_token, txt, stop = self.io.logits_to_token(
-                logits, req.logits_processor, req.token_cache
-            )
-            req.on_prefill_done(next_token, txt, stop)
+            if lp_pages and not lp_pages.isdisjoint(req.matches[0].node.prefix_page_indices()):
+                # logger.warning(f"<{req.request_id}> chunked prefill KV cache conflict with lprefill, skip")
+                continue
+
+            remaining = max(req.prefill_length - req.matches[0].len * page_size, 1)
+            chunk_size = min(Config().prefill_chunk_size, budget)
+            if chunk_size < remaining:
+                # only the last chunk of a request may end in the middle of a page
+                chunk_size = chunk_size // page_size * page_size
+                if chunk_size == 0:
+                    break
+            chunk_size = min(chunk_size, remaining)
+
+            if n_pages(chunk_size, page_size) > free_pages:
+                logger.warning(f"no free kvcache, skipping chunked prefill <{req}>")
+                continue
+
+            free_pages -= n_pages(chunk_size, page_size)
+            budget -= chunk_size
+            batch.append((req, chunk_size))
+        return batch
+
+    def _next_mixed_decode_reqs(self) -> List[Request]:
+        # leave room for at least one prefill chunk, and a kvcache page for
+        # each decode row like `_continuous_batching`
+        limit = min(self.kvcache.max_batch_size - 1, self.kv_accounting.free_pages)
+        return self.requests.in_state(ReqState.DECODING, limit=max(limit, 0))
+
+    async def _handle_chunked_prefill(self) -> Tuple[bool, int]:
+        """
+        returns whether any chunk was prefilled and the number of tokens
+        decoded in the same pass (mixed prefill-decode mode)
+        """
+        decode_reqs: List[Request] = []
+        if Config().mixed_prefill_decode:
+            decode_reqs = self._next_mixed_decode_reqs()
+        batch = self._next_chunked_prefill_batch(len(decode_reqs))
+        if not batch:
+            return False, 0
+        reqs = [req for req, _ in batch]
+        for req, chunk_size in batch:
+            req.state = ReqState.PREFILLING
+            req.stats.on_scheduled()
+            self._account_kv_pages(req, reserved=n_pages(chunk_size, self.kvcache.page_size))
+
+        logger.debug(
+            f"{[req.request_id for req in reqs]} prefilling on Rnr#0"
+            + (f" with {len(decode_reqs)} decode reqs" if decode_reqs else "")
+        )
+        logits, step_time = await make_async(self._timed)(
+            self.runners[0].prefill_chunks, reqs, [chunk_size for _, chunk_size in batch], decode_reqs
+        )
+        self.metrics.step_time.labels("prefill").observe(step_time)
+        self.metrics.prefill_tokens.inc(sum(chunk_size for _, chunk_size in batch))
+        # decode rows and the rows of finished prompts are sampled together
+        prefill_done = [req.on_prefill_1chunk_done() for req in reqs]
+        rows = list(range(len(decode_reqs))) + [
+            len(decode_reqs) + i for i, done in enumerate(prefill_done) if done
+        ]
+        sample_reqs = decode_reqs + [req for req, done in zip(reqs, prefill_done) if done]
+        samples = []
+        if sample_reqs:
+            samples = self._logits_to_tokens(logits[rows], sample_reqs, "runner0")
+            self.metrics.generation_tokens.inc(len(sample_reqs))
+
+        # decode rows first; requests cancelled during the pass are skipped
+        for i, (req, (next_token, txt, stop)) in enumerate(zip(sample_reqs, samples)):
+            if i < len(decode_reqs):
+                if req.state is not ReqState.DECODING:
+                    continue
+                req.on_decode1_done(next_token, txt, stop)
+                if stop:
+                    req.on_decode_done(stop)
+            elif req.state is ReqState.PREFILLING:
+                req.on_prefill_done(next_token, txt, stop)
+        for req in decode_reqs + reqs:
+            self._account_kv_pages(req)
+        return True, len(decode_reqs)
 
     # def _next_decode_req(self):
     #     for req in self.requests:
@@ -385,138 +613,270 @@ class Engine(Singleton):
     #             return req
 
     def _continuous_batching(self, nbatch: int):
-        decode_reqs: List[Request] = []
-        for req in self.requests:
-            if req.state is ReqState.DECODING:
-                decode_reqs.append(req)
-
+        decode_reqs = self.requests.in_state(ReqState.DECODING, limit=self.Bs[-1] * nbatch)
         if not decode_reqs:
             return None
 
-        if len(decode_reqs) > self.Bs[-1] * nbatch:
-            decode_reqs = decode_reqs[:self.Bs[-1] * nbatch]
-
-        free_pages = max(self.kvcache.max_num_pages - self.busy_kvcache_pages, 1) # keep at least one decode request
+        free_pages = max(self.kv_accounting.free_pages, 1) # keep at least one decode request
         if len(decode_reqs) > free_pages:
             for req in decode_reqs[free_pages:]:
-                req.stream.put(("\n\nServer is busy (KV cache full), please retry later.", "stop"))
-                req.cancel()
+                self._preempt(req)
             decode_reqs = decode_reqs[:free_pages]
         
-        nreqs = len(decode_reqs)
-        # logger.debug(f"{nreqs=}")
-
         batches: List[DecodeBatch | None] = []
-        for ibatch in range(nbatch):
-            l, r = (ibatch * nreqs) // nbatch, ((ibatch + 1) * nreqs) // nbatch
-            batch_reqs = decode_reqs[l:r]
-            
+        for batch_reqs in partition_decode_reqs(decode_reqs, nbatch, self.decode_cost_model):
             if not batch_reqs:
                 batches.append(None)
                 continue
 
-            for B in self.Bs:
-                if B >= len(batch_reqs):
-                    break
-
+            B = self.decode_cost_model.bucket(len(batch_reqs))
             # logger.debug(f"generate Batch: {B=}")
             batches.append(DecodeBatch(B, batch_reqs))
 
         return batches
 
-    async def _handle_decode_substep(self):
-        decode_res: List[Tuple[DecodeBatch, Awaitable]] = []
+    @staticmethod
+    def _timed(fn, *args):
+        t0 = time.perf_counter()
+        ret = fn(*args)
+        return ret, time.perf_counter() - t0
+
+    def _prepare_next_decode(self, reqs: List[Request]):
+        """
+        plan the step after the one in flight for `reqs`, with their next
+        tokens still to be sampled; requests about to finish are left out
+        """
+        reqs = [
+            req for req in reqs
+            if req.all_length + 1 < req.generation_config.max_length
+            and req.generated_length + 1 < req.generation_config.max_new_tokens
+        ]
+        # the step would need preemption, let the next substep plan it
+        if not reqs or len(reqs) > self.kv_accounting.free_pages:
+            return
 
-        batches = self._continuous_batching(N_RUNNERS)
-        if batches is None:
-            return 0
-        
+        batches: List[DecodeBatch | None] = []
+        for runner, batch_reqs in zip(
+            self.runners, partition_decode_reqs(reqs, N_RUNNERS, self.decode_cost_model)
+        ):
+            if not batch_reqs:
+                batches.append(None)
+                continue
+            batch = DecodeBatch(self.decode_cost_model.bucket(len(batch_reqs)), batch_reqs, lookahead=1)
+            runner.plan_decode1(batch)
+            batches.append(batch)
+        self.prepared = (batches, {req.request_id: req.all_length for req in reqs})
+
+    def _commit_prepared_decode(self):
+        """
+        returns the batches planned ahead by `_prepare_next_decode` if they
+        still are what `_continuous_batching` would schedule, otherwise None
+        """
+        if self.prepared is None:
+            return None
+        batches, spec_lengths = self.prepared
+        self.prepared = None
+
+        decode_reqs = self.requests.in_state(ReqState.DECODING, limit=self.Bs[-1] * N_RUNNERS)
+        valid = (
+            len(decode_reqs) == len(spec_lengths)
+            and len(decode_reqs) <= self.kv_accounting.free_pages
+            and all(spec_lengths.get(req.request_id) == req.all_length - 1 for req in decode_reqs)
+        )
         for runner, batch in zip(self.runners, batches):
             if batch is None:
                 continue
-            batch.set_runner_id_for_requests(runner.runner_id)
+            if valid:
+                batch.set_runner_id_for_requests(runner.runner_id)
+                runner.commit_decode1(batch)
+                continue
+            # replanned from scratch, only the placeholder hashes need fixing
+            reqs = [
+                req for req in batch.reqs
+                if req.state is ReqState.DECODING
+                and spec_lengths[req.request_id] == req.all_length - 1
+            ]
+            if reqs:
+                self.kvcache.rehash_last_page(
+                    [req.matches[0] for req in reqs],
+                    [req.all_ids[0, : req.all_length] for req in reqs],
+                )
+        return batches if valid else None
 
-            runner.plan_decode1(batch)
+    async def _handle_decode_substep(self, lookahead: bool = False):
+        """
+        lookahead: plan the next substep while this one runs on the gpu
+        """
+        with self.recorder.span("decode_substep", "scheduler") as args:
+            n_decoded = await self._decode_substep(lookahead, args)
+        return n_decoded
+
+    async def _decode_substep(self, lookahead: bool, span_args: Dict):
+        decode_res: List[Tuple[DecodeBatch, Awaitable]] = []
+
+        batches = self._commit_prepared_decode()
+        span_args["planned_ahead"] = batches is not None
+        if batches is None:
+            batches = self._continuous_batching(N_RUNNERS)
+            if batches is None:
+                return 0
+
+            for runner, batch in zip(self.runners, batches):
+                if batch is None:
+                    continue
+                batch.set_runner_id_for_requests(runner.runner_id)
 
-        torch.cuda.synchronize()
+                runner.plan_decode1(batch)
 
         for runner, batch in zip(self.runners, batches):
             if batch is None:
                 continue
-            b_res = make_async(runner.decode1)(batch)
+            b_res = make_async(self._timed)(runner.decode1, batch)
             decode_res.append((batch, b_res))
 
         if not decode_res:
             return 0
+        span_args["batches"] = [
+            dict(runner=batch.decode_runner_id, B=batch.B, reqs=[req.request_id for req in batch.reqs])
+            for batch, _ in decode_res
+        ]
 
-        io_res: List[Tuple[Request, Awaitable]] = []
+        if lookahead:
+            self._prepare_next_decode([req for batch, _ in decode_res for req in batch.reqs])
+        self._reclaim_kv_pages()
+
+        io_res: List[Tuple[DecodeBatch, Awaitable]] = []
         for batch, b_res in decode_res:
-            batch_logits = await b_res
-            for i, req in enumerate(batch.reqs):
-                res = make_async(self.io.logits_to_token)(
-                    batch_logits[i : i + 1], req.logits_processor, req.token_cache
-                )
-                io_res.append((req, res))
+            batch_logits, step_time = await b_res
+            self._on_decode_step_timed(batch, step_time)
+            io_res.append((
+                batch,
+                make_async(self._logits_to_tokens)(batch_logits, batch.reqs, f"runner{batch.decode_runner_id}"),
+            ))
+
+        n_decoded = 0
+        for batch, res in io_res:
+            for req, (next_token, txt, stop) in zip(batch.reqs, await res):
+                if req.state is not ReqState.DECODING:
+                    # cancelled during the step
+                    continue
+                req.on_decode1_done(next_token, txt, stop)
+                if stop:
+                    req.on_decode_done(stop)
+                self._account_kv_pages(req)
+            n_decoded += len(batch.reqs)
+        self.metrics.generation_tokens.inc(n_decoded)
+
+        return n_decoded
+
+    def _logits_to_tokens(self, logits: torch.Tensor, reqs: List[Request], track: str = "scheduler"):
+        """sample one token for each of `reqs` from the matching row of `logits`"""
+        with self.recorder.span("sample", track, n_reqs=len(reqs)):
+            return self.io.logits_to_tokens(
+                logits[: len(reqs)],
+                [req.sampling_params for req in reqs],
+                [req.detokenizer for req in reqs],
+                [req.stop_matcher for req in reqs],
+            )
 
-        for req, res in io_res:
-            next_token, txt, stop = await res
-            req.on_decode1_done(next_token, txt, stop)
-            if stop:
-                req.on_decode_done(stop)
-        
-        return len(io_res)
+    def _flush_streams(self, force: bool = False):
+        with self.recorder.span("stream_delivery", "scheduler") as args:
+            n_loop_hops = self.stream_delivery.n_loop_hops
+            self.stream_delivery.flush(force)
+            args["loop_hops"] = self.stream_delivery.n_loop_hops - n_loop_hops
+
+    def _on_decode_step_timed(self, batch: DecodeBatch, step_time: float):
+        n_reqs = len(batch.reqs)
+        kv_len = sum(req.all_length for req in batch.reqs)
+        predicted = self.decode_cost_model.predict(n_reqs, kv_len)
+        self.decode_cost_model.update(n_reqs, kv_len, step_time)
+        self.metrics.step_time.labels("decode").observe(step_time)
+        self.metrics.batch_size.labels(batch.decode_runner_id).observe(n_reqs)
+        self.decode_step_stats[batch.decode_runner_id] = dict(
+            batch_size=n_reqs,
+            kv_tokens=kv_len,
+            predicted_ms=predicted * 1000,
+            actual_ms=step_time * 1000,
+        )
 
     async def run_engine_loop(self):
         logger.info("enter engine loop")
+        progress = True
         while True:
-            if not self.requests:
-                await asyncio.sleep(0)
-                continue
-
-            # if all([req.state == ReqState.LPREFILLING for req in self.requests]):
-            #     await asyncio.sleep(0)
+            if not progress:
+                # nothing is runnable (no requests, or all of them wait on the
+                # layerwise prefill / free kvcache): park until submit, cancel
+                # or lprefill completion wakes us up
+                self._flush_streams(force=True)
+                self._reclaim_kv_pages()
+                await make_async(self._wait_for_wakeup)()
+            progress = False
 
             # logger.debug("[1/3] handle finished reqs")
-            self._handle_finished_reqs()
+            progress |= self._handle_finished_reqs() > 0
+            if not self.requests:
+                continue
 
-            self._summarize_kvcache_usage()
+            self._resume_preempted_reqs()
 
             if self.enable_layerwise_prefill:
                 # logger.debug("[LP] schedule")
                 self._schedule_layerwise_prefill()
                 # logger.debug("[LP] exec")
-                await self._handle_layerwise_prefill()
+                progress |= await self._handle_layerwise_prefill()
                 # logger.debug("[LP] done")
 
             # logger.debug("[2/3] chunked prefill")
-            await self._handle_chunked_prefill()
+            prefilled, n_mixed_decoded = await self._handle_chunked_prefill()
+            progress |= prefilled
+            self._flush_streams()
             # logger.debug("[3/3] decode substeps")
             perf_n_tokens_decoded = 0
             perf_time_start = time.perf_counter()
-            for _ in range(16):
-                perf_n_tokens_decoded += await self._handle_decode_substep()
+            # in mixed mode the prefill pass already was the first substep
+            n_substeps = 16 - (n_mixed_decoded > 0)
+            for i in range(n_substeps):
+                # nothing is planned ahead across loop iterations
+                perf_n_tokens_decoded += await self._handle_decode_substep(
+                    lookahead=i < n_substeps - 1
+                )
+                self._flush_streams()
+            progress |= perf_n_tokens_decoded > 0
 
             perf_time_end = time.perf_counter()
             perf_throughput = perf_n_tokens_decoded / (perf_time_end - perf_time_start)
             self.decode_throughput = perf_throughput
+            self.profiler.on_step()
             # logger.info(f"decoded {perf_n_tokens_decoded} tokens @ {perf_throughput:.3} token/s")
             # logger.debug(f"[DONE STEP]")
 
+    def start_profile(
+        self,
+        kinds: Optional[List[str]] = None,
+        duration: Optional[float] = None,
+        steps: Optional[int] = None,
+    ) -> Dict:
+        """
+        start a profiling session of the running engine, at most one at a time
+        kinds: "torch" (torch.profiler, cpu + cuda), "cpuinfer" (perfetto
+        trace of the cpu experts), "python" (stack samples of the engine thread)
+        duration / steps: stop after as many seconds / engine loop iterations
+        """
+        return self.profiler.start(kinds or ["torch", "cpuinfer"], duration, steps)
+
+    def stop_profile(self) -> Dict:
+        """stop the running session, returns where its files were written"""
+        return self.profiler.stop()
+
+    def profile_status(self) -> Dict:
+        """the running session, or the last one"""
+        return self.profiler.status()
+
     def start_trace(self):
-        if self.trace_started:
-            return
-        self.trace_started = True
-        self.prof = profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA])
-        self.prof.start()
-        KExpertsCPU.CPU_INFER.cpuinfer.start_trace("cpu.pftrace")
+        self.start_profile(["torch", "cpuinfer"])
 
     def stop_trace(self):
-        if not self.trace_started:
-            return
-        self.prof.stop()
-        self.prof.export_chrome_trace("gpu.json")
-        KExpertsCPU.CPU_INFER.cpuinfer.end_trace()
-        exit(0)
+        self.stop_profile()
 
     def submit(
         self,
@@ -524,9 +884,34 @@ class Engine(Singleton):
         input_message,
         generation_config: Optional[Dict] = None,
         tools: Optional[List] = None,
+        stream_options: Optional[Dict] = None,
     ):
+        """
+        stream_options: `AsyncStream` flush thresholds, min_flush_interval
+        (seconds) / min_flush_bytes, to send fewer and larger SSE chunks
+        """
         input_ids = self.io.format_and_tokenize_input_ids(input_message, tools)
+        return self._submit_input_ids(request_id, input_ids, generation_config, stream_options)
 
+    async def submit_async(
+        self,
+        request_id,
+        input_message,
+        generation_config: Optional[Dict] = None,
+        tools: Optional[List] = None,
+        stream_options: Optional[Dict] = None,
+    ):
+        """`submit` with the prompt rendered and tokenized off the calling thread"""
+        input_ids = await self.io.format_and_tokenize_input_ids_async(input_message, tools)
+        return self._submit_input_ids(request_id, input_ids, generation_config, stream_options)
+
+    def _submit_input_ids(
+        self,
+        request_id,
+        input_ids: torch.Tensor,
+        generation_config: Optional[Dict] = None,
+        stream_options: Optional[Dict] = None,
+    ):
         if not generation_config:
             generation_config = dict(
                 max_new_tokens=Config().max_new_tokens,
@@ -547,18 +932,30 @@ class Engine(Singleton):
 
         request = Request(
             request_id,
-            AsyncStream(request_id=request_id, cancel=self.cancel),
+            AsyncStream(
+                request_id=request_id,
+                cancel=self.cancel,
+                delivery=self.stream_delivery,
+                **(stream_options or {}),
+            ),
             input_ids,
             logits_processor=processor,
             generation_config=GenerationConfig(do_sample=True, **generation_config),
+            sampling_params=SamplingParams.from_config(generation_config),
         )
 
-        request.matches = self.kvcache.match(request.all_ids)
+        request.detokenizer = self.io.new_detokenizer(input_ids)
+        request.stop_matcher = StopMatcher.from_config(generation_config)
+        request.matches = self.kvcache.match(
+            request.all_ids[:, : request.all_length], [request.page_hashes]
+        )
         hit_length = request.matches[0].len * self.kvcache.page_size
 
         request.usage.prompt_tokens = request.all_length
         request.usage.total_tokens = request.all_length
         request.usage.cache_hit_tokens = hit_length
+        self.metrics.prompt_tokens.inc(request.all_length)
+        self.metrics.prefix_cache_hit_tokens.inc(hit_length)
 
         logger.info(
             (
@@ -568,18 +965,35 @@ class Engine(Singleton):
             )
         )
 
-        self.requests.append(request)
+        self.requests.add(request)
+        self._wakeup_engine()
         return request
 
     def cancel(self, request_id: str):
-        for req in self.requests:
-            if req.request_id == request_id:
-                logger.warning(f"Cancelling Req<{request_id}>")
-                req.cancel()
-                return True
+        req = self.requests.get(request_id)
+        if req is not None:
+            logger.warning(f"Cancelling Req<{request_id}>")
+            req.cancel()
+            self.metrics.cancellations.inc()
+            self._wakeup_engine()
+            return True
         logger.warning(f"Cancelling failed: Req<{request_id}> not found")
         return False
     
+    def get_step_trace(self, profile_id: Optional[str] = None) -> str:
+        """
+        the recent engine steps as Chrome trace json, the engine keeps running;
+        profile_id: a stopped "cpuinfer" profile session whose trace to merge in
+        """
+        cpu_trace = self.profiler.cpu_trace(profile_id) if profile_id else None
+        return json.dumps(self.recorder.to_chrome_trace(cpu_trace))
+
+    def get_metrics(self) -> str:
+        """engine metrics in the Prometheus text format"""
+        if self.state in [EngineState.BOOTING, EngineState.INIT, EngineState.ERROR]:
+            return ""
+        return self.metrics.render()
+
     def get_status(self):
         if self.state in [EngineState.BOOTING, EngineState.INIT, EngineState.ERROR]:
             status = {
@@ -589,9 +1003,10 @@ class Engine(Singleton):
         else:
             requests_status = []
             counters = {
-                "pending": 0,
-                "prefilling": 0,
-                "decoding": 0,
+                "pending": self.requests.count(ReqState.PENDING),
+                "prefilling": self.requests.count(ReqState.PREFILLING, ReqState.LPREFILLING),
+                "decoding": self.requests.count(ReqState.DECODING),
+                "preempted": self.requests.count(ReqState.PREEMPTED),
             }
 
             for req in self.requests:
@@ -600,17 +1015,27 @@ class Engine(Singleton):
                     **req.stats.summarize(),
                     **req.usage.model_dump(),
                 })
-                if req.state is ReqState.PENDING:
-                    counters["pending"] += 1
-                elif req.state in [ReqState.PREFILLING, ReqState.LPREFILLING]:
-                    counters["prefilling"] += 1
-                elif req.state is ReqState.DECODING:
-                    counters["decoding"] += 1
 
             status = {
                 "engine_state": self.state,
                 "request_counters": counters,
                 "decode_throughput": self.decode_throughput,
+                "kvcache": {
+                    **self.kv_accounting.summarize(),
+                    "free_watermark": self.kv_free_watermark,
+                    "evicted_pages": self.kvcache.prefix_tree.n_evicted_pages,
+                    "allocator": self.kvcache.page_table.allocator.summarize(),
+                },
+                "decode_runners": self.decode_step_stats,
+                "preemption": {
+                    "mode": Config().preemption_mode,
+                    "preemptions": self.n_preemptions,
+                    **(self.host_kv_pool.summarize() if self.host_kv_pool else {}),
+                },
+                "chat_template_cache": self.io.summarize_prefix_cache(),
+                "latency": self.latency_stats.summarize(),
+                "step_recorder": self.recorder.summarize(),
+                "profile": self.profiler.status(),
                 "config": Config().__dict__,
                 "requests": requests_status
             }
@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 from flashinfer.logits_processor import (
@@ -13,7 +13,13 @@ from flashinfer.logits_processor import (
 from transformers import AutoTokenizer, PretrainedConfig
 
 from heyi.config import Config
+from heyi.utils.chat_template_cache import ChatTemplatePrefixCache
+from heyi.utils.detokenizer import IncrementalDetokenizer
 from heyi.utils.log import logger
+from heyi.utils.sampling import SamplingParams, sample_batch, stack_sampling_params
+from heyi.utils.stop_matcher import StopMatcher
+from heyi.utils.tokenizer_pool import TokenizerPool
+from heyi.utils.utils import make_async
 
 
 class IOInterface:
@@ -29,12 +35,37 @@ class IOInterface:
         else:
             self.eos_token_id = self.tokenizer.eos_token_id
 
+        # system / tools prompt prefixes; verify checks every hit, not only new prefixes
+        self.prefix_cache: Optional[ChatTemplatePrefixCache] = None
+        if Config().chat_template_cache_size > 0:
+            self.prefix_cache = ChatTemplatePrefixCache(
+                self.tokenizer,
+                Config().chat_template_cache_size,
+                verify=Config().chat_template_cache_verify,
+            )
+
+        # tokenizes for submit_async off the caller, without workers the caller does
+        self.tokenizer_pool: Optional[TokenizerPool] = None
+        if Config().tokenizer_workers > 0:
+            logger.info(f"init tokenizer pool: {Config().tokenizer_workers} workers")
+            self.tokenizer_pool = TokenizerPool(
+                config.name_or_path,
+                Config().tokenizer_workers,
+                trust_remote_code=Config().trust_remote_code,
+                cache_size=Config().chat_template_cache_size,
+                cache_verify=Config().chat_template_cache_verify,
+            )
+
         # warmup: JIT
         pipe = LogitsPipe(
             [Temperature(), TopK(), Softmax(), TopP(), Sample()],
             input_type=TensorType.LOGITS,
         )
         pipe(torch.randn(1, 128), temperature=0.6, top_k=20, top_p=1.0)
+        self.sample(
+            torch.randn(2, 128),
+            [SamplingParams(temperature=0.6, top_k=20), SamplingParams(temperature=0)],
+        )
 
     def tokenize_prompt(self, prompt: str):
         input_ids = self.tokenizer.encode(prompt, return_tensors="pt").cpu()
@@ -43,6 +74,13 @@ class IOInterface:
     def format_and_tokenize_input_ids(
         self, messages: List, tools: List | None
     ):
+        if self.prefix_cache is not None:
+            input_ids, _ = self.prefix_cache.format_and_tokenize(
+                messages, tools, thinking=Config().thinking
+            )
+            logger.debug(f"get input ids of shape {input_ids.shape}")
+            return input_ids
+
         input_ids = self.tokenizer.apply_chat_template(
             messages,
             tools=tools,
@@ -55,27 +93,85 @@ class IOInterface:
         logger.debug(f"get input ids of shape {input_ids.shape}")
         return input_ids
 
+    async def format_and_tokenize_input_ids_async(
+        self, messages: List, tools: List | None
+    ) -> torch.Tensor:
+        """`format_and_tokenize_input_ids` on the tokenizer pool, or an executor thread without one"""
+        if self.tokenizer_pool is None:
+            return await make_async(self.format_and_tokenize_input_ids)(messages, tools)
+        input_ids = await self.tokenizer_pool.format_and_tokenize(
+            messages, tools, thinking=Config().thinking
+        )
+        logger.debug(f"get input ids of shape {input_ids.shape}")
+        return input_ids
+
+    def new_detokenizer(self, input_ids: torch.Tensor) -> IncrementalDetokenizer:
+        """detokenizer of a request whose prompt is `input_ids` [1, L]"""
+        return IncrementalDetokenizer(
+            self.tokenizer, input_ids[0].tolist(), skip_special_tokens=True
+        )
+
+    def summarize_prefix_cache(self):
+        """chat-template prefix cache hits of this process and the tokenizer pool"""
+        hits, misses = 0, 0
+        if self.prefix_cache is not None:
+            hits, misses = self.prefix_cache.hits, self.prefix_cache.misses
+        if self.tokenizer_pool is not None:
+            hits += self.tokenizer_pool.cache_hits
+            misses += self.tokenizer_pool.cache_misses
+        return {
+            "capacity": Config().chat_template_cache_size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
     def logits_to_token(
-        self, logits: torch.Tensor, processors: LogitsPipe, token_cache: List[int]
+        self,
+        logits: torch.Tensor,
+        processors: LogitsPipe,
+        detokenizer: IncrementalDetokenizer,
+        stop_matcher: Optional[StopMatcher] = None,
     ):
 
         sample = processors(logits)
 
         # self.ever_generated_ids.add(last)
-        return sample, *self.id_to_token(sample, token_cache)
+        return sample, *self.id_to_token(sample, detokenizer, stop_matcher)
+
+    def sample(self, logits: torch.Tensor, params: List[SamplingParams]) -> List[int]:
+        """sample every row of `logits` [B, vocab] in one go, one device to host copy"""
+        return sample_batch(
+            logits, *stack_sampling_params(params, logits.shape[-1], logits.device)
+        ).tolist()
+
+    def logits_to_tokens(
+        self,
+        logits: torch.Tensor,
+        params: List[SamplingParams],
+        detokenizers: List[IncrementalDetokenizer],
+        stop_matchers: List[Optional[StopMatcher]],
+    ) -> List[Tuple[int, str, str | None]]:
+        """batched `logits_to_token`, row i belongs to `params[i]` / `detokenizers[i]` / `stop_matchers[i]`"""
+        return [
+            (new_id, *self.id_to_token(new_id, detokenizer, stop_matcher))
+            for new_id, detokenizer, stop_matcher in zip(
+                self.sample(logits, params), detokenizers, stop_matchers
+            )
+        ]
 
     def id_to_token(
-        self, new_id: torch.Tensor, token_cache: List[int]
+        self,
+        new_id: torch.Tensor | int,
+        detokenizer: IncrementalDetokenizer,
+        stop_matcher: Optional[StopMatcher] = None,
     ) -> Tuple[str, str | None]:
-        new_id_: int = new_id.item()
+        new_id_: int = int(new_id)
         if new_id_ == self.eos_token_id:
-            ans = "", "stop"
-        else:
-            token_cache.append(new_id_)
-            text: str = self.tokenizer.decode(token_cache, skip_special_tokens=True)
-            if text.endswith("�"):
-                ans = "", None
-            else:
-                ans = text, None
-                token_cache.clear()
-        return ans
+            return "", "stop"
+        if stop_matcher is None:
+            return detokenizer.step(new_id_), None
+        if stop_matcher.is_stop_token(new_id_):
+            return "", "stop"
+        text, stopped = stop_matcher.feed(detokenizer.step(new_id_))
+        return text, "stop" if stopped else None
@@ -1,19 +1,33 @@
+import itertools
+import time
 from abc import abstractmethod
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import flashinfer
 import torch
 from torch.nn.attention import SDPBackend
 from transformers.modeling_utils import PreTrainedModel
 
+from heyi.config import Config
 from heyi.utils.kvcache.kvcache import PagedMLACache
 from heyi.utils.log import logger
 from heyi.utils.request import DecodeBatch, Request
+from heyi.utils.step_recorder import StepRecorder
 
 from .base_runner import BaseRunner
 
 
+N_SLOTS = 2
+
+
 class DecodeRunner(BaseRunner):
+    '''
+    Decode steps are double buffered: each of the `N_SLOTS` slots owns a
+    kvcache fork (page_indices / page_indptr / last_page_len), input and
+    output buffers, attention wrappers and cuda graphs, so step N+1 can be
+    planned into one slot while step N still runs from the other.
+    '''
+
     def __init__(
         self,
         runner_id: int,
@@ -24,29 +38,68 @@ class DecodeRunner(BaseRunner):
     ):
         super().__init__(runner_id, model, kvcache)
         self.stream = torch.cuda.Stream()
-        self.cuda_graph: Dict[int, torch.cuda.CUDAGraph] = {}
+        # graphs of all slots and batch sizes replay one after another on
+        # `self.stream`, so they can share one memory pool
+        self.graph_pool = torch.cuda.graph_pool_handle()
 
         self.Bs = Bs
         self.maxB = max(Bs)
-        self.input_buffer = {
-            B: {
-                "input_ids": torch.zeros((B, 1), dtype=torch.long).cuda(),
-                "past_key_values": self.kvcache,
-                "cache_position": torch.zeros((B), dtype=torch.int, device=0),
-            }
-            for B in self.Bs
-        }
-        self.output_buffer = {
-            "logits": torch.empty((self.maxB, model.config.vocab_size), dtype=torch.float32, device=0)
+        self.recorder = StepRecorder()
+        # planning overlaps the step in flight, so it gets a track of its own
+        self.track = f"runner{runner_id}"
+        self.plan_track = f"runner{runner_id} plan"
+        self.float_workspace_buffer = torch.empty(128*1024*1024, dtype=torch.uint8, device=0)
+        self.use_cuda_graph = use_cuda_graph
+
+        # ragged prefill inputs: ids then positions, gathered on the host
+        # and sent to the device in one copy
+        self.prefill_staging = torch.empty(
+            2 * (Config().prefill_batch_num_tokens + Config().max_batch_size),
+            dtype=torch.long, device="cpu", pin_memory=True,
+        )
+        self.prefill_staging_copied = torch.cuda.Event()
+
+        self.slots: List[Dict[str, Any]] = [
+            self._new_slot(kvcache if i == 0 else kvcache.fork())
+            for i in range(N_SLOTS)
+        ]
+        self._use_slot(0)
+
+    def _new_slot(self, kvcache: PagedMLACache) -> Dict[str, Any]:
+        # decode inputs of every batch size are views of one [2, maxB] tensor
+        # (input ids, cache positions) filled by a single copy from the host
+        input_host = torch.zeros((2, self.maxB), dtype=torch.long, device="cpu", pin_memory=True)
+        input_device = torch.zeros((2, self.maxB), dtype=torch.long, device=0)
+        return {
+            "kvcache": kvcache,
+            "cuda_graph": {},
+            "input_host": input_host,
+            "input_device": input_device,
+            "input_copied": torch.cuda.Event(),
+            "input_buffer": {
+                B: {
+                    "input_ids": input_device[0, :B].view(B, 1),
+                    "past_key_values": kvcache,
+                    "cache_position": input_device[1, :B],
+                }
+                for B in self.Bs
+            },
+            "output_buffer": {
+                "logits": torch.empty((self.maxB, self.model.config.vocab_size), dtype=torch.float32, device=0)
+            },
+            "wrapper": None,
         }
 
-        self.float_workspace_buffer = torch.empty(128*1024*1024, dtype=torch.uint8, device=0)
-        self.wrapper: Union[
-            flashinfer.BatchDecodeMlaWithPagedKVCacheWrapper,
-            flashinfer.BatchPrefillWithPagedKVCacheWrapper
-        ] = None # type: ignore
+    def _use_slot(self, slot: int):
+        '''point kvcache, buffers, wrappers and graphs at `slot`'''
+        self.slot = slot
+        for name, value in self.slots[slot].items():
+            setattr(self, name, value)
 
-        self.use_cuda_graph = use_cuda_graph
+    @property
+    def next_slot(self) -> int:
+        '''the slot not used by the last planned step'''
+        return (self.slot + 1) % N_SLOTS
     
     @abstractmethod
     def wrapper_plan_decode1(self, B: int):
@@ -57,12 +110,15 @@ class DecodeRunner(BaseRunner):
         raise NotImplementedError
 
     def warmup_and_capture_graph(self):
-        for B in self.Bs:
-            self._warmup_and_capture_graph(B)
+        for slot in range(N_SLOTS):
+            self._use_slot(slot)
+            for B in self.Bs:
+                self._warmup_and_capture_graph(B)
+        self._use_slot(0)
 
     @torch.no_grad()
     def _warmup_and_capture_graph(self, B: int):
-        logger.info(f"Rnr#{self.runner_id}: warmup {B=}...")
+        logger.info(f"Rnr#{self.runner_id}: warmup slot {self.slot} {B=}...")
         self.stream.wait_stream(torch.cuda.current_stream())
         with torch.cuda.stream(self.stream): # type: ignore
             for _ in range(3):
@@ -84,13 +140,13 @@ class DecodeRunner(BaseRunner):
             return
 
         self.cuda_graph[B] = torch.cuda.CUDAGraph()
-        logger.info(f"Rnr#{self.runner_id}: capturing {B=}...")
+        logger.info(f"Rnr#{self.runner_id}: capturing slot {self.slot} {B=}...")
         self.kvcache.plan(
             self.kvcache.match(self.input_buffer[B]["input_ids"]),
             self.input_buffer[B]["input_ids"],
         )
         self.wrapper_plan_decode1(B)
-        with torch.cuda.graph(cuda_graph=self.cuda_graph[B], stream=self.stream):
+        with torch.cuda.graph(cuda_graph=self.cuda_graph[B], pool=self.graph_pool, stream=self.stream):
             self.output_buffer["logits"][:B].copy_(self.model(
                 input_ids=self.input_buffer[B]["input_ids"],
                 past_key_values=self.input_buffer[B]["past_key_values"],
@@ -100,73 +156,179 @@ class DecodeRunner(BaseRunner):
             )[0].squeeze(dim=1))
         torch.cuda.synchronize("cuda")
 
-    @torch.no_grad
-    def prefill_chunk(self, req: Request):
-        '''Currently only support per request chunked prefill'''
-        if not req.matches:
-            req.matches = self.kvcache.match(req.all_ids[:, : req.all_length])
-        req.prefilled_length = req.matches[0].len * self.kvcache.page_size
-
-        # print()
-        # print("-" * 30, "PREFILL PLAN", "-" * 30)
-        # print()
-
-        # print(self.kvcache.prefix_tree)
-        # print(f"MATCH {req.all_ids[:, :req.all_length]}")
-        # print(f"MATCHED {matches[0]}, {req.prefilled_length=}")
-
-        input_ids, cache_position = req.next_chunk()
-        req.matches = self.kvcache.plan(
-            req.matches,
-            req.all_ids[:, : cache_position[-1].item() + 1],
+    def _forward_ragged(
+        self,
+        reqs: List[Request],
+        input_ids: torch.Tensor,
+        cache_position: torch.Tensor,
+        qo_lens: List[int],
+        kv_lens: List[int],
+    ):
+        '''
+        Runs the new tokens of several requests packed into one ragged
+        sequence, returns the logits of the last new token of every request
+        '''
+        # the attention plan reads the lengths on the host
+        qo_indptr_host = torch.tensor(
+            [0] + list(itertools.accumulate(qo_lens)), dtype=torch.int32, device="cpu"
+        )
+        qo_indptr = qo_indptr_host.to("cuda")
+        kv_len_arr = torch.tensor(kv_lens, dtype=torch.int32, device="cpu")
+
+        matches = self.kvcache.plan(
+            [req.matches[0] for req in reqs],
+            [req.all_ids[0, :kv_len] for req, kv_len in zip(reqs, kv_lens)],
             return_matches=True,
+            qo_indptr=qo_indptr,
         )
+        for req, match in zip(reqs, matches):
+            req.matches = [match]
+        t0 = time.perf_counter()
+        self.wrapper_plan_cprefill(qo_indptr_host, kv_len_arr)
+        self.recorder.record("wrapper_plan", self.track, t0, time.perf_counter())
 
-        # print(f"PLAN {req.all_ids[:, : cache_position[-1].item() + 1]}")
-        # print(self.kvcache.prefix_tree)
-        # print(self.kvcache)
+        hidden_states = self.model.model(
+            input_ids=input_ids,
+            cache_position=cache_position,
+            past_key_values=self.kvcache,
+            use_cache=True,
+            attn_wrapper=self.wrapper,
+        )[0]
+        # only the last token of each request goes through lm_head
+        logits = self.model.lm_head(hidden_states[0, qo_indptr[1:] - 1]).float()
+        return logits
 
-        # print()
-        # print("-" * 80)
-        # print()
+    @torch.no_grad
+    def prefill_chunks(
+        self,
+        reqs: List[Request],
+        chunk_sizes: List[int],
+        decode_reqs: Optional[List[Request]] = None,
+    ):
+        '''
+        Chunked prefill of several requests packed into one ragged sequence,
+        optionally carrying one decode token of each of `decode_reqs` in the
+        same forward pass. Returns the logits of the last token of every
+        request, decode requests first, [len(decode_reqs) + len(reqs), vocab]
+        '''
+        decode_reqs = decode_reqs or []
+        with self.recorder.span(
+            "prefill",
+            self.track,
+            chunks=[[req.request_id, chunk_size] for req, chunk_size in zip(reqs, chunk_sizes)],
+            n_decode=len(decode_reqs),
+        ):
+            return self._prefill_chunks(reqs, chunk_sizes, decode_reqs)
+
+    def _prefill_chunks(self, reqs: List[Request], chunk_sizes: List[int], decode_reqs: List[Request]):
+        b_input_ids, b_cache_position, qo_lens, kv_lens = [], [], [], []
+        for req in decode_reqs:
+            req.decode_runner_id = self.runner_id
+            b_input_ids.append(req.all_ids[0, req.all_length - 1 : req.all_length])
+            b_cache_position.append(torch.tensor([req.all_length - 1], device="cpu"))
+            qo_lens.append(1)
+            kv_lens.append(req.all_length)
+
+        for req, chunk_size in zip(reqs, chunk_sizes):
+            if not req.matches:
+                req.matches = self.kvcache.match(req.all_ids[:, : req.all_length], [req.page_hashes])
+            req.prefilled_length = req.matches[0].len * self.kvcache.page_size
 
-        # inputs_embeds = self.model.model.embed_tokens(input_ids)
-        bsz, q_len = input_ids.shape
-        qo_indptr = torch.tensor([0, q_len], dtype=torch.int32, device="cuda")
-        kv_len_arr = torch.tensor(
-            [cache_position[-1].item() + 1], dtype=torch.int32, device="cuda"
+            input_ids, cache_position = req.next_chunk(chunk_size)
+            b_input_ids.append(input_ids[0])
+            b_cache_position.append(cache_position)
+            qo_lens.append(input_ids.shape[1])
+            kv_lens.append(req.chunk_end)
+
+        input_ids, cache_position = self._stage_prefill_inputs(b_input_ids, b_cache_position)
+        return self._forward_ragged(
+            decode_reqs + reqs, input_ids, cache_position, qo_lens, kv_lens
         )
-        self.wrapper_plan_cprefill(qo_indptr, kv_len_arr)
-
-        with torch.no_grad():
-            logits = self.model(
-                input_ids=input_ids,
-                cache_position=cache_position,
-                past_key_values=self.kvcache,
-                return_dict=False,
-                use_cache=True,
-                attn_wrapper=self.wrapper,
-            )[0].squeeze(dim=1)
-        return logits
+
+    def _stage_prefill_inputs(
+        self, b_input_ids: List[torch.Tensor], b_cache_position: List[torch.Tensor]
+    ):
+        '''
+        host input ids and positions -> [1, n] ids and [n] positions on the
+        device, through the pinned staging buffer in one copy
+        '''
+        n = sum(ids.shape[0] for ids in b_input_ids)
+        # the previous copy out of the staging buffer must be done
+        self.prefill_staging_copied.synchronize()
+        if self.prefill_staging.shape[0] < 2 * n:
+            self.prefill_staging = torch.empty(
+                4 * n, dtype=torch.long, device="cpu", pin_memory=True
+            )
+        staging = self.prefill_staging[: 2 * n]
+        torch.cat(b_input_ids, out=staging[:n])
+        torch.cat(b_cache_position, out=staging[n:])
+        inputs = staging.to("cuda", non_blocking=True)
+        self.prefill_staging_copied.record()
+        return inputs[:n].view(1, n), inputs[n:]
+
+    def _stage_decode_inputs(self, slot: Dict[str, Any], batch: DecodeBatch):
+        '''batch input ids and positions -> the slot's decode input buffers, one copy'''
+        slot["input_copied"].synchronize()
+        batch.next_token(slot["input_host"])
+        slot["input_device"].copy_(slot["input_host"], non_blocking=True)
+        slot["input_copied"].record()
 
     @torch.no_grad
-    def plan_decode1(self, batch: DecodeBatch):
+    def plan_decode1(self, batch: DecodeBatch, slot: Optional[int] = None):
+        '''
+        plan `batch` into `slot`, by default the one not used by the last
+        planned step so it can be prepared while that step is running
+        '''
+        t0 = time.perf_counter()
+        self._use_slot(self.next_slot if slot is None else slot)
         B = batch.B
         batch.decode_runner_id = self.runner_id
+        batch.slot = self.slot
 
-        input_ids, cache_position = batch.next_token()
-        self.input_buffer[B]["input_ids"].copy_(input_ids)
-        self.input_buffer[B]["cache_position"].copy_(cache_position)
+        self._stage_decode_inputs(self.slots[self.slot], batch)
 
         assert batch.matches
         batch.matches = self.kvcache.plan(
             batch.matches, batch.all_ids, return_matches=True
         )
+        t1 = time.perf_counter()
         self.wrapper_plan_decode1(B)
+        self.slots[self.slot]["wrapper"] = self.wrapper
+        t2 = time.perf_counter()
+        self.recorder.record(
+            "plan", self.plan_track, t0, t1,
+            B=B, slot=self.slot, lookahead=batch.lookahead,
+            reqs=[req.request_id for req in batch.reqs],
+        )
+        self.recorder.record("wrapper_plan", self.plan_track, t1, t2, B=B)
+        # the step must see the buffers written above, no device-wide sync
+        self.stream.wait_stream(torch.cuda.current_stream())
+
+    @torch.no_grad
+    def commit_decode1(self, batch: DecodeBatch):
+        '''
+        fill the tokens sampled by the previous step into a batch planned
+        ahead with `lookahead`, its pages and positions are already in place
+        '''
+        assert batch.lookahead
+        t0 = time.perf_counter()
+        batch.lookahead = 0
+        slot = self.slots[batch.slot]
+        self._stage_decode_inputs(slot, batch)
+        # the page holding the new token was hashed with the placeholder
+        slot["kvcache"].rehash_last_page(batch.matches, batch.all_ids)
+        self.stream.wait_stream(torch.cuda.current_stream())
+        self.recorder.record("commit", self.plan_track, t0, time.perf_counter(), B=batch.B, slot=batch.slot)
 
     @torch.no_grad
     def decode1(self, batch: DecodeBatch):
+        with self.recorder.span("decode1", self.track, B=batch.B, n_reqs=len(batch.reqs), slot=batch.slot):
+            return self._decode1(batch)
+
+    def _decode1(self, batch: DecodeBatch):
         B = batch.B
+        slot = self.slots[batch.slot]
+        output_logits = slot["output_buffer"]["logits"]
 
         with torch.nn.attention.sdpa_kernel(
             backends=[
@@ -175,19 +337,19 @@ class DecodeRunner(BaseRunner):
                 SDPBackend.EFFICIENT_ATTENTION,
             ]
         ):
-            if self.use_cuda_graph:
-                with torch.cuda.stream(self.stream): # type: ignore
-                    self.cuda_graph[B].replay()
-                self.stream.synchronize()
-            else:
-                with torch.no_grad():
-                    self.output_buffer["logits"][:B].copy_(self.model(
-                        input_ids=self.input_buffer[B]["input_ids"],
-                        past_key_values=self.input_buffer[B]["past_key_values"],
-                        cache_position=self.input_buffer[B]["cache_position"],
+            with torch.cuda.stream(self.stream): # type: ignore
+                if self.use_cuda_graph:
+                    slot["cuda_graph"][B].replay()
+                else:
+                    input_buffer = slot["input_buffer"][B]
+                    output_logits[:B].copy_(self.model(
+                        input_ids=input_buffer["input_ids"],
+                        past_key_values=input_buffer["past_key_values"],
+                        cache_position=input_buffer["cache_position"],
                         use_cache=True,
-                        attn_wrapper=self.wrapper,
+                        attn_wrapper=slot["wrapper"],
                     )[0].squeeze(dim=1))
+            self.stream.synchronize()
 
-            logits = self.output_buffer["logits"][:B]
+            logits = output_logits[:B]
             return logits
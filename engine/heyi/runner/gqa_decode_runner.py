@@ -9,17 +9,21 @@ class GQADecodeRunner(DecodeRunner):
         self.float_workspace_buffer = torch.empty(
             384 * 1024 * 1024, dtype=torch.uint8, device=0
         )
-        self.decode_wrappers = {
-            B: flashinfer.BatchPrefillWithPagedKVCacheWrapper(
-                self.float_workspace_buffer,
-                use_cuda_graph=True,
-                qo_indptr_buf=self.kvcache.buffers["qo_indptr"][:B + 1],
-                paged_kv_indptr_buf=self.kvcache.buffers["page_indptr"][:B + 1],
-                paged_kv_indices_buf=self.kvcache.buffers["page_indices"],
-                paged_kv_last_page_len_buf=self.kvcache.buffers["last_page_len"][:B],
-            )
-            for B in self.Bs
-        }
+        # the graph-mode wrappers are bound to the buffers of their slot's kvcache
+        for slot in self.slots:
+            kvcache = slot["kvcache"]
+            slot["decode_wrappers"] = {
+                B: flashinfer.BatchPrefillWithPagedKVCacheWrapper(
+                    self.float_workspace_buffer,
+                    use_cuda_graph=True,
+                    qo_indptr_buf=kvcache.buffers["qo_indptr"][:B + 1],
+                    paged_kv_indptr_buf=kvcache.buffers["page_indptr"][:B + 1],
+                    paged_kv_indices_buf=kvcache.buffers["page_indices"],
+                    paged_kv_last_page_len_buf=kvcache.buffers["last_page_len"][:B],
+                )
+                for B in self.Bs
+            }
+        self._use_slot(0)
         self.prefill_wrapper: flashinfer.BatchPrefillWithPagedKVCacheWrapper = (
             flashinfer.BatchPrefillWithPagedKVCacheWrapper(
                 self.float_workspace_buffer,
@@ -30,7 +34,7 @@ class GQADecodeRunner(DecodeRunner):
             self.warmup_and_capture_graph()
 
     def wrapper_plan_decode1(self, B: int):
-        qo_indptr = torch.arange(0, B + 1, dtype=torch.int32, device="cuda")
+        qo_indptr = torch.arange(0, B + 1, dtype=torch.int32, device="cpu")
         page_indptr = self.kvcache.buffers["page_indptr"][:B + 1]
         page_indices = self.kvcache.buffers["page_indices"][:page_indptr[-1]]
         last_page_len = self.kvcache.buffers["last_page_len"][:B]
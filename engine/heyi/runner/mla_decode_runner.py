@@ -6,18 +6,22 @@ from .decode_runner import DecodeRunner
 class MLADecodeRunner(DecodeRunner):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.wrapper = flashinfer.mla.BatchMLAPagedAttentionWrapper(
-            self.float_workspace_buffer, use_cuda_graph=False
-        )
+        # slots never run at the same time, only the plan info is per slot
+        for slot in self.slots:
+            slot["wrapper"] = flashinfer.mla.BatchMLAPagedAttentionWrapper(
+                self.float_workspace_buffer, use_cuda_graph=False
+            )
+        self._use_slot(0)
         with torch.no_grad():
             self.warmup_and_capture_graph()
 
     def wrapper_plan_decode1(self, B: int):
+        # lengths from the host staging buffer, the plan needs them on the host
         self.wrapper.plan(
-            torch.arange(0, B + 1, dtype=torch.int32, device="cuda"),
+            torch.arange(0, B + 1, dtype=torch.int32, device="cpu"),
             self.kvcache.buffers["page_indptr"],
             self.kvcache.buffers["page_indices"],
-            self.input_buffer[B]["cache_position"].to(torch.int32) + 1,
+            self.input_host[1, :B].to(torch.int32) + 1,
             num_heads=self.model.config.num_attention_heads,
             head_dim_ckv=self.model.config.kv_lora_rank,
             head_dim_kpe=self.model.config.qk_rope_head_dim,
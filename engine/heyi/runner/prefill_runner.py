@@ -37,8 +37,8 @@ class PrefillRunner(BaseRunner):
 
     @torch.no_grad
     def prefill(self, req: Request):
-        matches = self.kvcache.match(req.all_ids[:, : req.all_length])
-        req.prefilled_length = matches[0].len * self.kvcache.page_size
+        req.matches = self.kvcache.match(req.all_ids[:, : req.all_length], [req.page_hashes])
+        req.prefilled_length = req.matches[0].len * self.kvcache.page_size
 
         # print()
         # print("-" * 30, "PREFILL PLAN", "-" * 30)
@@ -51,14 +51,14 @@ class PrefillRunner(BaseRunner):
         input_ids, cache_position = req.next_full_prefill()
         print(f"do prefill: {input_ids.shape=}, {cache_position.shape}")
         req.matches = self.kvcache.plan(
-            matches,
+            req.matches,
             req.all_ids[:, : cache_position[-1].item() + 1],
             return_matches=True,
         )
 
         bsz, q_len = input_ids.shape
         qo_indptr = torch.tensor([0, q_len], dtype=torch.int32, device=self.device)
-        kv_indptr = torch.tensor([0, req.prompt_length], dtype=torch.int32, device=self.device)
+        kv_indptr = torch.tensor([0, req.prefill_length], dtype=torch.int32, device=self.device)
 
         print("LP: plan")
         self._wrapper_plan(qo_indptr, kv_indptr)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from heyi.utils.log import logger
+
+
+PrefixEntry = NamedTuple("PrefixEntry", [("text", str), ("input_ids", torch.Tensor)])
+
+
+class ChatTemplatePrefixCache:
+    """
+    LRU cache of the rendered and tokenized chat-template prefix made of the
+    leading system messages, the tools and the template kwargs (e.g.
+    `thinking`), which clients re-send unchanged with every turn.
+
+    The whole conversation is still rendered, but only the text after the
+    cached prefix is tokenized. This is exact when the prefix ends on a token
+    boundary, as chat templates do (the system turn ends in a special token).
+    A new prefix is checked against a full tokenization of the prompt it came
+    with, and is never served from the cache if it does not split cleanly;
+    with `verify` every hit is checked as well.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, capacity: int, verify: bool = False):
+        self.tokenizer = tokenizer
+        self.capacity = capacity
+        self.verify = verify
+        self.lock = threading.Lock()
+        # None marks a prefix that cannot be split off the rendered prompt
+        self.entries: OrderedDict[str, Optional[PrefixEntry]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _split(messages: List) -> Tuple[List, List]:
+        n = 0
+        while n < len(messages) and messages[n].get("role") == "system":
+            n += 1
+        return messages[:n], messages[n:]
+
+    @staticmethod
+    def _key(system: List, tools: Optional[List], template_kwargs: Dict) -> str:
+        blob = json.dumps([system, tools, template_kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def _tokenize(self, text: str) -> torch.Tensor:
+        # same as apply_chat_template(tokenize=True): the template carries the special tokens
+        return self.tokenizer(text, add_special_tokens=False, return_tensors="pt")["input_ids"]
+
+    def _get(self, key: str) -> Tuple[bool, Optional[PrefixEntry]]:
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+
+    def _put(self, key: str, entry: Optional[PrefixEntry]):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def _render_prefix(self, system: List, tools: Optional[List], template_kwargs: Dict) -> Optional[str]:
+        try:
+            return self.tokenizer.apply_chat_template(
+                system, tools=tools, tokenize=False, add_generation_prompt=False, **template_kwargs
+            )
+        except Exception as e:
+            # e.g. templates that insist on a user turn
+            logger.debug(f"chat template prefix not renderable: {e}")
+            return None
+
+    def format_and_tokenize(
+        self, messages: List, tools: Optional[List] = None, **template_kwargs
+    ) -> Tuple[torch.Tensor, Optional[bool]]:
+        """
+        input ids [1, L] of the chat prompt, and whether the prefix was a
+        cache hit (None if the request has no cacheable prefix)
+        """
+        text = self.tokenizer.apply_chat_template(
+            messages, tools=tools, tokenize=False, add_generation_prompt=True, **template_kwargs
+        )
+        system, _ = self._split(messages)
+        if not system and not tools:
+            return self._tokenize(text), None
+
+        key = self._key(system, tools, template_kwargs)
+        found, entry = self._get(key)
+        if not found:
+            self._count(False)
+            expected = self._tokenize(text)
+            entry = None
+            prefix_text = self._render_prefix(system, tools, template_kwargs)
+            if prefix_text and text.startswith(prefix_text):
+                entry = PrefixEntry(prefix_text, self._tokenize(prefix_text))
+                if not torch.equal(self._join(entry, text), expected):
+                    logger.warning("chat template prefix does not split on a token boundary, not cached")
+                    entry = None
+            self._put(key, entry)
+            return expected, False
+
+        if entry is None or not text.startswith(entry.text):
+            self._count(False)
+            return self._tokenize(text), False
+
+        input_ids = self._join(entry, text)
+        if self.verify:
+            expected = self._tokenize(text)
+            if not torch.equal(input_ids, expected):
+                logger.warning("chat template prefix does not split on a token boundary, not cached")
+                self._put(key, None)
+                self._count(False)
+                return expected, False
+        self._count(True)
+        return input_ids, True
+
+    def _join(self, entry: PrefixEntry, text: str) -> torch.Tensor:
+        """input ids of `text` from the cached ones of its prefix"""
+        return torch.cat([entry.input_ids, self._tokenize(text[len(entry.text):])], dim=1)
+
+    def _count(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summarize(self):
+        return {
+            "entries": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
@@ -0,0 +1,77 @@
+from typing import Dict, List, Optional
+
+from heyi.utils.request import Request
+
+
+class DecodeCostModel:
+    """
+    predicted time of one decode step of a runner:
+
+        t = base[B] + kv_coef * sum(kv_len)
+
+    B is the cuda graph bucket the batch is padded to, so padding waste is in
+    `base`. Both terms are fitted online (normalized LMS) from measured step
+    times, the initial values only have to be in the right ballpark.
+    """
+
+    KV_SCALE = 1e5  # keeps the kv feature in the same range as the bucket one-hot
+
+    def __init__(
+        self,
+        Bs: List[int],
+        base: float = 0.05,
+        kv_coef: float = 0.002,
+        lr: float = 0.1,
+    ):
+        self.Bs = Bs
+        self.base: Dict[int, float] = {B: base * (1 + 0.1 * i) for i, B in enumerate(Bs)}
+        self.kv_coef = kv_coef  # seconds per KV_SCALE tokens
+        self.lr = lr
+
+    def bucket(self, n_reqs: int) -> Optional[int]:
+        for B in self.Bs:
+            if B >= n_reqs:
+                return B
+        return None
+
+    def predict(self, n_reqs: int, kv_len: int) -> float:
+        if n_reqs == 0:
+            return 0.0
+        B = self.bucket(n_reqs)
+        assert B is not None
+        return self.base[B] + self.kv_coef * kv_len / self.KV_SCALE
+
+    def update(self, n_reqs: int, kv_len: int, step_time: float):
+        if n_reqs == 0:
+            return
+        B = self.bucket(n_reqs)
+        x = kv_len / self.KV_SCALE
+        err = step_time - self.predict(n_reqs, kv_len)
+        step = self.lr * err / (1 + x * x)
+        self.base[B] = max(self.base[B] + step, 0.0)
+        self.kv_coef = max(self.kv_coef + step * x, 0.0)
+
+
+def partition_decode_reqs(
+    reqs: List[Request], nbatch: int, cost_model: DecodeCostModel
+) -> List[List[Request]]:
+    """
+    greedy longest-processing-time partition: the longest contexts are placed
+    first, each on the runner whose predicted step time grows the least
+    """
+    maxB = cost_model.Bs[-1]
+    assert len(reqs) <= maxB * nbatch
+
+    parts: List[List[Request]] = [[] for _ in range(nbatch)]
+    kv_lens = [0] * nbatch
+    for req in sorted(reqs, key=lambda r: r.all_length, reverse=True):
+        best, best_cost = -1, float("inf")
+        for i in range(nbatch):
+            if len(parts[i]) >= maxB:
+                continue
+            cost = cost_model.predict(len(parts[i]) + 1, kv_lens[i] + req.all_length)
+            if cost < best_cost:
+                best, best_cost = i, cost
+        parts[best].append(req)
+        kv_lens[best] += req.all_length
+    return parts
@@ -0,0 +1,49 @@
+from typing import List, Optional
+
+from transformers import PreTrainedTokenizerBase
+
+
+# prompt tokens decoded along with the first generated ones, so tokenizers
+# that strip the leading space of a sequence keep the space of the first token
+N_PROMPT_CONTEXT_TOKENS = 5
+
+
+class IncrementalDetokenizer:
+    """
+    stateful detokenizer of one request, emits only the text added by each
+    new token. Only the window `ids[prefix_offset:]` is decoded per token:
+
+    - prefix_offset:    start of the tokens whose text was emitted last
+    - read_offset:      end of the emitted tokens
+
+    Text ending in an incomplete utf-8 sequence ("�") is held back until
+    the following tokens complete it.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        prompt_ids: Optional[List[int]] = None,
+        skip_special_tokens: bool = True,
+    ):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids: List[int] = list(prompt_ids[-N_PROMPT_CONTEXT_TOKENS:]) if prompt_ids else []
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def step(self, new_id: int) -> str:
+        self.ids.append(new_id)
+        prefix_text = self._decode(self.ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+
+        # drop the tokens that will never be decoded again
+        del self.ids[: self.read_offset]
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        return new_text[len(prefix_text) :]
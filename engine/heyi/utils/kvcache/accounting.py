@@ -0,0 +1,77 @@
+import threading
+from typing import Dict, Tuple
+
+from heyi.utils.kvcache.pagetable import PageTable
+from heyi.utils.kvcache.prefixtree import PrefixTree
+
+
+class KVPageAccounting:
+    """
+    incremental bookkeeping of the kvcache pages held by live requests
+
+    per request:
+    - in_use:       pages holding the request's kv
+    - reserved:     pages admitted for the request but not filled yet,
+                    e.g. the rest of the prompt of a running layerwise prefill
+
+    Shared prefixes are counted once per holder, so in_use is an upper bound
+    of the distinct pages held by running requests. Pages pinned in the
+    prefix tree cannot be evicted either, including the matched prefixes of
+    requests still pending, so busy = max(in_use, pinned) + reserved is what
+    admission control checks against. The other pages of the prefix tree are
+    cached and may be evicted at any time.
+    """
+
+    def __init__(self, page_table: PageTable, prefix_tree: PrefixTree):
+        self.lock = threading.Lock()
+        self.page_table = page_table
+        self.prefix_tree = prefix_tree
+        self.max_num_pages = page_table.max_num_pages
+        self._reqs: Dict[str, Tuple[int, int]] = {}
+        self.in_use_pages = 0
+        self.reserved_pages = 0
+
+    def set(self, request_id: str, in_use: int, reserved: int = 0):
+        with self.lock:
+            old_in_use, old_reserved = self._reqs.get(request_id, (0, 0))
+            self._reqs[request_id] = (in_use, reserved)
+            self.in_use_pages += in_use - old_in_use
+            self.reserved_pages += reserved - old_reserved
+
+    def release(self, request_id: str):
+        with self.lock:
+            in_use, reserved = self._reqs.pop(request_id, (0, 0))
+            self.in_use_pages -= in_use
+            self.reserved_pages -= reserved
+
+    def get(self, request_id: str) -> Tuple[int, int]:
+        return self._reqs.get(request_id, (0, 0))
+
+    @property
+    def busy_pages(self) -> int:
+        return max(self.in_use_pages, self.pinned_pages) + self.reserved_pages
+
+    @property
+    def free_pages(self) -> int:
+        """pages that can still be admitted, free or evictable"""
+        return self.max_num_pages - self.busy_pages
+
+    @property
+    def pinned_pages(self) -> int:
+        return self.prefix_tree.n_pinned_pages
+
+    @property
+    def cached_pages(self) -> int:
+        """prefix-cache pages not held by any live request, reclaimable"""
+        return self.page_table.n_used_pages - self.pinned_pages
+
+    def summarize(self):
+        return {
+            "max_pages": self.max_num_pages,
+            "busy_pages": self.busy_pages,
+            "in_use_pages": self.in_use_pages,
+            "reserved_pages": self.reserved_pages,
+            "pinned_pages": self.pinned_pages,
+            "cached_pages": self.cached_pages,
+            "unallocated_pages": self.page_table.n_free_pages,
+        }
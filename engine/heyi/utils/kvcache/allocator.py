@@ -0,0 +1,83 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class PageAllocator:
+    """
+    free pages as a bitmap, handed out in runs of consecutive pages:
+    - at `hint` if the run starting there is free, e.g. right after the last
+      page of a growing sequence
+    - else from the smallest run of free pages that fits
+    - else from the longest runs, as few of them as possible
+
+    not thread-safe, `PageTable` allocates under its lock
+    """
+
+    def __init__(self, num_pages: int):
+        self.num_pages = num_pages
+        # padded with a used page on both ends, so every run has two edges
+        self._padded_mask = np.zeros(num_pages + 2, dtype=bool)
+        self.free_mask = self._padded_mask[1:-1]
+        self.free_mask[:] = True
+        self.n_free = num_pages
+
+        self.n_allocations = 0
+        # runs handed out, 1 per allocation if every one was contiguous
+        self.n_allocated_runs = 0
+
+    def free_runs(self) -> Tuple[np.ndarray, np.ndarray]:
+        """starts and lengths of the runs of free pages"""
+        mask = self._padded_mask
+        edges = np.flatnonzero(mask[1:] != mask[:-1])
+        starts, ends = edges[0::2], edges[1::2]
+        return starts, ends - starts
+
+    def allocate(self, num_pages: int, hint: Optional[int] = None) -> np.ndarray:
+        """int64 [num_pages] page ids"""
+        assert 0 < num_pages <= self.n_free
+        if (
+            hint is not None
+            and 0 <= hint <= self.num_pages - num_pages
+            and self.free_mask[hint : hint + num_pages].all()
+        ):
+            pages = np.arange(hint, hint + num_pages)
+            n_runs = 1
+        else:
+            starts, lengths = self.free_runs()
+            fits = np.flatnonzero(lengths >= num_pages)
+            if fits.size:
+                i = fits[np.argmin(lengths[fits])]
+                pages = np.arange(starts[i], starts[i] + num_pages)
+                n_runs = 1
+            else:
+                order = np.argsort(-lengths, kind="stable")
+                n_runs = int(np.searchsorted(np.cumsum(lengths[order]), num_pages)) + 1
+                pages = np.concatenate(
+                    [np.arange(starts[i], starts[i] + lengths[i]) for i in order[:n_runs]]
+                )[:num_pages]
+
+        self.free_mask[pages] = False
+        self.n_free -= num_pages
+        self.n_allocations += 1
+        self.n_allocated_runs += n_runs
+        return pages
+
+    def free(self, pages: np.ndarray):
+        assert not self.free_mask[pages].any(), "page freed twice"
+        self.free_mask[pages] = True
+        self.n_free += pages.size
+
+    def summarize(self):
+        _, lengths = self.free_runs()
+        largest = int(lengths.max()) if lengths.size else 0
+        return {
+            "free_pages": self.n_free,
+            "free_runs": int(lengths.size),
+            "largest_free_run": largest,
+            # free pages outside the largest run, 0 if they all are contiguous
+            "fragmentation": 1 - largest / self.n_free if self.n_free else 0.0,
+            "runs_per_allocation": (
+                self.n_allocated_runs / self.n_allocations if self.n_allocations else 0.0
+            ),
+        }
@@ -1,4 +1,3 @@
-import math
 import random
 from typing import List, Optional
 
@@ -7,86 +6,14 @@ from transformers.cache_utils import Cache
 from transformers.configuration_utils import PretrainedConfig
 
 from heyi.config import Config
+from heyi.utils.kvcache.pagehash import PageHashCache, do_page_hash
 from heyi.utils.kvcache.pagetable import PageTable, MLAPageTable, GQAPageTable
 from heyi.utils.kvcache.prefixtree import Match, PrefixTree
-
-import triton
-import triton.language as tl
+from heyi.utils.kvcache.swap import HostKVPool, SwapHandle
 
 def n_pages(n_tokens: int, page_size: int):
     return (n_tokens + page_size - 1) // page_size
 
-@triton.jit
-def hash_pages_kernel(
-    input_ptr,
-    output_ptr,
-    num_pages,
-    PAGE_SIZE: tl.constexpr,
-):
-    pid = tl.program_id(0)
-    if pid >= num_pages:
-        return
-    base = input_ptr + pid * PAGE_SIZE
-    h = 0
-    for i in tl.static_range(PAGE_SIZE):
-        x = tl.load(base + i)
-        h = h * 31 + x
-    tl.store(output_ptr + pid, h)
-
-
-def hash_pages(pages: torch.Tensor) -> torch.Tensor:
-    num_pages, page_size = pages.shape
-    if not pages.is_contiguous():
-        pages = pages.contiguous()
-    input_1d = pages.view(-1)
-    output = torch.empty(num_pages, dtype=torch.int64, device=pages.device)
-    grid = (num_pages,)
-    hash_pages_kernel[grid](input_1d, output, num_pages, PAGE_SIZE=page_size)
-    return output
-
-
-def do_page_hash(seq: torch.Tensor, page_size: int, trim: bool=False) -> list:
-    """
-    Args:
-        seq: 1D tensor of token IDs or values
-        page_size: number of tokens per page
-
-    Returns:
-        List of hashes, one per page (row)
-    """
-    L = seq.shape[0]
-    if trim:
-        # Trim the last unfull page
-        num_pages = L // page_size
-        seq = seq[:num_pages * page_size]
-    else:
-        # Pad with zeros at the end (or any sentinel if needed)
-        num_pages = math.ceil(L / page_size)
-        padded_len = num_pages * page_size
-
-        if L < padded_len:
-            pad_len = padded_len - L
-            seq = torch.cat(
-                [seq, torch.full((pad_len,), -1, dtype=seq.dtype, device=seq.device)]
-            )
-        
-    # Reshape to [num_pages, page_size]
-    pages = seq.reshape(num_pages, page_size).int()
-    page_hashes = hash_pages(pages)
-    page_hashes = page_hashes.tolist()
-
-    # Compute hashes per row
-
-    # page_hashes = []
-    # for row in pages:
-    #     ans = ""
-    #     for i in row.tolist():
-    #         ans += str(i) + ", "
-    #     page_hashes.append(ans)
-
-    return page_hashes
-
-
 class PagedKVCache(Cache):
     def __init__(
         self,
@@ -111,6 +38,7 @@ class PagedKVCache(Cache):
             self.prefix_tree = PrefixTree()
 
         self.page_table = page_table
+        self.qo_indptr: Optional[torch.Tensor] = None
 
         self.buffers = {
             "page_indices": torch.zeros(
@@ -139,20 +67,36 @@ class PagedKVCache(Cache):
         )
         return x
 
-    def match(self, all_ids: torch.Tensor):
-        batch_size = all_ids.shape[0]
+    def match(self, all_ids: torch.Tensor, page_hashes: Optional[List[PageHashCache]] = None):
+        """
+        page_hashes: the hash cache of each sequence, only pages not hashed
+        before are hashed
+        """
         matches: List[Match] = []
-        for seq in all_ids:
-            page_hashs = do_page_hash(seq, self.page_size, trim=True)
+        for i, seq in enumerate(all_ids):
+            if page_hashes is not None:
+                page_hashs = page_hashes[i].get(seq)
+            else:
+                page_hashs = do_page_hash(seq, self.page_size, trim=True)
             # print(f"Matching seq: {seq} -> page_hashs: {page_hashs}")
             matches.append(self.prefix_tree.match(page_hashs))
         return matches
 
     def plan(
-        self, matches: List[Match], all_ids: List[torch.Tensor], return_matches: bool = True
+        self,
+        matches: List[Match],
+        all_ids: List[torch.Tensor],
+        return_matches: bool = True,
+        qo_indptr: Optional[torch.Tensor] = None,
     ):
+        """
+        qo_indptr: [B + 1], offsets of each request's new tokens when they are
+        packed into one ragged sequence; None if every request appends the
+        same number of tokens (e.g. decode)
+        """
         B = len(matches)
         self.B = B
+        self.qo_indptr = qo_indptr
         assert len(all_ids) == B, "kv_append_length must match batch size"
 
         page_indices = self.buffers["page_indices"]
@@ -167,6 +111,8 @@ class PagedKVCache(Cache):
 
             if node == self.prefix_tree.root:
                 append_page_ids = all_ids[i]
+                last_page_hash = 0
+                next_page = None
                 pages_needed = (
                     append_page_ids.shape[0] + self.page_size - 1
                 ) // self.page_size
@@ -197,54 +143,48 @@ class PagedKVCache(Cache):
                 last_page_ids = relative_ids[: self.page_size]
                 append_page_ids = relative_ids[self.page_size :]
 
+                # hashes are chained, the pages appended continue from the last one
                 if (
                     l == node.prefix_len
                     and self.page_table.page_filled_len[node.page_indices[-1]]
                     < self.page_size
                 ):
-                    self.prefix_tree.modify(
-                        node, do_page_hash(last_page_ids, self.page_size)[0]
-                    )
+                    last_page_hash = do_page_hash(
+                        last_page_ids, self.page_size, seed=node.prefix_page_hash(l - 2)
+                    )[0]
+                    self.prefix_tree.modify(node, last_page_hash)
+                else:
+                    last_page_hash = node.prefix_page_hash(l - 1)
 
                 pages_needed = (
                     append_page_ids.shape[0] + self.page_size - 1
                 ) // self.page_size
+                # the sequence continues in the page after its last one, if free
+                next_page = node.page_indices[l - node.prefix_len - 1] + 1
                 if pages_needed > 0:
                     self.page_table.set_page_filled_len(
-                        torch.tensor(
-                            [node.page_indices[l - node.prefix_len - 1]],
-                            device=self.device,
-                        ),
+                        torch.tensor([next_page - 1], device=self.device),
                         torch.tensor([self.page_size], device=self.device, dtype=torch.int),
                     )
 
             if pages_needed:
-                if pages_needed > self.page_table.n_free_pages:
-                    # print(
-                    #     f"Not enough free pages: {pages_needed=}, {self.page_table.n_free_pages=}"
-                    # )
-                    # print(
-                    #     f"Requesting {pages_needed - self.page_table.n_free_pages} more pages"
-                    # )
-                    self.page_table.free(
-                        self.prefix_tree.free(
-                            pages_needed - self.page_table.n_free_pages
-                        )
-                    )
-
-                new_pages = self.page_table.allocate(pages_needed)
-                last_page = new_pages[-1]
+                # normally a no-op, the engine reclaims pages ahead of time
+                self.reclaim(pages_needed)
+                new_pages = self.page_table.allocate(pages_needed, hint=next_page)
+                last_page = int(new_pages[-1])
 
-                page_filled_len = [self.page_size for _ in new_pages[:-1]] + [
+                page_filled_len = [self.page_size] * (pages_needed - 1) + [
                     append_page_ids.shape[0] % self.page_size or self.page_size
                 ]
                 self.page_table.set_page_filled_len(
-                    torch.tensor(new_pages, device=self.device, dtype=torch.int),
+                    new_pages.to(self.device),
                     torch.tensor(page_filled_len, device=self.device, dtype=torch.int),
                 )
 
                 leaf_node: PrefixTree.Node = self.prefix_tree.add(
-                    new_pages, do_page_hash(append_page_ids, self.page_size), match
+                    new_pages.tolist(),
+                    do_page_hash(append_page_ids, self.page_size, seed=last_page_hash),
+                    match,
                 )
             else:
                 assert node.parent
@@ -258,8 +198,8 @@ class PagedKVCache(Cache):
                 )
 
             page_indptr[i + 1] = page_indptr[i] + leaf_node.prefix_len
-            page_indices[page_indptr[i] : page_indptr[i + 1]] = torch.tensor(
-                leaf_node.prefix_page_indices(), dtype=torch.int
+            page_indices[page_indptr[i] : page_indptr[i + 1]] = torch.from_numpy(
+                leaf_node.prefix_page_array()
             )
             last_page_len[i] = self.page_table.page_filled_len[last_page]
 
@@ -269,6 +209,93 @@ class PagedKVCache(Cache):
         if return_matches:
             return ret_matches
 
+    def reclaim(self, min_free_pages: int) -> int:
+        """
+        evict least recently used prefix-cache pages until `min_free_pages`
+        are free, returns the number of pages evicted
+        """
+        n = min_free_pages - self.page_table.n_free_pages
+        if n <= 0:
+            return 0
+        pages = self.prefix_tree.free(n)
+        self.page_table.free(pages)
+        return len(pages)
+
+    def rehash_last_page(self, matches: List[Match], all_ids: List[torch.Tensor]):
+        """
+        recompute the hash of the last page of each planned sequence, for
+        tokens that were planned as a placeholder and got their value later
+        """
+        for (l, node), ids in zip(matches, all_ids):
+            if node.children:
+                continue
+            last = n_pages(ids.shape[0], self.page_size) - 1
+            page_hash = do_page_hash(
+                ids[last * self.page_size :], self.page_size, seed=node.prefix_page_hash(last - 1)
+            )[0]
+            self.prefix_tree.modify(node, page_hash)
+
+    def swap_out(
+        self, match: Match, kv_len: int, host_pool: HostKVPool
+    ) -> Optional[SwapHandle]:
+        """
+        copy the first `kv_len` tokens of kv under `match` to host memory,
+        the device pages stay in the prefix tree and become evictable;
+        returns None if the host pool is full
+        """
+        page_indices = match.node.prefix_page_indices()[: n_pages(kv_len, self.page_size)]
+        slots = host_pool.allocate(len(page_indices))
+        if slots is None:
+            return None
+        host_pool.copy_out(self.page_table.pages, page_indices, slots)
+        return SwapHandle(slots, kv_len)
+
+    def swap_in(
+        self,
+        handle: SwapHandle,
+        all_ids: torch.Tensor,
+        host_pool: HostKVPool,
+        page_hashes: Optional[PageHashCache] = None,
+    ) -> Match:
+        """
+        all_ids: 1D, the tokens whose kv is held by `handle`
+        page_hashes: the hash cache of the sequence
+
+        pages still cached in the prefix tree are reused, only the evicted
+        ones are copied back from host memory
+        """
+        kv_len = handle.kv_len
+        match = self.match(all_ids[None, :kv_len], [page_hashes] if page_hashes else None)[0]
+        (l, node) = match
+
+        pages_needed = n_pages(kv_len, self.page_size) - l
+        if pages_needed > 0:
+            self.reclaim(pages_needed)
+            new_pages = self.page_table.allocate(
+                pages_needed, hint=node.page_indices[-1] + 1 if l else None
+            )
+            host_pool.copy_in(self.page_table.pages, handle.slots[l:], new_pages)
+
+            page_filled_len = [self.page_size] * (pages_needed - 1) + [
+                kv_len % self.page_size or self.page_size
+            ]
+            self.page_table.set_page_filled_len(
+                new_pages.to(self.device),
+                torch.tensor(page_filled_len, device=self.device, dtype=torch.int),
+            )
+            node = self.prefix_tree.add(
+                new_pages.tolist(),
+                do_page_hash(
+                    all_ids[l * self.page_size : kv_len],
+                    self.page_size,
+                    seed=node.prefix_page_hash(l - 1),
+                ),
+                match,
+            )
+
+        host_pool.free(handle.slots)
+        return Match(node.prefix_len, node)
+
     def get_seq_length(self, layer_idx: Optional[int] = 0):
         return (
             self.page_size * (torch.diff(self.buffers["page_indptr"]) - 1)
@@ -332,6 +359,7 @@ class PagedMLACache(PagedKVCache):
             self.buffers["page_indices"][:],
             self.buffers["page_indptr"][: self.B + 1],
             self.buffers["last_page_len"][: self.B],
+            self.qo_indptr,
         )
         return page_table
     
@@ -375,6 +403,7 @@ class PagedGQACache(PagedKVCache):
             self.buffers["page_indices"][:],
             self.buffers["page_indptr"][: self.B + 1],
             self.buffers["last_page_len"][: self.B],
+            self.qo_indptr,
         )
         return page_table
     
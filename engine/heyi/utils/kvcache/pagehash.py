@@ -0,0 +1,167 @@
+import math
+from typing import List
+
+import numpy as np
+import torch
+import triton
+import triton.language as tl
+
+# token mixing: k = fmix64(x * K1 + (position + 1) * K2), a page hashes to the wrapping sum of its k
+_K1 = tl.constexpr(0x9E3779B97F4A7C15)
+_K2 = tl.constexpr(0xC2B2AE3D27D4EB4F)
+_C1 = tl.constexpr(0xFF51AFD7ED558CCD)
+_C2 = tl.constexpr(0xC4CEB9FE1A85EC53)
+# chaining: h[i] = h[i - 1] * M + page_hash[i], h[-1] = seed, all mod 2**64
+_M = 0x9FB21C651E98DF25
+_M_INV = pow(_M, -1, 1 << 64)
+
+_U64 = np.uint64
+
+
+@triton.jit
+def _fmix64(k):
+    k = k ^ (k >> 33)
+    k = k * _C1
+    k = k ^ (k >> 33)
+    k = k * _C2
+    k = k ^ (k >> 33)
+    return k
+
+
+@triton.jit
+def hash_pages_kernel(
+    input_ptr,
+    output_ptr,
+    num_pages,
+    PAGE_SIZE: tl.constexpr,
+):
+    pid = tl.program_id(0)
+    if pid >= num_pages:
+        return
+    offs = tl.arange(0, PAGE_SIZE)
+    x = tl.load(input_ptr + pid * PAGE_SIZE + offs).to(tl.uint32, bitcast=True).to(tl.uint64)
+    k = _fmix64(x * _K1 + (offs.to(tl.uint64) + 1) * _K2)
+    h = tl.sum(k, axis=0)
+    tl.store(output_ptr + pid, h.to(tl.int64, bitcast=True))
+
+
+def _fmix64_host(k: np.ndarray) -> np.ndarray:
+    k ^= k >> _U64(33)
+    k *= _U64(_C1.value)
+    k ^= k >> _U64(33)
+    k *= _U64(_C2.value)
+    k ^= k >> _U64(33)
+    return k
+
+
+def _hash_pages_host(pages: torch.Tensor) -> torch.Tensor:
+    """`hash_pages_kernel` for host tensors, bit-identical"""
+    page_size = pages.shape[1]
+    x = pages.numpy().view(np.uint32).astype(np.uint64)
+    positions = (np.arange(1, page_size + 1, dtype=np.uint64) * _U64(_K2.value)).astype(np.uint64)
+    k = _fmix64_host(x * _U64(_K1.value) + positions)
+    h = k.sum(axis=1, dtype=np.uint64)
+    return torch.from_numpy(h.view(np.int64))
+
+
+def hash_pages(pages: torch.Tensor) -> torch.Tensor:
+    """int32 [num_pages, page_size] -> int64 [num_pages], each page on its own"""
+    num_pages, page_size = pages.shape
+    if not pages.is_cuda:
+        return _hash_pages_host(pages)
+    assert page_size & (page_size - 1) == 0, "page size must be a power of 2"
+    if not pages.is_contiguous():
+        pages = pages.contiguous()
+    input_1d = pages.view(-1)
+    output = torch.empty(num_pages, dtype=torch.int64, device=pages.device)
+    grid = (num_pages,)
+    hash_pages_kernel[grid](input_1d, output, num_pages, PAGE_SIZE=page_size)
+    return output
+
+
+# M ** i and M ** -i, grown on demand
+_powers = np.ones(1, dtype=np.uint64)
+_inv_powers = np.ones(1, dtype=np.uint64)
+
+
+def _power_tables(n: int):
+    global _powers, _inv_powers
+    while _powers.shape[0] < n:
+        k = _powers.shape[0]
+        _powers = np.concatenate([_powers, _powers * _powers[-1] * _U64(_M)])
+        _inv_powers = np.concatenate([_inv_powers, _inv_powers * _inv_powers[-1] * _U64(_M_INV)])
+        assert _powers.shape[0] == 2 * k
+    return _powers[:n], _inv_powers[:n]
+
+
+def chain_page_hashes(page_hashes: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    h[i] = h[i - 1] * M + page_hashes[i] with h[-1] = seed, vectorized as
+    h[i] = M ** i * (seed * M + sum(page_hashes[j] * M ** -j for j <= i))
+    (M is odd, so invertible mod 2**64); uint64 in and out
+    """
+    powers, inv_powers = _power_tables(page_hashes.shape[0])
+    s = np.cumsum(page_hashes * inv_powers, dtype=np.uint64)
+    s += np.array(seed, dtype=np.int64).view(np.uint64) * _U64(_M)
+    return s * powers
+
+
+def do_page_hash(seq: torch.Tensor, page_size: int, trim: bool = False, seed: int = 0) -> List[int]:
+    """
+    Args:
+        seq: 1D tensor of token IDs or values
+        page_size: number of tokens per page
+        trim: drop the last page if it is not full, otherwise it is padded with -1
+        seed: hash of the page before `seq`, 0 at the start of a sequence
+
+    Returns:
+        List of chained hashes, one per page: each depends on the page and
+        on all pages before it
+    """
+    L = seq.shape[0]
+    if trim:
+        # Trim the last unfull page
+        num_pages = L // page_size
+        seq = seq[:num_pages * page_size]
+    else:
+        # Pad with -1 at the end
+        num_pages = math.ceil(L / page_size)
+        padded_len = num_pages * page_size
+
+        if L < padded_len:
+            pad_len = padded_len - L
+            seq = torch.cat(
+                [seq, torch.full((pad_len,), -1, dtype=seq.dtype, device=seq.device)]
+            )
+    if num_pages == 0:
+        return []
+
+    # Reshape to [num_pages, page_size]
+    pages = seq.reshape(num_pages, page_size).int()
+    page_hashes = hash_pages(pages).cpu().numpy().view(np.uint64)
+    return chain_page_hashes(page_hashes, seed).view(np.int64).tolist()
+
+
+class PageHashCache:
+    """
+    chained hashes of the full pages of one growing token sequence (a
+    request), each page is hashed once; the tokens of a full page never
+    change, so `get` only hashes the pages added since the last call
+    """
+
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+        self.hashes: List[int] = []
+
+    def get(self, ids: torch.Tensor) -> List[int]:
+        """ids: 1D, a prefix of the sequence"""
+        num_pages = ids.shape[0] // self.page_size
+        n_cached = len(self.hashes)
+        if num_pages > n_cached:
+            self.hashes += do_page_hash(
+                ids[n_cached * self.page_size : num_pages * self.page_size],
+                self.page_size,
+                trim=True,
+                seed=self.hashes[-1] if self.hashes else 0,
+            )
+        return self.hashes[:num_pages]
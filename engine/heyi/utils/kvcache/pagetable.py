@@ -3,17 +3,19 @@ import threading
 from typing import List, Optional
 
 import flashinfer
+import numpy as np
 import torch
 from transformers.configuration_utils import PretrainedConfig
 
+from heyi.utils.kvcache.allocator import PageAllocator
+
 
 class PageTable:
     """
     global states:
     - page_filled_len:      [max_num_pages], 0 ~ page_size, tracks how much of each page is filled
     - mla_paged_kv_cache:   [num_layers, max_num_pages, page_size, ckv_dim + kpe_dim], the actual KV cache storage
-    - free_pages:           set of free page IDs
-    - used_pages:           set of used page IDs
+    - allocator:            free page IDs, see `PageAllocator`
 
     per-step states (passed as parameters to update method):
     - kv_page_indices:      [max_num_pages], flat ragged list of page IDs
@@ -36,31 +38,39 @@ class PageTable:
         self.pages = pages
         self.device = device
 
-        self.free_pages = set([i for i in range(max_num_pages)])
-        self.used_pages = set()
+        self.allocator = PageAllocator(max_num_pages)
 
         self.page_filled_len = torch.zeros(self.max_num_pages, dtype=torch.int32)
 
     @property
     def n_free_pages(self):
-        return len(self.free_pages)
+        return self.allocator.n_free
 
-    def allocate(self, num_pages: int) -> List[int]:
-        """Vectorized allocation of the first num_pages free pages."""
+    @property
+    def n_used_pages(self):
+        return self.max_num_pages - self.allocator.n_free
+
+    def allocate(self, num_pages: int, hint: Optional[int] = None) -> torch.Tensor:
+        """
+        int32 [num_pages] page IDs on the host, consecutive where possible;
+        hint: the page wanted first, e.g. the one after the last page of the
+        sequence being extended
+        """
         with self.lock:
-            # print(f"Allocating {num_pages} pages")
             assert self.n_free_pages >= num_pages
-            alloc_pages = [self.free_pages.pop() for _ in range(num_pages)]
-            for page in alloc_pages:
-                self.used_pages.add(page)
-        return alloc_pages
+            pages = self.allocator.allocate(num_pages, hint)
+        return torch.from_numpy(pages.astype(np.int32))
 
-    def free(self, pages_to_free: List[int]):
+    def free(self, pages_to_free: List[int] | torch.Tensor):
+        if isinstance(pages_to_free, torch.Tensor):
+            pages = pages_to_free.cpu().numpy().astype(np.int64)
+        else:
+            pages = np.asarray(pages_to_free, dtype=np.int64)
+        if pages.size == 0:
+            return
         with self.lock:
-            for page in pages_to_free:
-                self.used_pages.remove(page)
-                self.free_pages.add(page)
-            self.page_filled_len[pages_to_free] = 0
+            self.allocator.free(pages)
+            self.page_filled_len[torch.from_numpy(pages)] = 0
 
     def set_page_filled_len(self, page_indices: torch.Tensor, lengths: torch.Tensor):
         with self.lock:
@@ -78,8 +88,7 @@ class PageTable:
     def __str__(self):
         return (
             f"{self.n_free_pages=}\n"
-            f"{self.free_pages=}\n"
-            f"{self.used_pages=}\n"
+            f"{self.allocator.summarize()=}\n"
             f"{self.page_filled_len=}"
         )
 
@@ -120,13 +129,17 @@ class MLAPageTable(PageTable):
         kv_page_indices: torch.Tensor,
         kv_page_indptr: torch.Tensor,
         kv_last_page_len: torch.Tensor,
+        append_indptr: Optional[torch.Tensor] = None,
     ):
         B = ckv.shape[0]
         seqlen = ckv.shape[1]
 
-        self.append_indptr = torch.arange(
-            0, B * seqlen + 1, seqlen, device=self.device
-        ).view(B + 1)
+        if append_indptr is None:
+            # same number of new tokens for every request
+            append_indptr = torch.arange(
+                0, B * seqlen + 1, seqlen, device=self.device
+            ).view(B + 1)
+        self.append_indptr = append_indptr
 
         batch_indices, positions = flashinfer.page.get_batch_indices_positions(
             self.append_indptr,
@@ -187,13 +200,17 @@ class GQAPageTable(PageTable):
         kv_page_indices: torch.Tensor,
         kv_page_indptr: torch.Tensor,
         kv_last_page_len: torch.Tensor,
+        append_indptr: Optional[torch.Tensor] = None,
     ):
         B = key.shape[0]
         seqlen = key.shape[1]
 
-        self.append_indptr = torch.arange(
-            0, B * seqlen + 1, seqlen, device=self.device
-        ).view(B + 1)
+        if append_indptr is None:
+            # same number of new tokens for every request
+            append_indptr = torch.arange(
+                0, B * seqlen + 1, seqlen, device=self.device
+            ).view(B + 1)
+        self.append_indptr = append_indptr
 
         batch_indices, positions = flashinfer.page.get_batch_indices_positions(
             self.append_indptr,
@@ -1,9 +1,14 @@
+import bisect
+import heapq
+import itertools
 import time
-from typing import Any, Callable, List, NamedTuple, Optional, Dict
+from typing import Any, Callable, List, NamedTuple, Optional, Dict, Tuple
 from uuid import uuid4
 
 import threading
 
+import numpy as np
+
 
 def indstr(d: int, s: str | List):
     if isinstance(s, str):
@@ -15,12 +20,75 @@ def indstr(d: int, s: str | List):
 Match = NamedTuple("Match", [("len", int), ("node", "PrefixTree.Node")])
 
 
+class EvictionHeap:
+    """
+    min-heap of the evictable nodes of a prefix tree by timestamp; a touched
+    node is pushed again instead of moved, its older entries go stale and are
+    skipped when popped, like entries of nodes that got children or left the
+    tree. Stale entries are dropped in bulk once they outnumber live ones.
+
+    `lock` also guards the pins of the nodes, which requests change from
+    the scheduler and the runner threads, and `n_pinned_pages`, the pages on
+    the paths from the root to pinned nodes, each counted once
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap: List[Tuple[float, int, "PrefixTree.Node"]] = []
+        self.seq = itertools.count()
+        # live entries after the last compaction
+        self.n_live = 0
+        self.n_pinned_pages = 0
+
+    def push(self, node: "PrefixTree.Node"):
+        with self.lock:
+            self._push(node)
+
+    def _push(self, node: "PrefixTree.Node"):
+        node._heap_seq = seq = next(self.seq)
+        heapq.heappush(self.heap, (node.timestamp, seq, node))
+        if len(self.heap) > 2 * self.n_live + 1024:
+            self._compact()
+
+    @staticmethod
+    def _live(entry: Tuple[float, int, "PrefixTree.Node"]) -> bool:
+        _, seq, node = entry
+        return node._heap_seq == seq and node.evictable
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if self._live(entry)]
+        heapq.heapify(self.heap)
+        self.n_live = len(self.heap)
+
+    def pop(self) -> Optional["PrefixTree.Node"]:
+        """the least recently used evictable node, None if there is none"""
+        with self.lock:
+            while self.heap:
+                entry = heapq.heappop(self.heap)
+                if self._live(entry):
+                    entry[2]._heap_seq = -1
+                    return entry[2]
+            return None
+
+
 class PrefixTree:
     """
     kvcache trie-tree for one batch
     each node is a range of pages
     nodes under same parent don't share any prefix
     (split only happens at the exact difference segment)
+
+    page hashes are chained (see `pagehash`), equal hashes at a position
+    mean equal prefixes up to there, so children are looked up by their
+    first page hash and a run of pages is matched by bisection
+
+    only leaves are evicted, least recently used first, through an
+    `EvictionHeap`; touching a node does not walk to the root, a parent
+    takes the timestamp of its last child when it becomes a leaf
+
+    a node pinned by a live request (see `Request.matches`) is not evicted,
+    and neither are its ancestors as they are not leaves; splitting a node
+    keeps it as the tail half, so a pin stays on the same pages
     """
 
     class Node:
@@ -30,47 +98,117 @@ class PrefixTree:
             page_hashs: List[int],
             parent: Optional["PrefixTree.Node"] = None,
             is_root: Optional[bool] = False,
+            lru: Optional[EvictionHeap] = None,
         ):
             self.node_id = uuid4().int if not is_root else 0
             self.page_indices = page_indices
             self.page_hashs = page_hashs
             self.parent = parent
             self._children: Dict[int, "PrefixTree.Node"] = {}
+            # children by first page hash; identical partial last pages may
+            # share one, e.g. two requests with the same prompt
+            self._children_by_hash: Dict[int, List["PrefixTree.Node"]] = {}
             self.is_root = is_root
             self.timestamp = time.perf_counter()
-            self.subtree_size = len(page_hashs)
+            self.lru = lru if lru is not None else parent.lru
+            # seq of the node's live entry in `lru`, -1 if none
+            self._heap_seq = -1
+            # live requests whose match ends in this node, and in its subtree
+            self.ref_count = 0
+            self.subtree_ref_count = 0
+            # pages before this node on the path from the root; paths are
+            # absolute, so only splitting the node itself changes it
+            self.offset = parent.prefix_len if parent else 0
+            # page indices from the root, built on first use
+            self._prefix_pages: Optional[np.ndarray] = None
 
         @property
         def children(self):
             return self._children.values()
 
-        def _update_subtree_size_bt(self, diff: int):
-            """
-            update subtree size from self to root
-            """
+        @property
+        def evictable(self) -> bool:
+            """an unpinned leaf still in the tree"""
+            return (
+                not self._children
+                and not self.ref_count
+                and self.parent is not None
+                and self.parent._children.get(self.node_id) is self
+            )
+
+        def pin(self):
+            """the caller holds `lru.lock`"""
+            self.ref_count += 1
+            node = self
+            while node is not None:
+                node.subtree_ref_count += 1
+                if node.subtree_ref_count == 1:
+                    self.lru.n_pinned_pages += node.len
+                node = node.parent
+
+        def unpin(self):
+            """the caller holds `lru.lock`"""
+            assert self.ref_count > 0
+            self.ref_count -= 1
             node = self
-            while node:
-                node.subtree_size += diff
+            while node is not None:
+                node.subtree_ref_count -= 1
+                if node.subtree_ref_count == 0:
+                    self.lru.n_pinned_pages -= node.len
                 node = node.parent
+            if self.evictable:
+                self.lru._push(self)
+
+        def touch(self):
+            self.timestamp = time.perf_counter()
+            if self.evictable:
+                self.lru.push(self)
+
+        def _index_child(self, node: "PrefixTree.Node"):
+            self._children_by_hash.setdefault(node.page_hashs[0], []).append(node)
+
+        def _unindex_child(self, node: "PrefixTree.Node"):
+            key = node.page_hashs[0]
+            nodes = self._children_by_hash[key]
+            nodes.remove(node)
+            if not nodes:
+                del self._children_by_hash[key]
+
+        def child_by_hash(self, page_hash: int) -> Optional["PrefixTree.Node"]:
+            nodes = self._children_by_hash.get(page_hash)
+            return nodes[0] if nodes else None
 
         def _dropch(self, node: "PrefixTree.Node"):
             self._children.pop(node.node_id)
-            self._update_subtree_size_bt(-node.subtree_size)
+            self._unindex_child(node)
 
         def _addch(self, node: "PrefixTree.Node"):
             self._children[node.node_id] = node
-            self._update_subtree_size_bt(node.subtree_size)
+            self._index_child(node)
 
         def _extend_pagelist(self, page_indices: List[int], page_hashs: List[int]):
             assert not self.is_root
-            self.page_indices += page_indices
-            self.page_hashs += page_hashs
-            self._update_subtree_size_bt(len(page_hashs))
+            with self.lru.lock:
+                self.page_indices += page_indices
+                self.page_hashs += page_hashs
+                if self.subtree_ref_count:
+                    self.lru.n_pinned_pages += len(page_hashs)
+            self._prefix_pages = None
+
+        def _set_last_page_hash(self, page_hash: int):
+            if self.len == 1 and self.parent:
+                # the first page is the key in the parent's index
+                self.parent._unindex_child(self)
+                self.page_hashs[-1] = page_hash
+                self.parent._index_child(self)
+            else:
+                self.page_hashs[-1] = page_hash
 
         def split(self, position: int):
             """
             split after count: list -> list[:position], list[position:]
             e.g. [a, b, c].split(1) = [a,], [b, c]
+            the head is a new node, the tail is this node
             """
             if self.is_root:
                 return (self, None)
@@ -80,69 +218,59 @@ class PrefixTree:
             if position == len(self.page_hashs):
                 return (self, None)
 
-            assert self.parent
+            parent = self.parent
+            assert parent
             lnode = PrefixTree.Node(
                 self.page_indices[:position],
                 self.page_hashs[:position],
-                self.parent,
-            )
-            rnode = PrefixTree.Node(
-                self.page_indices[position:],
-                self.page_hashs[position:],
-                lnode,
+                parent,
             )
-            if self.parent:
-                self.parent._dropch(self)
-                self.parent._addch(lnode)
-            lnode._addch(rnode)
-            for c in self.children:
-                rnode._addch(c)
-                c.parent = rnode
-            return (lnode, rnode)
-
-        def _update_timestamp_bt(self):
-            """
-            update timestamp from self to root
-            """
-            node = self
-            while node:
-                node.timestamp = time.perf_counter()
-                node = node.parent
-
-        def _match(self, page_hashs: List[int]):
+            lnode.timestamp = self.timestamp
+            # pins walk up the parents, which change here
+            with self.lru.lock:
+                lnode.subtree_ref_count = self.subtree_ref_count
+                # re-keyed by the new first page in the indices
+                parent._dropch(self)
+                self.page_indices = self.page_indices[position:]
+                self.page_hashs = self.page_hashs[position:]
+                self.offset += position
+                self.parent = lnode
+                parent._addch(lnode)
+                lnode._addch(self)
+            return (lnode, self)
+
+        def _match(self, page_hashs: List[int], start: int = 0):
             """
-            single node match, non-recursive
+            single node match, non-recursive: the number of leading pages of
+            the node equal to `page_hashs[start:]`
             """
-            min_l = min(len(self.page_hashs), len(page_hashs))
-            matched = 0
-            for i, (a, b) in enumerate(
-                zip(self.page_hashs[:min_l], page_hashs[:min_l])
-            ):
-                matched = i
-                if a != b:
-                    break
-            else:
-                matched = min_l
-            return matched
+            n = min(len(self.page_hashs), len(page_hashs) - start)
+            if n <= 0:
+                return 0
+            if self.page_hashs[n - 1] == page_hashs[start + n - 1]:
+                return n
+            # with chained hashes matching is monotonic: pages equal up to
+            # some point and different after it
+            return bisect.bisect_left(
+                range(n), True, key=lambda i: self.page_hashs[i] != page_hashs[start + i]
+            )
 
         def treematch(self, page_hashes: List[int]) -> Match:
             all_matched = self.prefix_len
             node = self
+            start = 0
             while True:
-                matched = node._match(page_hashes)
-                page_hashes = page_hashes[matched:]
+                matched = node._match(page_hashes, start)
+                start += matched
                 all_matched += matched
 
-                if matched != node.len:
+                if matched != node.len or start >= len(page_hashes):
                     return Match(all_matched, node)
 
-                for c in node.children:
-                    child_matched = c._match(page_hashes)
-                    if child_matched > 0:
-                        node = c
-                        break
-                else:
+                child = node.child_by_hash(page_hashes[start])
+                if child is None:
                     return Match(all_matched, node)
+                node = child
 
         def add(
             self, page_indices: List[int], page_hashs: List[int], at: int
@@ -154,6 +282,7 @@ class PrefixTree:
                 assert self.is_root
                 leaf_node = PrefixTree.Node(page_indices, page_hashs, self)
                 self._addch(leaf_node)
+                leaf_node.touch()
                 return leaf_node
 
             assert self.parent  # assert node is not root
@@ -168,7 +297,7 @@ class PrefixTree:
             else:
                 leaf_node = PrefixTree.Node(page_indices, page_hashs, lnode)
                 lnode._addch(leaf_node)
-            leaf_node._update_timestamp_bt()
+            leaf_node.touch()
             return leaf_node
 
         def _traverse(
@@ -190,41 +319,33 @@ class PrefixTree:
                 ret += c._traverse(f=f)
             return ret
 
-        def prefix_page_indices(self):
-            page_indices = []
+        def prefix_page_hash(self, i: int) -> int:
+            """
+            hash of the `i`-th page on the path from the root, which seeds the
+            chained hash of the page after it; 0 before the first page
+            """
+            if i < 0:
+                return 0
             node = self
-            while node:
-                page_indices = node.page_indices + page_indices
+            while node.offset > i:
                 node = node.parent
-            return page_indices
-
-        def free(self, npages: int) -> List[int]:
-            # print(f"try freeing {npages=} from subtree, root {self.page_hashs}")
-            assert npages <= self.subtree_size
-
-            children_size = self.subtree_size - self.len
-            if children_size < npages:
-                rlen = npages - children_size
-                lnode, rnode = self.split(self.len - rlen)
-                assert lnode
-                assert rnode
-                lnode._dropch(rnode)
-                # print(f"freeing {rnode.subtree_size}, dropping:\n{rnode}")
-                return rnode._traverse(attr="page_indices")
-
-            # Sort children by LRU timestamp (ascending: least recently used first)
-            lru_children = sorted(self.children, key=lambda x: x.timestamp)
-
-            # Iterate through sorted children
-            freed_pages = []
-            for c in lru_children:
-                # print(f"child: {c.__repr__()}")
-                freed_pages += c.free(min(npages - len(freed_pages), c.subtree_size))
-                # print(f"{npages=}, {freed_pages=}, {len(freed_pages)}")
-                if len(freed_pages) >= npages:
-                    # print("break")
-                    break
-            return freed_pages
+            return node.page_hashs[i - node.offset]
+
+        def prefix_page_array(self) -> np.ndarray:
+            """int32 [prefix_len], the page indices from the root, cached"""
+            if self._prefix_pages is None:
+                parts = []
+                node = self
+                while node:
+                    parts.append(node.page_indices)
+                    node = node.parent
+                self._prefix_pages = np.fromiter(
+                    itertools.chain.from_iterable(reversed(parts)), dtype=np.int32, count=self.prefix_len
+                )
+            return self._prefix_pages
+
+        def prefix_page_indices(self) -> List[int]:
+            return self.prefix_page_array().tolist()
 
         def __str__(self, d=0):
             s = indstr(
@@ -253,14 +374,19 @@ class PrefixTree:
 
         @property
         def prefix_len(self) -> int:
-            return (
-                self.len if self.parent == None else self.parent.prefix_len + self.len
-            )
+            return self.offset + self.len
 
     def __init__(self):
-        self.root = PrefixTree.Node([], [], None, is_root=True)
+        self.lru = EvictionHeap()
+        self.root = PrefixTree.Node([], [], None, is_root=True, lru=self.lru)
         # self.root = CacheTree.Node([], None, is_root=True)
         self.lock = threading.Lock()
+        self.n_evicted_pages = 0
+
+    @property
+    def n_pinned_pages(self) -> int:
+        """distinct pages held by pinned nodes, not evictable"""
+        return self.lru.n_pinned_pages
 
     def add(
         self,
@@ -270,7 +396,7 @@ class PrefixTree:
     ) -> Node:
         with self.lock:
             l, node = matched
-            at = l - (node.parent.prefix_len if node.parent else 0)
+            at = l - node.offset
             return node.add(page_indices, page_hashs, at)
 
     def modify(self, node: "PrefixTree.Node", last_page_hash: int):
@@ -279,8 +405,8 @@ class PrefixTree:
         """
         with self.lock:
             assert not node._children
-            node.page_hashs[-1] = last_page_hash
-            node._update_timestamp_bt()
+            node._set_last_page_hash(last_page_hash)
+            node.touch()
 
     def match(self, page_hashs: List[int]):        
         match = self.root.treematch(page_hashs)
@@ -290,19 +416,39 @@ class PrefixTree:
         # split at matched point
         with self.lock:
             l, node = match
-            at = l - (node.parent.prefix_len if node.parent else 0)
+            at = l - node.offset
             node, _ = node.split(at)
             assert node
-            node._update_timestamp_bt()
+            node.touch()
             return Match(l, node)
 
-    def free(self, npages: int):
+    def _drop_leaf(self, node: "PrefixTree.Node") -> List[int]:
+        parent = node.parent
+        assert parent
+        parent._dropch(node)
+        if parent.evictable:
+            # used at least as recently as the child, untouched by its reads
+            parent.timestamp = max(parent.timestamp, node.timestamp)
+            self.lru.push(parent)
+        return node.page_indices
+
+    def free(self, npages: int) -> List[int]:
         """
-        free at least npages
+        free up to npages, least recently used leaves first; the last leaf
+        is cut short rather than dropped if it holds more than needed
         """
         with self.lock:
-            # print(f"Freeing {npages} pages")
-            return self.root.free(npages)
+            freed: List[int] = []
+            while len(freed) < npages:
+                node = self.lru.pop()
+                if node is None:
+                    break
+                n = npages - len(freed)
+                if node.len > n:
+                    _, node = node.split(node.len - n)
+                freed += self._drop_leaf(node)
+            self.n_evicted_pages += len(freed)
+            return freed
 
     def __str__(self):
         return "\nPrefixTree:\n" + str(self.root) + "\n"
@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+import torch
+
+
+SwapHandle = NamedTuple("SwapHandle", [("slots", List[int]), ("kv_len", int)])
+
+
+class HostKVPool:
+    """
+    pinned host memory mirror of `PageTable.pages`, holds the kv pages of
+    preempted requests until they are swapped back in
+
+    - pages:        [num_layers] x [max_num_pages, page_size, ...], pinned
+    - free_slots:   set of free host page slots
+    """
+
+    def __init__(self, device_pages: List[torch.Tensor], max_num_pages: int):
+        self.lock = threading.Lock()
+        self.max_num_pages = max_num_pages
+        self.pages = [
+            torch.empty(
+                (max_num_pages, *p.shape[1:]),
+                dtype=p.dtype,
+                device="cpu",
+                pin_memory=True,
+            )
+            for p in device_pages
+        ]
+        self.page_nbytes = sum(p[0].nbytes for p in self.pages)
+        self.free_slots = set(range(max_num_pages))
+
+        self.n_swapped_out_pages = 0
+        self.n_swapped_in_pages = 0
+        self.swap_time = 0.0
+
+    @property
+    def n_free_slots(self):
+        return len(self.free_slots)
+
+    def allocate(self, num_pages: int) -> Optional[List[int]]:
+        with self.lock:
+            if num_pages > self.n_free_slots:
+                return None
+            return [self.free_slots.pop() for _ in range(num_pages)]
+
+    def free(self, slots: List[int]):
+        with self.lock:
+            self.free_slots.update(slots)
+
+    @torch.no_grad()
+    def copy_out(
+        self, device_pages: List[torch.Tensor], page_indices: List[int], slots: List[int]
+    ):
+        """device pages `page_indices` -> host `slots`"""
+        t0 = time.perf_counter()
+        src = torch.tensor(page_indices, dtype=torch.long, device=device_pages[0].device)
+        dst = torch.tensor(slots, dtype=torch.long)
+        for host, dev in zip(self.pages, device_pages):
+            host.index_copy_(0, dst, dev.index_select(0, src).cpu())
+        self.swap_time += time.perf_counter() - t0
+        self.n_swapped_out_pages += len(slots)
+
+    @torch.no_grad()
+    def copy_in(
+        self,
+        device_pages: List[torch.Tensor],
+        slots: List[int],
+        page_indices: List[int] | torch.Tensor,
+    ):
+        """host `slots` -> device pages `page_indices`"""
+        t0 = time.perf_counter()
+        src = torch.tensor(slots, dtype=torch.long)
+        dst = torch.as_tensor(page_indices, dtype=torch.long).to(device_pages[0].device)
+        for host, dev in zip(self.pages, device_pages):
+            dev.index_copy_(0, dst, host.index_select(0, src).to(dev.device))
+        torch.cuda.synchronize(device_pages[0].device)
+        self.swap_time += time.perf_counter() - t0
+        self.n_swapped_in_pages += len(slots)
+
+    def summarize(self):
+        n_pages = self.n_swapped_out_pages + self.n_swapped_in_pages
+        return {
+            "swap_space_pages": self.max_num_pages,
+            "swap_space_free_pages": self.n_free_slots,
+            "swapped_out_pages": self.n_swapped_out_pages,
+            "swapped_in_pages": self.n_swapped_in_pages,
+            # GB/s
+            "swap_bandwidth": (
+                n_pages * self.page_nbytes / self.swap_time / 1e9
+                if self.swap_time > 0 else 0
+            ),
+        }
@@ -0,0 +1,208 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    a metric family, one child per combination of label values; children
+    are created once and cached, so updating them is an attribute add
+    under a lock
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self._children: Dict[LabelValues, "_Metric"] = {}
+        self._init_value()
+
+    def _init_value(self):
+        raise NotImplementedError
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.help)
+
+    def labels(self, *values) -> "_Metric":
+        assert len(values) == len(self.labelnames), f"{self.name} expects labels {self.labelnames}"
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self.lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, extra label, value) of one child"""
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        if self.labelnames:
+            children = list(self._children.items())
+        else:
+            children = [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child._samples():
+                labels = _format_labels(self.labelnames, values, extra)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _init_value(self):
+        self.value = 0
+
+    def inc(self, amount: Union[int, float] = 1):
+        with self.lock:
+            self.value += amount
+
+    def _samples(self):
+        return [("", "", self.value)]
+
+
+class Gauge(_Metric):
+    """
+    set directly, or computed at collection time by `set_function`, which
+    for a labeled gauge returns {label values: value}
+    """
+
+    type_name = "gauge"
+
+    def _init_value(self):
+        self.value = 0
+        self.function: Optional[Callable] = None
+
+    def set(self, value: Union[int, float]):
+        self.value = value
+
+    def set_function(self, function: Callable):
+        self.function = function
+
+    def _samples(self):
+        return [("", "", self.value)]
+
+    def collect(self) -> List[str]:
+        if self.function is not None:
+            values = self.function()
+            if self.labelnames:
+                for key, value in values.items():
+                    self.labels(*(key if isinstance(key, tuple) else (key,))).set(value)
+            else:
+                self.value = values
+        return super().collect()
+
+
+class Histogram(_Metric):
+    """fixed bucket upper bounds, observing is a bisect and two adds"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = ()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _init_value(self):
+        # the last one counts what is above all bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def _samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            samples.append(("_bucket", f'le="{_format_value(float(bound))}"', cumulative))
+        samples.append(("_sum", "", self.sum))
+        samples.append(("_count", "", self.count))
+        return samples
+
+
+class MetricsRegistry:
+    """named metrics, rendered in the Prometheus text exposition format"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        assert metric.name not in self.metrics, f"metric {metric.name} already registered"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = (), function: Optional[Callable] = None) -> Gauge:
+        gauge = self._register(Gauge(self.prefix + name, help, labelnames))
+        if function is not None:
+            gauge.set_function(function)
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+class EngineMetrics:
+    """the metrics the engine exports, gauges are read from the engine at collection time"""
+
+    STEP_TIME_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, max_batch_size: int):
+        self.registry = r = MetricsRegistry(prefix="heyi_")
+        self.generation_tokens = r.counter("generation_tokens_total", "tokens generated")
+        self.prompt_tokens = r.counter("prompt_tokens_total", "prompt tokens of submitted requests")
+        self.prefill_tokens = r.counter("prefill_tokens_total", "prompt tokens prefilled, prefix cache hits excluded")
+        self.prefix_cache_hit_tokens = r.counter("prefix_cache_hit_tokens_total", "prompt tokens served from the prefix cache")
+        self.requests_finished = r.counter("requests_finished_total", "requests removed from the engine", ["reason"])
+        self.cancellations = r.counter("cancellations_total", "requests cancelled")
+        self.preemptions = r.counter("preemptions_total", "decoding requests preempted", ["mode"])
+        self.step_time = r.histogram(
+            "step_seconds", "time of one engine step", self.STEP_TIME_BUCKETS, ["phase"]
+        )
+        self.batch_size = r.histogram(
+            "decode_batch_size", "requests per decode step", range(1, max_batch_size + 1), ["runner"]
+        )
+        self.kv_pages = r.gauge("kvcache_pages", "kvcache pages by state", ["state"])
+        self.queue_depth = r.gauge("requests", "live requests by state", ["state"])
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,237 @@
+import collections
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from torch.profiler import ProfilerActivity, profile
+
+from heyi.config import Config
+from heyi.utils.log import logger
+from heyi.utils.step_recorder import StepRecorder
+
+PROFILE_KINDS = ("torch", "cpuinfer", "python")
+
+
+class PythonSampler:
+    """
+    samples the python stack of one thread every `interval` seconds and
+    writes them as collapsed stacks (flamegraph.pl, speedscope)
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: collections.Counter = collections.Counter()
+        self.n_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="python-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def stop(self, path: str):
+        self.stopped.set()
+        self.thread.join()
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    """
+    one profiling run writing into its own directory, stopped explicitly or
+    after `duration` seconds / `max_steps` engine loop iterations
+    """
+
+    def __init__(
+        self,
+        kinds: Sequence[str],
+        out_dir: str,
+        duration: Optional[float],
+        max_steps: Optional[int],
+        cpuinfer: Any,
+        thread_id: Optional[int],
+    ):
+        self.id = uuid.uuid4().hex[:8]
+        self.kinds = list(kinds)
+        self.out_dir = os.path.join(out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.id}")
+        self.duration = duration
+        self.max_steps = max_steps
+        self.cpuinfer = cpuinfer
+        self.thread_id = thread_id
+        self.steps = 0
+        self.start_time = 0.0
+        self.stop_time = 0.0
+        self.files: List[str] = []
+        self.torch_profile: Optional[profile] = None
+        self.sampler: Optional[PythonSampler] = None
+
+    @property
+    def running(self) -> bool:
+        return self.start_time > 0 and not self.stop_time
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.start_time = time.perf_counter()
+        if "torch" in self.kinds:
+            self.torch_profile = profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA])
+            self.torch_profile.start()
+        if "cpuinfer" in self.kinds:
+            self.cpuinfer.start_trace(os.path.join(self.out_dir, "cpu.pftrace"))
+        if "python" in self.kinds:
+            self.sampler = PythonSampler(self.thread_id)
+            self.sampler.start()
+
+    def stop(self):
+        self.stop_time = time.perf_counter()
+        cpu_trace = None
+        if self.torch_profile is not None:
+            self.torch_profile.stop()
+            self.files.append(os.path.join(self.out_dir, "gpu.json"))
+            self.torch_profile.export_chrome_trace(self.files[-1])
+        if "cpuinfer" in self.kinds:
+            self.cpuinfer.end_trace()
+            cpu_trace = os.path.join(self.out_dir, "cpu.pftrace")
+            self.files.append(cpu_trace)
+        if self.sampler is not None:
+            self.files.append(os.path.join(self.out_dir, "python.collapsed"))
+            self.sampler.stop(self.files[-1])
+        # the engine steps of the session, next to the traces
+        self.files.append(os.path.join(self.out_dir, "steps.json"))
+        StepRecorder().dump(self.files[-1], since=self.start_time, cpu_trace=cpu_trace)
+
+    def status(self) -> Dict[str, Any]:
+        end = self.stop_time or time.perf_counter()
+        return {
+            "id": self.id,
+            "kinds": self.kinds,
+            "running": self.running,
+            "elapsed": end - self.start_time,
+            "steps": self.steps,
+            "duration": self.duration,
+            "max_steps": self.max_steps,
+            "out_dir": self.out_dir,
+            "files": self.files,
+        }
+
+
+class Profiler:
+    """
+    runs at most one `ProfileSession` at a time next to the live engine;
+    sessions hitting their duration or step limit stop on a thread of their
+    own, so writing the traces does not hold up the engine loop
+    """
+
+    def __init__(self, cpuinfer: Any = None, thread_id: Optional[int] = None):
+        self.lock = threading.Lock()
+        self.cpuinfer = cpuinfer
+        self.thread_id = thread_id
+        self.session: Optional[ProfileSession] = None
+        self.last_session: Optional[ProfileSession] = None
+        self.timer: Optional[threading.Timer] = None
+
+    def start(
+        self,
+        kinds: Sequence[str] = ("torch", "cpuinfer"),
+        duration: Optional[float] = None,
+        steps: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        kinds = list(dict.fromkeys(kinds))
+        if not kinds or any(kind not in PROFILE_KINDS for kind in kinds):
+            raise ValueError(f"profile kinds must be some of {PROFILE_KINDS}, got {kinds}")
+        if "cpuinfer" in kinds and self.cpuinfer is None:
+            raise ValueError("cpuinfer is not initialized")
+        if "python" in kinds and self.thread_id is None:
+            raise ValueError("no thread to sample")
+
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError(f"profile session {self.session.id} is already running")
+            session = ProfileSession(
+                kinds,
+                self.profiles_dir(),
+                duration,
+                steps,
+                self.cpuinfer,
+                self.thread_id,
+            )
+            session.start()
+            self.session = session
+            if duration:
+                self.timer = threading.Timer(duration, self._stop_in_background, (session,))
+                self.timer.daemon = True
+                self.timer.start()
+        logger.info(f"profile session {session.id} started: {kinds}, {duration=}, {steps=}")
+        return session.status()
+
+    @staticmethod
+    def profiles_dir() -> str:
+        return os.path.join(Config().log_dir, "profiles")
+
+    def cpu_trace(self, session_id: str) -> str:
+        """
+        the cpuinfer trace written by the stopped session `session_id`; only
+        ids are taken from clients, never paths
+        """
+        if not re.fullmatch(r"[0-9a-f]{8}", session_id):
+            raise ValueError(f"invalid profile session id {session_id!r}")
+        if self.session is not None and self.session.id == session_id:
+            raise ValueError(f"profile session {session_id} is still running")
+        root = self.profiles_dir()
+        dirs = [d for d in os.listdir(root) if d.endswith(f"-{session_id}")] if os.path.isdir(root) else []
+        path = os.path.join(root, dirs[0], "cpu.pftrace") if dirs else ""
+        if not os.path.isfile(path):
+            raise ValueError(f"profile session {session_id} has no cpuinfer trace")
+        return path
+
+    def _stop(self, session: ProfileSession) -> Dict[str, Any]:
+        with self.lock:
+            if self.session is not session:
+                return session.status()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            session.stop()
+            self.session = None
+            self.last_session = session
+        logger.info(f"profile session {session.id} written to {session.out_dir}")
+        return session.status()
+
+    def _stop_in_background(self, session: ProfileSession):
+        threading.Thread(target=self._stop, args=(session,), daemon=True).start()
+
+    def stop(self) -> Dict[str, Any]:
+        session = self.session
+        if session is None:
+            raise RuntimeError("no profile session is running")
+        return self._stop(session)
+
+    def on_step(self):
+        """called once per engine loop iteration"""
+        session = self.session
+        if session is None:
+            return
+        session.steps += 1
+        if session.max_steps and session.steps == session.max_steps:
+            self._stop_in_background(session)
+
+    def status(self) -> Dict[str, Any]:
+        session = self.session or self.last_session
+        return session.status() if session else {"running": False}
@@ -1,65 +1,26 @@
-import asyncio
+import itertools
+import threading
+from collections import OrderedDict
 from enum import Enum, auto
-from typing import Any, AsyncGenerator, Callable, Optional, Tuple, Type, Union, List
+from typing import Callable, Dict, Iterator, Optional, Tuple, List
 
 import torch
 from transformers import GenerationConfig
 from flashinfer.logits_processor import LogitsPipe
 
 from heyi.config import Config
+from heyi.utils.detokenizer import IncrementalDetokenizer
 from heyi.utils.stats import ReqStats
 from heyi.utils.kvcache.kvcache import Match
+from heyi.utils.kvcache.pagehash import PageHashCache
+from heyi.utils.kvcache.swap import SwapHandle
+from heyi.utils.sampling import SamplingParams
+from heyi.utils.stop_matcher import StopMatcher
+from heyi.utils.stream import AsyncStream
+from heyi.utils.token_arena import TokenBuffer
 from heyi.utils.usage import Usage
 
-STOP_ITERATION = Exception()  # Sentinel
-
-
-class AsyncStream:
-    """A stream of RequestOutputs or PoolingRequestOutputs for a request
-    that can be iterated over asynchronously via an async generator."""
-
-    def __init__(self, request_id: str, cancel: Callable[[str], None]) -> None:
-        self.request_id = request_id
-        self._cancel = cancel
-        self._queue: asyncio.Queue = asyncio.Queue()
-        self._finished = False
-
-    def put(self, item: Union[Any, Exception]) -> None:
-        if not self._finished:
-            self._queue.put_nowait(item)
-
-    def finish(
-        self,
-        exception: Optional[Union[BaseException, Type[BaseException]]] = None,
-    ) -> None:
-        if not self._finished:
-            self._finished = True
-            self._queue.put_nowait(
-                exception if self._is_raisable(exception) else STOP_ITERATION
-            )
-
-    @property
-    def finished(self) -> bool:
-        return self._finished
-
-    async def generator(self) -> AsyncGenerator[Any, None]:
-        try:
-            while True:
-                result = await self._queue.get()
-                if self._is_raisable(result):
-                    if result == STOP_ITERATION:
-                        return
-                    raise result
-                yield result
-        except GeneratorExit:
-            self._cancel(self.request_id)
-            raise asyncio.CancelledError from None
-
-    @staticmethod
-    def _is_raisable(value: Any):
-        return isinstance(value, BaseException) or (
-            isinstance(value, type) and issubclass(value, BaseException)
-        )
+PLACEHOLDER_TOKEN = -1  # a token planned ahead of being sampled, never matches a real page
 
 
 class ReqState(Enum):
@@ -67,6 +28,7 @@ class ReqState(Enum):
     PREFILLING = "PREFILLING"
     LPREFILLING = "LPREFILLING"
     DECODING = "DECODING"
+    PREEMPTED = "PREEMPTED"
     FINISHED = "FINISHED"
     CANCELLED = "CANCELLED"
 
@@ -79,75 +41,136 @@ class Request:
         input_ids: torch.Tensor,
         logits_processor: LogitsPipe,
         generation_config: Optional[GenerationConfig] = None,
+        sampling_params: Optional[SamplingParams] = None,
     ):
         self.request_id = request_id
         self.stream = stream
         self.logits_processor = logits_processor
+        # used by the batched sampler, `logits_processor` samples a single row
+        self.sampling_params = sampling_params if sampling_params else SamplingParams()
         self.generation_config = (
             generation_config if generation_config else GenerationConfig()
         )
 
-        self.state = ReqState.PENDING
+        # set by RequestRegistry, which makes every transition under its lock
+        self.registry: Optional["RequestRegistry"] = None
+        self._state = ReqState.PENDING
 
         self.prefilled_length = 0
         self.prompt_length = input_ids.shape[1]
-        self.all_ids = torch.zeros(1, generation_config.max_length).int().cuda()
-        self.all_ids[:, :self.prompt_length] = input_ids
+        self.tokens = TokenBuffer(input_ids)
         self.all_length = self.prompt_length
         self.generated_length = 0
 
         self.input_ids = None
         self.cache_position = None
-        self.matches: List[Match] = []
+        self.chunk_end = 0
+        self._matches: List[Match] = []
+        # chained hashes of the full pages, for prefix matching
+        self.page_hashes = PageHashCache(Config().kvcache_page_size)
 
         self.stats = ReqStats()
-        self.token_cache = []
+        self.detokenizer: Optional[IncrementalDetokenizer] = None  # set on submit
+        self.stop_matcher: Optional[StopMatcher] = None
         self.decode_runner_id: int | None = None
+        self.swap_handle: Optional[SwapHandle] = None
 
         self.usage = Usage()
 
 
-    def next_chunk(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        if self.prefilled_length < self.prompt_length:
+    @property
+    def state(self) -> ReqState:
+        return self._state
+
+    @state.setter
+    def state(self, state: ReqState):
+        if self.registry is not None:
+            self.registry.transition(self, state)
+        else:
+            self._state = state
+
+    @property
+    def matches(self) -> List[Match]:
+        return self._matches
+
+    @matches.setter
+    def matches(self, matches: List[Match]):
+        '''
+        the matched prefix-tree nodes stay pinned until replaced; atomic, the
+        scheduler and a runner thread may both set them
+        '''
+        nodes = matches or self._matches
+        if not nodes:
+            self._matches = matches
+            return
+        with nodes[0].node.lru.lock:
+            for match in matches:
+                match.node.pin()
+            for match in self._matches:
+                match.node.unpin()
+            self._matches = matches
+
+    @property
+    def prefill_length(self) -> int:
+        '''tokens to prefill, includes the generated ones if recomputing after preemption'''
+        return self.all_length
+
+    def next_chunk(self, chunk_size: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''host input ids [1, n] and positions [n] of the next chunk, staged to the gpu by the runner'''
+        if chunk_size is None:
+            chunk_size = Config().prefill_chunk_size
+        if self.prefilled_length < self.prefill_length:
             l = self.prefilled_length
             r = min(
-                self.prefilled_length + Config().prefill_chunk_size,
-                self.prompt_length,
+                self.prefilled_length + chunk_size,
+                self.prefill_length,
             )
-            self.cache_position = torch.arange(l, r).cuda()
-            self.input_ids = self.all_ids[:, l:r].cuda()
+            self.cache_position = torch.arange(l, r, device="cpu")
+            self.input_ids = self.all_ids[:, l:r]
+            self.chunk_end = r
         else:
-            self.cache_position = torch.tensor([self.prompt_length - 1]).int().cuda()
-            self.input_ids = self.all_ids[:, self.prompt_length - 1 : self.prompt_length].cuda()
+            self.cache_position = torch.tensor([self.prefill_length - 1], device="cpu")
+            self.input_ids = self.all_ids[:, self.prefill_length - 1 : self.prefill_length]
+            self.chunk_end = self.prefill_length
     
         return self.input_ids, self.cache_position
     
     def next_full_prefill(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        if self.prefilled_length < self.prompt_length:
+        if self.prefilled_length < self.prefill_length:
             l = self.prefilled_length
-            r = self.prompt_length
+            r = self.prefill_length
             self.cache_position = torch.arange(l, r).cuda()
             self.input_ids = self.all_ids[:, l:r].cuda()
         else:
-            self.cache_position = torch.tensor([self.prompt_length - 1]).int().cuda()
-            self.input_ids = self.all_ids[:, self.prompt_length - 1 : self.prompt_length].cuda()
+            self.cache_position = torch.tensor([self.prefill_length - 1]).int().cuda()
+            self.input_ids = self.all_ids[:, self.prefill_length - 1 : self.prefill_length].cuda()
         return self.input_ids, self.cache_position
     
-    def next_token(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        return self.all_ids[0, self.all_length-1], self.all_length - 1
+    @property
+    def all_ids(self) -> torch.Tensor:
+        '''[1, capacity] host view of the token ids, valid up to `all_length`'''
+        return self.tokens.ids
+
+    def append_token(self, token):
+        # keep room for a lookahead placeholder after it
+        self.tokens.reserve(self.all_length + 2)
+        self.all_ids[0, self.all_length] = int(token)
+        self.all_length += 1
+
+    def next_token(self, lookahead: int = 0) -> Tuple[int, int]:
+        if lookahead:
+            # the token at all_length is not sampled yet
+            return int(self.all_ids[0, self.all_length]), self.all_length
+        return int(self.all_ids[0, self.all_length-1]), self.all_length - 1
     
     def on_prefill_1chunk_done(self):
-        self.prefilled_length = min(
-            self.prefilled_length + Config().prefill_chunk_size,
-            self.prompt_length,
-        )
-        if self.prefilled_length >= self.prompt_length:
+        self.prefilled_length = self.chunk_end
+        if self.prefilled_length >= self.prefill_length:
             return True
         return False
 
     def on_decode1_done(self, token, txt, stop):
-        self.all_ids[0, self.all_length] = token
-        self.all_length += 1
+        self.append_token(token)
         self.generated_length += 1
         # print(f"DECODE1 DONE, {self.all_length=}, {token=}, {txt=}")
         self.stream.put((txt, stop))
@@ -166,22 +189,50 @@ class Request:
         if self.state not in [ReqState.PREFILLING, ReqState.LPREFILLING]:
             print(f"Invalid state={self.state.name}")
         self.state = ReqState.DECODING
+        if self.generated_length > 0:
+            # recomputed after preemption, the prefill yields the next decode token
+            self.on_decode1_done(token, txt, stop)
+            if stop:
+                self.on_decode_done(stop)
+            return
         self.stats.on_prefill_done(self.all_length)
-        self.all_ids[0, self.all_length] = token
-        self.all_length += 1
+        self.append_token(token)
         self.usage.prompt_tokens = self.prompt_length
         self.usage.total_tokens = self.all_length
         if Config().thinking:
             self.stream.put(("<think>", None))
         self.stream.put((txt, stop))
         self.generated_length += 1
+        if stop:
+            self.on_decode_done(stop)
 
     def on_decode_done(self, reason="stop"):
+        if self.stop_matcher and (held := self.stop_matcher.flush()):
+            # the start of a stop string that never completed
+            self.stream.put((held, None))
         self.state = ReqState.FINISHED
         self.stream.put(self.usage)
         self.stream.put(("", reason))
         self.stream.finish()
 
+    def preempt(self, swap_handle: Optional[SwapHandle] = None):
+        '''
+        pause decoding; with `swap_handle` the kv is restored from host memory
+        on resume, otherwise the request goes back to the prefill queue and
+        recomputes whatever the prefix tree has evicted by then
+        '''
+        self.matches = []
+        self.decode_runner_id = None
+        self.prefilled_length = 0
+        self.swap_handle = swap_handle
+        self.state = ReqState.PREEMPTED if swap_handle else ReqState.PENDING
+
+    def resume(self, match: Match):
+        '''swapped in, continue decoding'''
+        self.matches = [match]
+        self.swap_handle = None
+        self.state = ReqState.DECODING
+
     def cancel(self):
         self.state = ReqState.CANCELLED
         self.stream.put(self.usage)
@@ -198,27 +249,110 @@ class Request:
         return not (self == value)
 
 
+class RequestRegistry:
+    """
+    requests indexed by id and by state, transitions are O(1)
+
+    each state keeps a queue in the order requests entered it, except that
+    preempted requests jump to the front of PENDING / PREEMPTED so they
+    resume before newer ones. Thread-safe: queries return snapshots.
+    """
+
+    def __init__(self, on_state_change: Optional[Callable[[Request, ReqState], None]] = None):
+        self.lock = threading.Lock()
+        self.on_state_change = on_state_change
+        self._by_id: Dict[str, Request] = {}
+        self._by_state: Dict[ReqState, OrderedDict[str, Request]] = {
+            state: OrderedDict() for state in ReqState
+        }
+
+    def add(self, req: Request):
+        with self.lock:
+            self._by_id[req.request_id] = req
+            self._by_state[req.state][req.request_id] = req
+            req.registry = self
+
+    def remove(self, req: Request):
+        with self.lock:
+            self._by_id.pop(req.request_id, None)
+            for queue in self._by_state.values():
+                queue.pop(req.request_id, None)
+            req.registry = None
+
+    def transition(self, req: Request, state: ReqState):
+        """
+        set the state of `req` and move it to that state's queue, atomic: the
+        engine thread and a cancelling caller may race
+        """
+        with self.lock:
+            old_state = req._state
+            if old_state is state:
+                return
+            req._state = state
+            if req.request_id not in self._by_id:
+                # removed meanwhile
+                return
+            self._by_state[old_state].pop(req.request_id, None)
+            queue = self._by_state[state]
+            queue[req.request_id] = req
+            if old_state is ReqState.DECODING and state in [ReqState.PENDING, ReqState.PREEMPTED]:
+                queue.move_to_end(req.request_id, last=False)
+        if self.on_state_change is not None:
+            self.on_state_change(req, old_state)
+
+    def get(self, request_id: str) -> Optional[Request]:
+        return self._by_id.get(request_id)
+
+    def in_state(self, *states: ReqState, limit: Optional[int] = None) -> List[Request]:
+        with self.lock:
+            reqs = itertools.chain.from_iterable(
+                self._by_state[state].values() for state in states
+            )
+            return list(itertools.islice(reqs, limit))
+
+    def count(self, *states: ReqState) -> int:
+        return sum(len(self._by_state[state]) for state in states)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Request]:
+        with self.lock:
+            return iter(list(self._by_id.values()))
+
+
 class DecodeBatch:
 
-    def __init__(self, B: int, reqs: List[Request]):
+    def __init__(self, B: int, reqs: List[Request], lookahead: int = 0):
+        '''
+        lookahead: 1 to plan the step after the one in flight, whose input
+        tokens are not sampled yet and stand in as `PLACEHOLDER_TOKEN`
+        '''
         self.reqs = reqs
         assert B >= len(reqs)
         self.B = B
         self.decode_runner_id: int | None = None
-
-    def next_token(self):
+        self.slot: int | None = None
+        self.lookahead = lookahead
+        if lookahead:
+            for req in reqs:
+                req.tokens.reserve(req.all_length + 1)
+                req.all_ids[0, req.all_length] = PLACEHOLDER_TOKEN
+
+    def next_token(self, out: torch.Tensor):
+        '''write the input ids / positions of the step into rows 0 / 1 of the host tensor `out`'''
         b_input_ids = []
         b_cache_position = []
         for req in self.reqs:
-            input_ids, cache_position = req.next_token()
+            input_ids, cache_position = req.next_token(self.lookahead)
             b_input_ids.append(input_ids)
             b_cache_position.append(cache_position)
 
-        return torch.tensor(b_input_ids, device=0).view(-1, 1), torch.tensor(b_cache_position, device=0)
+        out[:, : len(self.reqs)] = torch.tensor([b_input_ids, b_cache_position], device="cpu")
 
     @property
     def all_ids(self):
-        return [req.all_ids[0, :req.all_length] for req in self.reqs]
+        return [req.all_ids[0, :req.all_length + self.lookahead] for req in self.reqs]
    
     def set_runner_id_for_requests(self, runner_id: int):
         for req in self.reqs:
@@ -232,7 +366,7 @@ class DecodeBatch:
     def matches(self, matches):
         '''user must ensure the sequence of `matches` aligns with the sequence of `self.reqs`'''        
         for req, match in zip(self.reqs, matches):
-            req.matches[0] = match
+            req.matches = [match]
 
     def __repr__(self):
         str_reqs = ", ".join([
@@ -0,0 +1,88 @@
+from typing import Dict, List, NamedTuple, Tuple
+
+import flashinfer
+import torch
+
+
+class SamplingParams(NamedTuple):
+    """
+    per request sampling knobs, with the same semantics as the per request
+    `LogitsPipe` built by `prepare_logits_processor`:
+
+    - temperature:  0 is greedy; only values in (0, 1) rescale the logits
+    - top_k:        0 disables top-k
+    - top_p:        1.0 disables top-p
+    """
+
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "SamplingParams":
+        temperature = config.get("temperature")
+        if temperature is None or not 0 <= temperature < 1:
+            temperature = 1.0
+        top_p = config.get("top_p")
+        return cls(
+            temperature=float(temperature),
+            top_k=int(config.get("top_k") or 0),
+            top_p=float(1.0 if top_p is None else top_p),
+        )
+
+
+def stack_sampling_params(
+    params: List[SamplingParams], vocab_size: int, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    [B] temperature, top_k, top_p tensors, moved to `device` in one transfer
+    """
+    packed = torch.tensor(
+        [
+            [p.temperature for p in params],
+            [p.top_k if 0 < p.top_k < vocab_size else vocab_size for p in params],
+            [p.top_p for p in params],
+        ],
+        dtype=torch.float32,
+    ).to(device, non_blocking=True)
+    temperature, top_k, top_p = packed
+    return temperature, top_k.int(), top_p
+
+
+def _sample_torch(
+    logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor
+) -> torch.Tensor:
+    """reference implementation: top-k, softmax, top-p, sample"""
+    sorted_logits, sorted_ids = logits.sort(dim=-1, descending=True)
+    ranks = torch.arange(logits.shape[-1], device=logits.device)
+    sorted_logits = sorted_logits.masked_fill(ranks >= top_k[:, None], -torch.inf)
+    probs = sorted_logits.softmax(dim=-1)
+    # keep the smallest prefix whose mass reaches top_p, at least one token
+    cum_before = probs.cumsum(dim=-1) - probs
+    probs = probs.masked_fill(cum_before >= top_p[:, None], 0.0)
+    picked = torch.multinomial(probs, num_samples=1).squeeze(-1)
+    return sorted_ids.gather(-1, picked[:, None]).squeeze(-1)
+
+
+@torch.no_grad()
+def sample_batch(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_k: torch.Tensor,
+    top_p: torch.Tensor,
+) -> torch.Tensor:
+    """
+    sample one token per row of `logits` [B, vocab] with per row parameters,
+    rows with temperature 0 are greedy. Returns [B] token ids on the device
+    of `logits`.
+    """
+    logits = logits.float()
+    greedy = temperature == 0
+    scaled = logits / torch.where(greedy, 1.0, temperature)[:, None]
+    if logits.is_cuda:
+        sampled = flashinfer.sampling.top_k_top_p_sampling_from_logits(
+            scaled, top_k, top_p, filter_apply_order="top_k_first"
+        )
+    else:
+        sampled = _sample_torch(scaled, top_k, top_p)
+    return torch.where(greedy, logits.argmax(dim=-1), sampled.long())
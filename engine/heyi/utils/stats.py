@@ -1,23 +1,101 @@
+import math
+import threading
 import time
-
-import numpy as np
+from typing import List
+
+
+class LogHistogram:
+    """
+    constant-memory latency histogram with log-spaced buckets
+
+    `buckets_per_octave` buckets per doubling of the value, i.e. quantiles
+    are within 2 ** (1 / buckets_per_octave) - 1 (4.4% by default) of the
+    exact value; values out of [min_value, max_value] go to the end buckets.
+    Recording is O(1), histograms of the same shape merge by adding counts.
+    """
+
+    def __init__(self, min_value: float = 1e-3, max_value: float = 1e7, buckets_per_octave: int = 16):
+        self.min_value = min_value
+        self.buckets_per_octave = buckets_per_octave
+        self.n_buckets = int(math.log2(max_value / min_value) * buckets_per_octave) + 1
+        self.counts: List[int] = [0] * self.n_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _bucket(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        return min(int(math.log2(value / self.min_value) * self.buckets_per_octave), self.n_buckets - 1)
+
+    def _bucket_value(self, i: int) -> float:
+        """geometric middle of bucket `i`"""
+        return self.min_value * 2 ** ((i + 0.5) / self.buckets_per_octave)
+
+    def record(self, value: float):
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LogHistogram"):
+        assert self.n_buckets == other.n_buckets and self.min_value == other.min_value
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen > rank:
+                return min(max(self._bucket_value(i), self.min), self.max)
+        return self.max
+
+    def summarize(self, quantiles=(0.5, 0.95, 0.99)):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            **{f"p{round(q * 100)}": self.quantile(q) for q in quantiles},
+            "max": self.max,
+        }
 
 
 class ReqStats:
     def __init__(self):
         self._start_time = time.perf_counter()
+        self._schedule_time = 0.0
         self._first_token_time = 0.0
         self._last_token_time = 0.0
-        self._token_intervals = []
+        self.tbt_hist = LogHistogram()  # ms
 
         self.prefill_ntokens = 0
         self.decode_ntokens = 0
 
+        self.queue_time = 0
         self.ttft = 0
         self.avg_tbt = 0
         self.p95_tbt = 0
         self.throughput = 0
 
+    def on_scheduled(self):
+        """first time the request leaves the pending queue"""
+        if not self._schedule_time:
+            self._schedule_time = time.perf_counter()
+
     def on_prefill_done(self, ntokens: int):
         self.prefill_ntokens = ntokens
         self._first_token_time = time.perf_counter()
@@ -26,23 +104,25 @@ class ReqStats:
 
     def on_decode1_done(self):
         current_time = time.perf_counter()
-        self._token_intervals.append(current_time - self._last_token_time)
+        self.tbt_hist.record((current_time - self._last_token_time) * 1000)
         self.decode_ntokens += 1
         self._last_token_time = current_time
 
     def summarize(self):
+        queue_time = (
+            (self._schedule_time - self._start_time) * 1000
+            if self._schedule_time
+            else 0.0
+        )
+
         ttft = (
             (self._first_token_time - self._start_time) * 1000
             if self._start_time and self._first_token_time
             else 0.0
         )
 
-        if self._token_intervals:
-            intervals = np.array(self._token_intervals)
-            avg_tbt = np.mean(intervals) * 1000
-            p95_tbt = np.percentile(intervals, 95) * 1000
-        else:
-            avg_tbt = p95_tbt = 0.0
+        avg_tbt = self.tbt_hist.mean
+        p95_tbt = self.tbt_hist.quantile(0.95)
 
         if self.decode_ntokens > 1:
             total_time = self._last_token_time - self._first_token_time
@@ -52,12 +132,14 @@ class ReqStats:
         else:
             throughput = 0.0
 
+        self.queue_time=queue_time
         self.ttft=ttft
         self.avg_tbt=avg_tbt
         self.p95_tbt=p95_tbt
         self.throughput=throughput
 
         return dict(
+            queue_time=queue_time,
             ttft=ttft,
             avg_tbt=avg_tbt,
             p95_tbt=p95_tbt,
@@ -71,6 +153,7 @@ class ReqStats:
             "\n" + "=" * 60,
             "LLM Request Performance Statistics".center(60),
             "-" * 60,
+            f"{'Queue Time':<35}: {self.queue_time:>8.2f} ms",
             f"{'TTFT':<35}: {self.ttft:>8.2f} ms",
             f"{'Avg TBT':<35}: {self.avg_tbt:>8.2f} ms",
             f"{'P95 TBT':<35}: {self.p95_tbt:>8.2f} ms",
@@ -83,9 +166,38 @@ class ReqStats:
         return "\n".join(output)
 
 
+class LatencyStats:
+    """engine-wide latency distributions (ms), requests are merged in when they finish"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue_time = LogHistogram()
+        self.ttft = LogHistogram()
+        self.tbt = LogHistogram()
+
+    def add_request(self, stats: ReqStats):
+        stats.summarize()
+        with self.lock:
+            if stats._schedule_time:
+                self.queue_time.record(stats.queue_time)
+            if stats._first_token_time:
+                self.ttft.record(stats.ttft)
+            self.tbt.merge(stats.tbt_hist)
+
+    def summarize(self):
+        with self.lock:
+            return {
+                "queue_time": self.queue_time.summarize(),
+                "ttft": self.ttft.summarize(),
+                "tbt": self.tbt.summarize(),
+            }
+
+
 if __name__ == "__main__":
     stats = ReqStats()
-    time.sleep(0.12)
+    time.sleep(0.02)
+    stats.on_scheduled()
+    time.sleep(0.1)
     stats.on_prefill_done(256)
 
     delays = [0.05, 0.048, 0.052, 0.049, 0.051, 0.055, 0.053, 0.047, 0.050, 0.052]
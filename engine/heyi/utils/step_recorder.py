@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from heyi.config import Config
+from heyi.utils.log import logger
+from heyi.utils.singleton import Singleton
+
+
+class StepRecorder(Singleton):
+    """
+    ring buffer of the last `step_recorder_size` timed spans of the engine
+    (scheduling, planning, decode steps, sampling, stream delivery), cheap
+    enough to stay on: a span is two clock reads and a deque append; a size
+    of 0 turns it off.
+
+    Spans are kept per track, e.g. the scheduler or a runner, and exported as
+    a Chrome trace (chrome://tracing, ui.perfetto.dev) on the clock perfetto
+    uses, so the trace of `CPUInfer.start_trace` can be merged in.
+    """
+
+    def _singleton_init(self, capacity: Optional[int] = None):
+        self.capacity = Config().step_recorder_size if capacity is None else capacity
+        self.lock = threading.Lock()
+        # (name, track, start, end, args), perf_counter seconds
+        self.spans: deque = deque(maxlen=max(self.capacity, 1))
+        self.n_recorded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def record(self, name: str, track: str, start: float, end: float, **args):
+        if self.capacity > 0:
+            with self.lock:
+                self.spans.append((name, track, start, end, args))
+                self.n_recorded += 1
+
+    @contextmanager
+    def span(self, name: str, track: str, **args):
+        """times the block, the yielded args can still be added to"""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(name, track, start, time.perf_counter(), **args)
+
+    @staticmethod
+    def _clock_offset_us() -> float:
+        """perf_counter -> perfetto's default trace clock (boottime), in us"""
+        return time.clock_gettime_ns(time.CLOCK_BOOTTIME) / 1e3 - time.perf_counter() * 1e6
+
+    def to_chrome_trace(self, cpu_trace: Optional[str] = None, since: float = 0.0) -> Dict[str, Any]:
+        """
+        cpu_trace: a perfetto trace of `CPUInfer.start_trace` to merge in,
+        needs the `perfetto` python package
+        since: only spans ending after this perf_counter time
+        """
+        with self.lock:
+            spans = [span for span in self.spans if span[3] >= since]
+        pid = os.getpid()
+        offset = self._clock_offset_us()
+        tids: Dict[str, int] = {}
+        events: List[Dict[str, Any]] = []
+        for name, track, start, end, args in spans:
+            tid = tids.setdefault(track, len(tids) + 1)
+            events.append({
+                "name": name,
+                "cat": "engine",
+                "ph": "X",
+                "ts": start * 1e6 + offset,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        for track, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track}})
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "heyi engine"}})
+        if cpu_trace:
+            events.extend(self._load_perfetto_trace(cpu_trace))
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str, cpu_trace: Optional[str] = None, since: float = 0.0):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(cpu_trace, since), f)
+
+    @staticmethod
+    def _load_perfetto_trace(path: str) -> List[Dict[str, Any]]:
+        try:
+            from perfetto.trace_processor import TraceProcessor
+        except ImportError:
+            logger.warning("perfetto is not installed, cpu trace not merged")
+            return []
+
+        tp = TraceProcessor(trace=path)
+        try:
+            rows = tp.query(
+                "select s.ts, s.dur, s.name, s.category, t.tid, t.name as thread_name "
+                "from slice s join thread_track tt on s.track_id = tt.id "
+                "join thread t using (utid)"
+            )
+            events = []
+            names = {}
+            for row in rows:
+                names[row.tid] = row.thread_name or f"cpuinfer {row.tid}"
+                events.append({
+                    "name": row.name,
+                    "cat": row.category or "cpuinfer",
+                    "ph": "X",
+                    "ts": row.ts / 1e3,
+                    "dur": max(row.dur, 0) / 1e3,
+                    "pid": "cpuinfer",
+                    "tid": row.tid,
+                })
+            for tid, name in names.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": "cpuinfer", "tid": tid, "args": {"name": name}})
+            return events
+        finally:
+            tp.close()
+
+    def summarize(self):
+        return {
+            "capacity": self.capacity,
+            "spans": len(self.spans),
+            "recorded": self.n_recorded,
+        }
@@ -0,0 +1,109 @@
+from collections import deque
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Sequence, Tuple
+
+
+class StopAutomaton:
+    """
+    Aho-Corasick automaton over the characters of the stop strings
+
+    - goto:     trie edges of each state
+    - fail:     longest proper suffix of the state that is also a trie state
+    - depth:    length of the state's string, i.e. the longest suffix of the
+                text read so far that may still grow into a stop string
+    - out:      length of the longest stop string ending at the state, 0 if none
+    """
+
+    def __init__(self, stop_strings: Sequence[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.out = [0]
+        for s in stop_strings:
+            state = 0
+            for c in s:
+                if c not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.out.append(0)
+                    self.goto[state][c] = len(self.goto) - 1
+                state = self.goto[state][c]
+            self.out[state] = max(self.out[state], len(s))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in self.goto[state].items():
+                queue.append(child)
+                self.fail[child] = self.next(self.fail[state], c) if state else 0
+                self.out[child] = max(self.out[child], self.out[self.fail[child]])
+
+    def next(self, state: int, c: str) -> int:
+        while state and c not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(c, 0)
+
+
+@lru_cache(maxsize=64)
+def _automaton(stop_strings: Tuple[str, ...]) -> StopAutomaton:
+    return StopAutomaton(stop_strings)
+
+
+class StopMatcher:
+    """
+    per request stop conditions, matched on the streamed text as it arrives
+
+    Text that may be the start of a stop string is held back until it either
+    completes the stop string (dropped, the request stops) or can no longer
+    match (released with the next text). Each character is looked at a
+    bounded amortized number of times, independent of the output length.
+    """
+
+    def __init__(
+        self, stop_strings: Sequence[str] = (), stop_token_ids: Iterable[int] = ()
+    ):
+        stop_strings = tuple(s for s in stop_strings if s)
+        self.automaton = _automaton(stop_strings) if stop_strings else None
+        self.stop_token_ids: FrozenSet[int] = frozenset(stop_token_ids)
+        self.state = 0
+        self.held = ""
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "StopMatcher":
+        stop = config.get("stop") or []
+        if isinstance(stop, str):
+            stop = [stop]
+        return cls(stop, config.get("stop_token_ids") or [])
+
+    def is_stop_token(self, token_id: int) -> bool:
+        return token_id in self.stop_token_ids
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """
+        returns the text that is safe to stream and whether a stop string
+        was completed; the stop string itself is never returned
+        """
+        if self.automaton is None or not text:
+            return text, False
+
+        pending = self.held + text
+        state = self.state
+        for i, c in enumerate(text):
+            state = self.automaton.next(state, c)
+            if self.automaton.out[state]:
+                end = len(self.held) + i + 1
+                self.held = ""
+                self.state = 0
+                return pending[: end - self.automaton.out[state]], True
+
+        self.state = state
+        n_safe = len(pending) - self.automaton.depth[state]
+        self.held = pending[n_safe:]
+        return pending[:n_safe], False
+
+    def flush(self) -> str:
+        """the held back text, once the request finished for another reason"""
+        held, self.held = self.held, ""
+        self.state = 0
+        return held
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple, Type, Union
+
+from heyi.utils.log import logger
+
+STOP_ITERATION = Exception()  # Sentinel
+
+
+def _is_text(item: Any) -> bool:
+    """a (text, None) chunk, which can be merged with the next one"""
+    return isinstance(item, tuple) and len(item) == 2 and isinstance(item[0], str) and item[1] is None
+
+
+class AsyncStream:
+    """A stream of RequestOutputs or PoolingRequestOutputs for a request
+    that can be iterated over asynchronously via an async generator.
+
+    Items are put by the engine thread and consumed on the loop running
+    `generator`. They are buffered here and handed over to that loop by the
+    `StreamDelivery`, consecutive text chunks merged into one. With
+    `min_flush_interval` (seconds) or `min_flush_bytes` text is held back
+    until either is reached; anything else (stop reason, usage, end of
+    stream) is delivered with the next flush."""
+
+    def __init__(
+        self,
+        request_id: str,
+        cancel: Callable[[str], None],
+        delivery: Optional["StreamDelivery"] = None,
+        min_flush_interval: float = 0.0,
+        min_flush_bytes: int = 0,
+    ) -> None:
+        self.request_id = request_id
+        self._cancel = cancel
+        self._delivery = delivery
+        self.min_flush_interval = min_flush_interval
+        self.min_flush_bytes = min_flush_bytes
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._finished = False
+        # consumer loop, known once `generator` runs
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._pending: List[Any] = []
+        self._pending_bytes = 0
+        self._urgent = False  # a non-text item is pending
+        self._last_flush = time.perf_counter()
+
+    def put(self, item: Union[Any, Exception]) -> None:
+        if not self._finished:
+            self._enqueue(item)
+
+    def finish(
+        self,
+        exception: Optional[Union[BaseException, Type[BaseException]]] = None,
+    ) -> None:
+        if not self._finished:
+            self._finished = True
+            self._enqueue(
+                exception if self._is_raisable(exception) else STOP_ITERATION
+            )
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def _enqueue(self, item: Any):
+        with self._lock:
+            if _is_text(item):
+                if self._pending and _is_text(self._pending[-1]):
+                    self._pending[-1] = (self._pending[-1][0] + item[0], None)
+                else:
+                    self._pending.append(item)
+                self._pending_bytes += len(item[0])
+            else:
+                self._pending.append(item)
+                self._urgent = True
+        if self._delivery is not None:
+            self._delivery.mark(self)
+        elif self._loop is not None:
+            items = self._take(time.perf_counter(), force=True)
+            if items:
+                self._loop.call_soon_threadsafe(self._deliver, items)
+
+    def _take(self, now: float = 0.0, force: bool = False) -> Optional[List[Any]]:
+        """
+        pending items due for delivery, None if there are none or they are
+        held back; called off the consumer loop
+        """
+        with self._lock:
+            if not self._pending or self._loop is None:
+                return None
+            if not (
+                force
+                or self._urgent
+                or (not self.min_flush_interval and not self.min_flush_bytes)
+                or (self.min_flush_interval and now - self._last_flush >= self.min_flush_interval)
+                or (self.min_flush_bytes and self._pending_bytes >= self.min_flush_bytes)
+            ):
+                return None
+            items, self._pending = self._pending, []
+            self._pending_bytes = 0
+            self._urgent = False
+            self._last_flush = now
+            return items
+
+    def _deliver(self, items: List[Any]):
+        """runs on the consumer loop"""
+        for item in items:
+            self._queue.put_nowait(item)
+
+    async def generator(self) -> AsyncGenerator[Any, None]:
+        with self._lock:
+            # items put before the consumer showed up
+            self._loop = asyncio.get_running_loop()
+            items, self._pending = self._pending, []
+            self._pending_bytes = 0
+            self._urgent = False
+        self._deliver(items)
+        try:
+            while True:
+                result = await self._queue.get()
+                if self._is_raisable(result):
+                    if result == STOP_ITERATION:
+                        return
+                    raise result
+                yield result
+        except GeneratorExit:
+            self._cancel(self.request_id)
+            raise asyncio.CancelledError from None
+
+    @staticmethod
+    def _is_raisable(value: Any):
+        return isinstance(value, BaseException) or (
+            isinstance(value, type) and issubclass(value, BaseException)
+        )
+
+
+def _deliver_batch(batch: List[Tuple[AsyncStream, List[Any]]]):
+    for stream, items in batch:
+        stream._deliver(items)
+
+
+class StreamDelivery:
+    """
+    hands the items put on `AsyncStream`s over to their consumer loops,
+    one `call_soon_threadsafe` per consumer loop per `flush` instead of one
+    per item. The engine flushes once per scheduler step.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # streams with pending items, insertion ordered
+        self.dirty: Dict[int, AsyncStream] = {}
+        self.n_flushes = 0
+        self.n_loop_hops = 0
+
+    def mark(self, stream: AsyncStream):
+        with self.lock:
+            self.dirty[id(stream)] = stream
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self.dirty)
+
+    def flush(self, force: bool = False):
+        """
+        deliver what is due; held back text (flush thresholds, consumer not
+        started yet) stays pending, `force` ignores the thresholds
+        """
+        with self.lock:
+            streams = list(self.dirty.values())
+            self.dirty.clear()
+        if not streams:
+            return
+
+        now = time.perf_counter()
+        by_loop: Dict[asyncio.AbstractEventLoop, List[Tuple[AsyncStream, List[Any]]]] = {}
+        held = []
+        for stream in streams:
+            items = stream._take(now, force)
+            if items is None:
+                # without a consumer yet, `generator` picks the items up itself
+                if stream._pending and stream._loop is not None:
+                    held.append(stream)
+                continue
+            by_loop.setdefault(stream._loop, []).append((stream, items))
+        if held:
+            with self.lock:
+                for stream in held:
+                    self.dirty.setdefault(id(stream), stream)
+
+        self.n_flushes += 1
+        for loop, batch in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver_batch, batch)
+                self.n_loop_hops += 1
+            except RuntimeError:
+                # the consumer loop is closed, nobody is listening anymore
+                logger.warning(f"dropped stream items of {len(batch)} requests, consumer loop closed")
@@ -0,0 +1,102 @@
+import threading
+from typing import Dict, List
+
+import torch
+
+from heyi.config import Config
+from heyi.utils.singleton import Singleton
+
+
+class TokenArena(Singleton):
+    """
+    host memory of the token ids of all requests
+
+    Requests hold one contiguous int32 segment each, so every prefix of a
+    request is a zero-copy view. Segment capacities are a power of two number
+    of pages (`kvcache_page_size` tokens); a full segment moves to one twice
+    as large, which keeps appends amortized O(1) and the held memory within
+    twice the live tokens. Freed segments are kept per size class and reused;
+    new ones are carved out of chunks of `CHUNK_NUM_TOKENS` (larger segments
+    get a chunk of their own).
+    """
+
+    CHUNK_NUM_TOKENS = 1 << 22
+
+    def _singleton_init(self, page_size: int = 0):
+        self.lock = threading.Lock()
+        self.page_size = page_size or Config().kvcache_page_size
+        self.chunks: List[torch.Tensor] = []
+        self.chunk_used = 0  # tokens carved out of the last chunk
+        self.free_segments: Dict[int, List[torch.Tensor]] = {}
+        self.reserved_tokens = 0  # in chunks
+        self.held_tokens = 0  # in segments handed out
+
+    def _capacity(self, num_tokens: int) -> int:
+        n_pages = max((num_tokens + self.page_size - 1) // self.page_size, 1)
+        return (1 << (n_pages - 1).bit_length()) * self.page_size
+
+    def allocate(self, num_tokens: int) -> torch.Tensor:
+        """1D int32 segment of at least `num_tokens`, filled with -1"""
+        capacity = self._capacity(num_tokens)
+        with self.lock:
+            free = self.free_segments.get(capacity)
+            if free:
+                segment = free.pop()
+            elif capacity > self.CHUNK_NUM_TOKENS:
+                segment = torch.empty(capacity, dtype=torch.int32, device="cpu")
+                self.chunks.append(segment)
+                self.reserved_tokens += capacity
+            else:
+                if not self.chunks or self.chunk_used + capacity > self.chunks[-1].shape[0]:
+                    self.chunks.append(
+                        torch.empty(self.CHUNK_NUM_TOKENS, dtype=torch.int32, device="cpu")
+                    )
+                    self.chunk_used = 0
+                    self.reserved_tokens += self.CHUNK_NUM_TOKENS
+                segment = self.chunks[-1][self.chunk_used : self.chunk_used + capacity]
+                self.chunk_used += capacity
+            self.held_tokens += capacity
+        segment.fill_(-1)
+        return segment
+
+    def free(self, segment: torch.Tensor):
+        with self.lock:
+            self.free_segments.setdefault(segment.shape[0], []).append(segment)
+            self.held_tokens -= segment.shape[0]
+
+    def summarize(self):
+        return {
+            "reserved_tokens": self.reserved_tokens,
+            "held_tokens": self.held_tokens,
+        }
+
+
+class TokenBuffer:
+    """
+    the token ids of one request in the `TokenArena`, grows on demand;
+    `ids` is [1, capacity], valid up to what the request has written
+    """
+
+    def __init__(self, input_ids: torch.Tensor):
+        self.arena = TokenArena()
+        length = input_ids.shape[-1]
+        self.segment = self.arena.allocate(length + 1)
+        self.segment[:length] = input_ids.view(-1)
+
+    @property
+    def ids(self) -> torch.Tensor:
+        return self.segment.view(1, -1)
+
+    def reserve(self, num_tokens: int):
+        """make room for `num_tokens` tokens, moves the segment if it is too small"""
+        if num_tokens <= self.segment.shape[0]:
+            return
+        segment = self.arena.allocate(num_tokens)
+        segment[: self.segment.shape[0]] = self.segment
+        self.arena.free(self.segment)
+        self.segment = segment
+
+    def release(self):
+        if self.segment is not None:
+            self.arena.free(self.segment)
+            self.segment = None
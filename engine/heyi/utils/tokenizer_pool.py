@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from heyi.utils.chat_template_cache import ChatTemplatePrefixCache
+
+# the tokenizer and prefix cache of a worker process
+_tokenizer: Optional[PreTrainedTokenizerBase] = None
+_prefix_cache: Optional[ChatTemplatePrefixCache] = None
+
+
+def _init_worker(model_path: str, trust_remote_code: bool, cache_size: int, cache_verify: bool):
+    global _tokenizer, _prefix_cache
+    torch.set_num_threads(1)
+    _tokenizer = AutoTokenizer.from_pretrained(
+        model_path, trust_remote_code=trust_remote_code, use_fast=True
+    )
+    if cache_size > 0:
+        _prefix_cache = ChatTemplatePrefixCache(_tokenizer, cache_size, cache_verify)
+
+
+def _format_and_tokenize(
+    messages: List, tools: Optional[List], template_kwargs: Dict
+) -> Tuple[torch.Tensor, Optional[bool]]:
+    assert _tokenizer is not None
+    hit = None
+    if _prefix_cache is not None:
+        input_ids, hit = _prefix_cache.format_and_tokenize(messages, tools, **template_kwargs)
+    else:
+        input_ids = _tokenizer.apply_chat_template(
+            messages,
+            tools=tools,
+            tokenize=True,
+            add_generation_prompt=True,
+            return_tensors="pt",
+            **template_kwargs,
+        )
+    # handed back as a file descriptor, not pickled element by element
+    return input_ids.share_memory_(), hit
+
+
+class TokenizerPool:
+    """
+    chat-template rendering and tokenization in worker processes, so long
+    prompts neither hold the GIL of the http server nor of the engine thread
+
+    Workers are spawned (the parent has cuda initialized) and return the
+    input ids [1, L] as shared-memory tensors. Each worker has its own
+    `ChatTemplatePrefixCache`, the hit counts are summed here. The pool
+    lives as long as the engine, i.e. the process, whose exit joins the
+    workers.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        n_workers: int,
+        trust_remote_code: bool = True,
+        cache_size: int = 0,
+        cache_verify: bool = False,
+    ):
+        self.n_workers = n_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_path, trust_remote_code, cache_size, cache_verify),
+        )
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def submit(
+        self, messages: List, tools: Optional[List] = None, **template_kwargs
+    ) -> Future:
+        return self.executor.submit(_format_and_tokenize, messages, tools, template_kwargs)
+
+    async def format_and_tokenize(
+        self, messages: List, tools: Optional[List] = None, **template_kwargs
+    ) -> torch.Tensor:
+        input_ids, hit = await asyncio.wrap_future(self.submit(messages, tools, **template_kwargs))
+        if hit is not None:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        return input_ids